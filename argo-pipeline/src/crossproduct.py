@@ -1,11 +1,30 @@
 import json
 import argparse
+
+import pandas as pd
+
 from cartiflette.pipeline import crossproduct_parameters_production
+from cartiflette.pipeline.planner import plan_from_crossproduct, write_plan
 
 parser = argparse.ArgumentParser(description="Crossproduct Script")
 parser.add_argument(
     "--restrictfield", type=str, default=None, help="Field to restrict level-polygons"
 )
+parser.add_argument(
+    "--plan", type=str, default=None, help="Path to write the execution plan to"
+)
+parser.add_argument(
+    "--year",
+    type=int,
+    default=None,
+    help="Year of the datasets (default: every year of the parameters)",
+)
+parser.add_argument(
+    "--batches",
+    type=int,
+    default=None,
+    help="Bin-pack the split jobs into this number of batches (split_batch.py)",
+)
 
 
 # parameters
@@ -47,20 +66,45 @@ def main():
     tempdf = crossproduct_parameters_production(
         croisement_filter_by_borders=croisement_decoupage_level,
         list_format=formats,
-        years=years,
+        years=[args.year] if args.year else years,
         crs_list=crs_list,
         sources=sources,
         simplifications=[0, 50],
     )
-    tempdf.columns = tempdf.columns.str.replace("_", "-")
+    # deduplicated plan : a single job per split, producing every format and
+    # simplification (enrich and dissolve being run once, upstream)
+    plan = plan_from_crossproduct(tempdf)
+    if args.plan:
+        write_plan(plan, args.plan)
+    if args.batches:
+        batches = plan.batches(args.batches, level_polygons=args.restrictfield)
+        print(
+            json.dumps(
+                [
+                    {"batch": json.dumps(records(pd.DataFrame(batch)))}
+                    for batch in batches
+                    if batch
+                ]
+            )
+        )
+        return
+
+    tempdf = pd.DataFrame(plan.split_jobs())
 
     # Apply filtering if restrictfield is provided
     if args.restrictfield:
-        tempdf = tempdf.loc[tempdf["level-polygons"] == args.restrictfield]
+        tempdf = tempdf.loc[tempdf["level_polygons"] == args.restrictfield]
 
-    output = tempdf.to_json(orient="records")
-    parsed = json.loads(output)
-    print(json.dumps(parsed))
+    print(json.dumps(records(tempdf)))
+
+
+def records(tempdf):
+    "Rows of the jobs, as argo parameters"
+    tempdf = tempdf.copy()
+    for column in ["format_output", "simplification"]:
+        tempdf[column] = tempdf[column].apply(lambda x: ",".join(map(str, x)))
+    tempdf.columns = tempdf.columns.str.replace("_", "-")
+    return json.loads(tempdf.to_json(orient="records"))
 
 
 if __name__ == "__main__":
@@ -16,6 +16,9 @@ parser.add_argument(
 parser.add_argument(
     "-lp", "--localpath", help="Path within bucket", default="temp"
 )
+parser.add_argument(
+    "-y", "--year", help="Year of the dataset", type=int, default=2022
+)
 
 # Parse arguments
 args = parser.parse_args()
@@ -24,7 +27,7 @@ bucket = BUCKET
 path_within_bucket = args.path
 local_path = args.localpath
 
-year = 2022
+year = args.year
 fs = FS
 
 os.makedirs(local_path, exist_ok=True)
@@ -36,7 +39,8 @@ def main(path_within_bucket, localpath, bucket=BUCKET, year=year):
 
     path_combined_files = combine_adminexpress_territory(
         path_within_bucket=path_within_bucket,
-        intermediate_dir=localpath
+        intermediate_dir=localpath,
+        year=year,
     )
 
     path_raw_s3 = create_path_bucket(
@@ -62,7 +66,7 @@ def main(path_within_bucket, localpath, bucket=BUCKET, year=year):
 
     # Retrieve COG metadata
     tagc_metadata = prepare_cog_metadata(
-        path_within_bucket, local_dir=localpath)
+        path_within_bucket, local_dir=localpath, year=year)
     tagc_metadata.drop(columns=["LIBGEO"]).to_csv(f"{localpath}/tagc.csv")
 
     data = {"preprocessed": path_combined_files, "metadata": f"{localpath}/tagc.csv"}
@@ -71,4 +75,4 @@ def main(path_within_bucket, localpath, bucket=BUCKET, year=year):
 
 
 if __name__ == "__main__":
-    main(path_within_bucket, localpath=local_path)
+    main(path_within_bucket, localpath=local_path, year=year)
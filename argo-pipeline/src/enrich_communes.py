@@ -0,0 +1,41 @@
+import argparse
+
+from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET
+from cartiflette.pipeline.enrich_communes import enrich_communes_from_s3
+
+# Initialize ArgumentParser
+parser = argparse.ArgumentParser(
+    description="Enrich the commune layer with the COG metadata, once."
+)
+parser.add_argument(
+    "-p", "--path", help="Path within bucket", default=PATH_WITHIN_BUCKET
+)
+parser.add_argument(
+    "-lp", "--localpath", help="Local working directory", default="temp"
+)
+parser.add_argument(
+    "-y", "--year", help="Year of the dataset", type=int, default=2022
+)
+parser.add_argument(
+    "-s", "--source", help="Source", default="EXPRESS-COG-CARTO-TERRITOIRE"
+)
+
+# Parse arguments
+args = parser.parse_args()
+
+
+def main(path_within_bucket, localpath, year, source, bucket=BUCKET):
+    return enrich_communes_from_s3(
+        {
+            "bucket": bucket,
+            "path_within_bucket": path_within_bucket,
+            "year": year,
+            "source": source,
+            "local_dir": localpath,
+            "metadata_file": f"{localpath}/tagc.csv",
+        }
+    )
+
+
+if __name__ == "__main__":
+    main(args.path, localpath=args.localpath, year=args.year, source=args.source)
@@ -0,0 +1,58 @@
+import argparse
+import json
+import logging
+
+from cartiflette.config import (
+    PATH_WITHIN_BUCKET,
+    GEOPROCESSING_ENGINE,
+    SPLIT_BATCH_MAX_WORKERS,
+)
+from cartiflette.pipeline.split_batch import parse_batch, split_batch_from_s3
+
+
+parser = argparse.ArgumentParser(description="Run a batch of split jobs.")
+logger = logging.getLogger(__name__)
+
+# Define the arguments with their default values
+parser.add_argument(
+    "--path", type=str, default=PATH_WITHIN_BUCKET, help="Path in bucket"
+)
+parser.add_argument(
+    "--batch",
+    type=str,
+    required=True,
+    help="Rows of the batch, as a json list (or @path of a json file)",
+)
+parser.add_argument(
+    "--engine",
+    type=str,
+    default=GEOPROCESSING_ENGINE,
+    choices=["mapshaper", "python"],
+    help="Geoprocessing engine",
+)
+parser.add_argument(
+    "--max_workers",
+    type=int,
+    default=SPLIT_BATCH_MAX_WORKERS,
+    help="Number of processes",
+)
+
+# Parse the arguments
+args = parser.parse_args()
+
+
+def main(batch, path_within_bucket, engine, max_workers):
+    if batch.startswith("@"):
+        with open(batch[1:], encoding="utf8") as f:
+            batch = f.read()
+    configs = [
+        {**config, "path_within_bucket": path_within_bucket, "engine": engine}
+        for config in parse_batch(json.loads(batch))
+    ]
+    logger.info(f"Processing a batch of {len(configs)} splits")
+    split_batch_from_s3(configs, max_workers=max_workers)
+    return configs
+
+
+if __name__ == "__main__":
+    main(args.batch, args.path, args.engine, args.max_workers)
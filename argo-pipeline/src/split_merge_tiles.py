@@ -1,5 +1,5 @@
 import argparse
-from cartiflette.config import PATH_WITHIN_BUCKET
+from cartiflette.config import PATH_WITHIN_BUCKET, GEOPROCESSING_ENGINE
 from cartiflette.pipeline import (
     mapshaperize_split_from_s3,
     mapshaperize_merge_split_from_s3,
@@ -10,12 +10,26 @@ import logging
 parser = argparse.ArgumentParser(description="Process command line arguments.")
 logger = logging.getLogger(__name__)
 
+
+def comma_separated(type_):
+    "Parse a comma separated list of values (a single value is kept as is)"
+
+    def parse(value):
+        values = [type_(x) for x in value.split(",")]
+        return values if len(values) > 1 else values[0]
+
+    return parse
+
+
 # Define the arguments with their default values
 parser.add_argument(
     "--path", type=str, default=PATH_WITHIN_BUCKET, help="Path in bucket"
 )
 parser.add_argument(
-    "--format_output", type=str, default="geojson", help="Output format"
+    "--format_output",
+    type=comma_separated(str),
+    default="geojson",
+    help="Output format(s), comma separated",
 )
 parser.add_argument("--year", type=int, default=2022, help="Year for the data")
 parser.add_argument("--crs", type=int, default=4326, help="Coordinate Reference System")
@@ -23,7 +37,10 @@ parser.add_argument(
     "--source", type=str, default="EXPRESS-COG-CARTO-TERRITOIRE", help="Data source"
 )
 parser.add_argument(
-    "--simplification", type=float, default=0, help="Simplification level"
+    "--simplification",
+    type=comma_separated(float),
+    default=0,
+    help="Simplification level(s), comma separated",
 )
 parser.add_argument(
     "--level_polygons", type=str, default="COMMUNE", help="Level of polygons"
@@ -31,6 +48,13 @@ parser.add_argument(
 parser.add_argument(
     "--filter_by", type=str, default="DEPARTEMENT", help="Splitting criteria"
 )
+parser.add_argument(
+    "--engine",
+    type=str,
+    default=GEOPROCESSING_ENGINE,
+    choices=["mapshaper", "python"],
+    help="Geoprocessing engine",
+)
 
 # Parse the arguments
 args = parser.parse_args()
@@ -45,6 +69,7 @@ args_dict = {
     "simplification": args.simplification,
     "level_polygons": args.level_polygons,
     "filter_by": args.filter_by,
+    "engine": args.engine,
 }
 
 
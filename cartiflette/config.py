@@ -17,8 +17,102 @@ for key in ["token", "secret", "key"]:
         continue
 FS = s3fs.S3FileSystem(client_kwargs={"endpoint_url": ENDPOINT_URL}, **kwargs)
 
+try:
+    CPUS = len(os.sched_getaffinity(0))
+except AttributeError:
+    # os.sched_getaffinity is only available on some Unix platforms
+    CPUS = os.cpu_count() or 1
+# Nota : number of CPUs the process may run on (which can be less than the
+# machine's CPUs, ie in a container), used by default to size the process
+# pools ; CPU quotas (ie kubernetes' limits) are not detected, set the pools'
+# sizes explicitly in that case
+
 THREADS_DOWNLOAD = 5
-# Nota : each thread may also span the same number of children threads;
-# set to 1 for debugging purposes (will deactivate multithreading)
+# Nota : default number of concurrent downloads per host; set to 1 for
+# debugging purposes (will deactivate multithreading)
+
+HOSTS_CONCURRENCY = {
+    "data.geopf.fr": 4,
+    "wxs.ign.fr": 2,
+    "www.insee.fr": 2,
+}
+# Nota : maximum number of concurrent downloads for each provider's host
+
+DOWNLOAD_DISK_BUDGET = 20 * 1024**3
+# Nota : maximum volume (in bytes) of archives being processed at once on
+# local disk during a download pipeline
+
+PROCESSES_LAYERS = min(CPUS, 8)
+# Nota : number of processes used to evaluate the layers of the datasets
+# (GIS reading, CRS checks and territory recognition), spawned once per
+# download run; set to 1 for debugging purposes (will deactivate
+# multiprocessing)
 
 LEAVE_TQDM = False
+
+NESTED_ARCHIVE_SPOOL_SIZE = 50 * 1024 * 1024
+# Nota : nested archives (ie zip in zip) larger than this (in bytes) will be
+# spilled to a temporary file on disk instead of being kept in memory
+
+MD5_REGISTRY_BATCH_SIZE = 50
+# Nota : md5 hash values of downloaded datasets are written to the s3 once
+# this number of updates is pending (and in any case at the end of the run)
+
+MD5_REGISTRY_COMPACTION = 20
+# Nota : the md5 registry's snapshot is rewritten once a run has to read at
+# least this number of per-dataset objects newer than the snapshot
+
+UPLOAD_BATCH_SIZE = 32
+UPLOAD_CHUNKSIZE = 50 * 1024 * 1024
+UPLOAD_MAX_CONCURRENCY = 4
+# Nota : raw files are uploaded to the s3 concurrently, UPLOAD_BATCH_SIZE
+# files at a time ; files larger than UPLOAD_CHUNKSIZE (in bytes) are sent as
+# multipart uploads with UPLOAD_MAX_CONCURRENCY parts sent simultaneously
+
+THREADS_UNPACK = 2
+THREADS_UPLOAD = 4
+PIPELINE_QUEUE_SIZE = 2
+# Nota : downloaded datasets are unpacked (THREADS_UNPACK datasets at a time,
+# each one evaluating it's layers on PROCESSES_LAYERS processes) and uploaded
+# (THREADS_UPLOAD datasets at a time) while other downloads are running ; at
+# most PIPELINE_QUEUE_SIZE datasets are waiting in front of each stage
+
+CACHE_MAX_RESPONSE_SIZE = 10 * 1024 * 1024
+CACHE_EXCLUDED_CONTENT_TYPES = {
+    "application/zip",
+    "application/x-zip-compressed",
+    "application/x-7z-compressed",
+    "application/octet-stream",
+}
+# Nota : responses larger than CACHE_MAX_RESPONSE_SIZE (in bytes) or of one of
+# those content types will not be stored in the http cache (cartiflette.sqlite)
+
+MAPSHAPER_WORKER = True
+MAPSHAPER_WORKERS = 2
+MAPSHAPER_WORKER_CACHE_SIZE = 0
+MAPSHAPER_WORKER_TIMEOUT = 3600
+# Nota : mapshaper commands are run in long-lived Node processes (at most
+# MAPSHAPER_WORKERS per Python process, each one running a command at a time)
+# and are aborted (the Node process being restarted) after
+# MAPSHAPER_WORKER_TIMEOUT seconds ; each Node process can keep up to
+# MAPSHAPER_WORKER_CACHE_SIZE bytes of input files in memory (opt-in, as this
+# volume is multiplied by the number of workers and processes) ; set
+# MAPSHAPER_WORKER to False to use the mapshaper CLI for each command (which
+# is also the fallback if the worker can't be started)
+
+GEOPROCESSING_ENGINE = "mapshaper"
+# Nota : engine used to enrich, dissolve, simplify and split the layers in the
+# pipeline : either "mapshaper" (Node) or "python" (shapely/geopandas,
+# in-process) ; can be overriden by the "engine" key of each job's config
+
+DISSOLVE_PARTITION = "DEPARTEMENT"
+DISSOLVE_MAX_WORKERS = CPUS
+# Nota : levels dissolved from the commune layer are dissolved by
+# DISSOLVE_PARTITION on a pool of DISSOLVE_MAX_WORKERS processes (1 for a
+# serial dissolve), the partial results being merged afterwards along the
+# partitions' shared boundaries
+
+SPLIT_BATCH_MAX_WORKERS = CPUS
+# Nota : a batch of split jobs (argo-pipeline/src/split_batch.py) is run on a
+# pool of SPLIT_BATCH_MAX_WORKERS processes, the input layers shared by
+# several jobs being downloaded once
@@ -6,9 +6,11 @@
 
 from cartiflette.download.pipeline import (
     download_all,
+    plan_download_all,
 )
 
 
 __all__ = [
     "download_all",
+    "plan_download_all",
 ]
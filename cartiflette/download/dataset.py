@@ -2,20 +2,24 @@
 
 from datetime import date
 import fnmatch
-import io
-import json
 import logging
 import os
-import pebble
 import py7zr
 import re
 import s3fs
+import shutil
 import tempfile
 from typing import Tuple
 import zipfile
 
-from cartiflette.utils import import_yaml_config, hash_file, deep_dict_update
-from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET, FS
+from cartiflette.utils import get_sources_catalog, hash_file
+from cartiflette.config import (
+    BUCKET,
+    PATH_WITHIN_BUCKET,
+    FS,
+    NESTED_ARCHIVE_SPOOL_SIZE,
+)
+from cartiflette.download.md5_registry import Md5Registry
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +42,7 @@ class Dataset:
         bucket: str = BUCKET,
         path_within_bucket: str = PATH_WITHIN_BUCKET,
         fs: s3fs.S3FileSystem = FS,
+        registry: Md5Registry = None,
     ):
         """
         Initialize a Dataset object.
@@ -61,6 +66,11 @@ class Dataset:
             path within bucket. The default is PATH_WITHIN_BUCKET.
         fs : s3fs.S3FileSystem, optional
             S3 file system to use. The default is FS.
+        registry : Md5Registry, optional
+            Registry of md5 hash values, meant to be shared among all the
+            Datasets of a pipeline run. The default is None, which will use a
+            registry dedicated to this Dataset (written to the s3 at each
+            update).
 
         """
         if not year:
@@ -70,9 +80,13 @@ class Dataset:
         self.year = year
         self.territory = territory
         self.provider = provider
-        self.config_open_data = import_yaml_config()
+        self.catalog = get_sources_catalog()
+        self.config_open_data = self.catalog.config
         self.json_md5 = f"{bucket}/{path_within_bucket}/md5.json"
         self.fs = fs
+        if registry is None:
+            registry = Md5Registry(bucket, path_within_bucket, fs, batch_size=1)
+        self.registry = registry
 
         self.sources = self.config_open_data[provider][dataset_family][source]
 
@@ -109,61 +123,35 @@ class Dataset:
         """
         return hash_file(file_path)
 
-    @pebble.synchronized
     def _get_last_md5(self) -> None:
         """
-        Read the last md5 hash value of the target on the s3 and store it
-        as an attribute of the Dataset : self.md5
+        Read the last md5 hash value of the target in the registry and store
+        it as an attribute of the Dataset : self.md5
         """
-
-        try:
-            with self.fs.open(self.json_md5, "r") as f:
-                all_md5 = json.load(f)
-        except Exception as e:
-            logger.error(e)
-            logger.error("md5 json not found on MinIO")
-            return
-        try:
-            md5 = all_md5[self.provider][self.dataset_family][self.source][
-                self.territory
-            ][str(self.year)]
+        md5 = self.registry.get(
+            self.provider,
+            self.dataset_family,
+            self.source,
+            self.territory,
+            self.year,
+        )
+        if md5:
             self.md5 = md5
-        except Exception as e:
-            logger.debug(e)
-            logger.debug("file not referenced in md5 json")
 
-    @pebble.synchronized
     def update_json_md5(self, md5: str) -> bool:
         "Mise à jour du json des md5"
-        md5 = {
-            self.provider: {
-                self.dataset_family: {
-                    self.source: {self.territory: {str(self.year): md5}}
-                }
-            }
-        }
-        path_filesystem = self.json_md5
-        json_in_bucket = path_filesystem in self.fs.ls(
-            path_filesystem.rsplit("/", maxsplit=1)[0]
+        return self.registry.update(
+            self.provider,
+            self.dataset_family,
+            self.source,
+            self.territory,
+            self.year,
+            md5,
         )
-        try:
-            if json_in_bucket:
-                with self.fs.open(self.json_md5, "r") as f:
-                    all_md5 = json.load(f)
-                    all_md5 = deep_dict_update(all_md5, md5)
-            else:
-                all_md5 = md5
-            with self.fs.open(self.json_md5, "w") as f:
-                json.dump(all_md5, f)
-            return True
-        except Exception as e:
-            logger.error(e)
-            logger.error("md5 not written")
-            return False
 
     def get_path_from_provider(self) -> str:
         """
-        Get the path to download the file from (based on the yaml content)
+        Get the path to download the file from (based on the sources catalog)
 
         Raises
         ------
@@ -178,96 +166,15 @@ class Dataset:
 
         """
 
-        provider = self.provider
-        dataset_family = self.dataset_family
-        year = self.year
-        source = self.source
-        sources = self.sources
-
-        # print(sources)
-
-        exclude = {"territory", "FTP"}
-        available_years = set(sources.keys()) - exclude
-
-        if year is None:
-            year = max(available_years)
-            msg = (
-                f"year {year} is latest available for {provider} "
-                f"with source {source}"
-            )
-            logger.info(msg)
-
-        if year not in available_years:
-            msg = (
-                f"year {year} not described in YAML for provider {provider} "
-                f"with source {source}"
-            )
-            raise ValueError(msg)
-
-        # Let's scroll the yaml to find first `file` (fixed URL) or
-        # structure` value (url to be formatted with diverse fields)
-        # and pattern
-
-        d = self.config_open_data.copy()
-        for key in provider, dataset_family, source, year:
-            d = d[key]
-            try:
-                self.pattern = d["pattern"]
-                break
-            except KeyError:
-                continue
-
-        d = self.config_open_data.copy()
-        for key in provider, dataset_family, source, year:
-            d = d[key]
-            try:
-                url = d["file"]
-                break
-            except KeyError:
-                continue
-
-        try:
-            url
-        except UnboundLocalError:
-            d = self.config_open_data.copy()
-            for key in provider, dataset_family, source, year:
-                d = d[key]
-                try:
-                    url = d["structure"]
-                    break
-                except KeyError:
-                    continue
-
-            if not url:
-                msg = (
-                    "Neither `file` nor `structure` has been found in the "
-                    f"yaml file for {self}"
-                )
-                raise ValueError(msg)
-
-            if self.territory:
-                try:
-                    territories = sources["territory"]
-                except KeyError:
-                    # No territory
-                    territory = ""
-                else:
-                    try:
-                        territory = territories[self.territory]
-                    except KeyError:
-                        msg = (
-                            f"error on territory : {self.territory} "
-                            f"not in {territories}"
-                        )
-                        raise ValueError(msg)
-
-            kwargs = sources[year].copy()
-            try:
-                kwargs["territory"] = territory
-            except UnboundLocalError:
-                pass
-
-            url = url.format(**kwargs)
+        resolved = self.catalog.resolve(
+            self.provider,
+            self.dataset_family,
+            self.source,
+            self.territory,
+            self.year,
+        )
+        self.pattern = resolved["pattern"]
+        url = resolved["url"]
 
         logger.debug(f"using {url}")
 
@@ -288,14 +195,18 @@ class Dataset:
         """
         self.temp_archive_path = path
 
-    def unpack(self, protocol: str) -> Tuple[str, Tuple[Tuple[str, ...], ...]]:
+    def unpack(
+        self, protocol: str, spool_size: int = NESTED_ARCHIVE_SPOOL_SIZE
+    ) -> Tuple[str, Tuple[Tuple[str, ...], ...]]:
         """
         Decompress a group of files if they validate a pattern and an extension
         type. Returns the path to the folder containing
         the decompressed files. Note that this folder will be stored in the
         temporary cache, but requires manual cleanup.
         If nested archives (ie zip in zip), will unpack all nested data and
-        look for target pattern **INSIDE** the nested archive only
+        look for target pattern **INSIDE** the nested archive only. Nested
+        archives are never fully loaded in memory : those larger than
+        `spool_size` bytes are spilled to a temporary file.
 
         Every file Path
 
@@ -303,6 +214,9 @@ class Dataset:
         ----------
         protocol: str
             Protocol to use for unpacking. Either "7z" or "zip"
+        spool_size: int, optional
+            Maximum size (in bytes) of a nested archive to keep in memory.
+            The default is NESTED_ARCHIVE_SPOOL_SIZE.
 
         Raises
         ------
@@ -358,68 +272,105 @@ class Dataset:
 
             return loader, list_files, extract, targets_kw
 
-        extracted = []
-        archives_to_process = [(self.temp_archive_path, protocol)]
-        while archives_to_process:
-            archive, protocol = archives_to_process.pop()
-            loader, list_files, extract, targets_kw = get_utils_from_protocol(protocol)
-            with loader(archive, mode="r") as archive:
-                everything = getattr(archive, list_files)()
-
-                # Handle nested archives (and presume there is no mixup in
-                # formats...)
-                archives = [
-                    x for x in everything if x.endswith(".zip") or x.endswith(".7z")
-                ]
-                archives = [(x, x.split(".")[-1]) for x in archives]
-                for nested_archive, protocol in archives:
-                    with archive.open(nested_archive) as nested:
-                        archives_to_process.append(
-                            (io.BytesIO(nested.read()), protocol)
-                        )
+        def spool_nested_archive(archive, nested_archive: str, workdir: str):
+            # Copy a nested archive by chunks, either to a spooled buffer
+            # (zip, which allows streaming) or straight to disk (7z, which
+            # only allows extraction) to keep memory usage bounded
+            if isinstance(archive, zipfile.ZipFile):
+                spool = tempfile.SpooledTemporaryFile(
+                    max_size=spool_size, dir=workdir
+                )
+                with archive.open(nested_archive) as nested:
+                    shutil.copyfileobj(nested, spool, 1024 * 1024)
+                spool.seek(0)
+                return spool
 
-                files = filter_case_insensitive(self.pattern, everything)
+            archive.extract(path=workdir, targets=[nested_archive])
+            archive.reset()
+            return os.path.join(workdir, nested_archive)
 
-                if year <= 2020 and source.endswith("-TERRITOIRE"):
-                    territory_code = sources["territory"][territory].split("_")[0]
-                    files = {x for x in files if territory_code in x}
+        extracted = []
+        archives_to_process = [(self.temp_archive_path, protocol)]
+        spools = []
+        workdir = tempfile.mkdtemp()
+        try:
+            while archives_to_process:
+                archive, protocol = archives_to_process.pop()
+                loader, list_files, extract, targets_kw = get_utils_from_protocol(
+                    protocol
+                )
+                with loader(archive, mode="r") as archive:
+                    everything = getattr(archive, list_files)()
 
-                # Find all auxiliary files sharing the same name as those found
-                # (needed for shapefiles)
-                if any(x.lower().endswith(".shp") for x in files):
-                    shapefiles_pattern = {
-                        os.path.splitext(x)[0]
-                        for x in files
-                        if x.lower().endswith(".shp")
+                    # Handle nested archives (and presume there is no mixup in
+                    # formats...)
+                    archives = [
+                        x
+                        for x in everything
+                        if x.endswith(".zip") or x.endswith(".7z")
+                    ]
+                    archives = [(x, x.split(".")[-1]) for x in archives]
+                    for nested_archive, protocol in archives:
+                        nested = spool_nested_archive(
+                            archive, nested_archive, workdir
+                        )
+                        if not isinstance(nested, str):
+                            spools.append(nested)
+                        archives_to_process.append((nested, protocol))
+
+                    files = filter_case_insensitive(self.pattern, everything)
+
+                    if year <= 2020 and source.endswith("-TERRITOIRE"):
+                        territory_code = sources["territory"][territory].split(
+                            "_"
+                        )[0]
+                        files = {x for x in files if territory_code in x}
+
+                    # Find all auxiliary files sharing the same name as those
+                    # found (needed for shapefiles)
+                    if any(x.lower().endswith(".shp") for x in files):
+                        shapefiles_pattern = {
+                            os.path.splitext(x)[0]
+                            for x in files
+                            if x.lower().endswith(".shp")
+                        }
+                    else:
+                        shapefiles_pattern = set()
+
+                    logger.debug(shapefiles_pattern)
+
+                    if shapefiles_pattern:
+                        targets = [
+                            x
+                            for x in getattr(archive, list_files)()
+                            if os.path.splitext(x)[0] in shapefiles_pattern
+                        ]
+                    else:
+                        targets = files
+
+                    logger.debug(targets)
+                    logger.debug(len(targets))
+
+                    # Nota : in any case, extract all other files (for
+                    # territory detection even if shapefile is not the target,
+                    # for example when using dbf) -> return only target but
+                    # extract all
+                    patterns = {x.rsplit(".", maxsplit=1)[0] for x in targets}
+                    real_extracts = {
+                        x
+                        for x in everything
+                        if x.rsplit(".", maxsplit=1)[0] in patterns
                     }
-                else:
-                    shapefiles_pattern = set()
 
-                logger.debug(shapefiles_pattern)
-
-                if shapefiles_pattern:
-                    targets = [
-                        x
-                        for x in getattr(archive, list_files)()
-                        if os.path.splitext(x)[0] in shapefiles_pattern
+                    kwargs = {"path": location, targets_kw: real_extracts}
+                    getattr(archive, extract)(**kwargs)
+                    extracted += [
+                        os.path.join(location, target) for target in targets
                     ]
-                else:
-                    targets = files
-
-                logger.debug(targets)
-                logger.debug(len(targets))
-
-                # Nota : in any case, extract all other files (for territory
-                # detection even if shapefile is not the target, for example
-                # when using dbf) -> return only target but extract all
-                patterns = {x.rsplit(".", maxsplit=1)[0] for x in targets}
-                real_extracts = {
-                    x for x in everything if x.rsplit(".", maxsplit=1)[0] in patterns
-                }
-
-                kwargs = {"path": location, targets_kw: real_extracts}
-                getattr(archive, extract)(**kwargs)
-                extracted += [os.path.join(location, target) for target in targets]
+        finally:
+            for spool in spools:
+                spool.close()
+            shutil.rmtree(workdir, ignore_errors=True)
 
         # self._list_levels(extracted)
 
@@ -8,19 +8,37 @@
 from collections import OrderedDict
 from itertools import product
 import logging
+import os
 from pebble import ThreadPool
 import s3fs
 import shutil
 import traceback
-from typing import Union
-
-from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET, FS, THREADS_DOWNLOAD
+from typing import Dict, Tuple, Union
+
+from cartiflette.config import (
+    BUCKET,
+    PATH_WITHIN_BUCKET,
+    FS,
+    DOWNLOAD_DISK_BUDGET,
+    THREADS_DOWNLOAD,
+    THREADS_UNPACK,
+    THREADS_UPLOAD,
+    UPLOAD_BATCH_SIZE,
+    UPLOAD_CHUNKSIZE,
+    UPLOAD_MAX_CONCURRENCY,
+)
 from cartiflette.utils import (
     deep_dict_update,
     create_path_bucket,
+    compile_sources_index,
+    is_described,
 )
-from cartiflette.download.scraper import MasterScraper
+from cartiflette.download.scraper import MasterScraper, layers_pool
 from cartiflette.download.dataset import Dataset
+from cartiflette.download.md5_registry import Md5Registry
+from cartiflette.download.raw_store import RawStore
+from cartiflette.download.report import RunReport, measure
+from cartiflette.download.scheduler import DownloadScheduler, StagedPipeline
 
 logger = logging.getLogger(__name__)
 
@@ -31,12 +49,15 @@ def _upload_raw_dataset_to_s3(
     bucket: str = BUCKET,
     path_within_bucket: str = PATH_WITHIN_BUCKET,
     fs: s3fs.S3FileSystem = FS,
+    store: RawStore = None,
 ) -> dict:
     """
-    Upload a dataset's layers' objects into s3. In case of success, will also
-    update the JSON md5 at the root of the filesystem and return a dict maping
-    layers to the uploaded files (only the main file if this is a shapefile
-    layer). Will perform a cleanup of the temporary folder whatever the result.
+    Upload a dataset's layers' objects into s3 (through the content-addressed
+    RawStore, each file's content being uploaded only once). In case of
+    success, will also register the md5 of the dataset in the registry and
+    return a dict maping layers to the uploaded files (only the main file if
+    this is a shapefile layer). Will perform a cleanup of the temporary folder
+    whatever the result.
 
     Parameters
     ----------
@@ -50,6 +71,9 @@ def _upload_raw_dataset_to_s3(
         path within bucket. The default is PATH_WITHIN_BUCKET.
     fs : s3fs.S3FileSystem, optional
         S3 file system to use. The default is FS.
+    store : RawStore, optional
+        Store of the raw files, meant to be shared among all uploads of a
+        pipeline run. The default is None, which will use a new RawStore.
 
     Returns
     -------
@@ -81,6 +105,7 @@ def _upload_raw_dataset_to_s3(
         # DUPLICATE SOURCES IN BUCKET
         errors_encountered = False
         dataset_paths = dict()
+        files = dict()
         for key, layer in result["layers"].items():
             layer_paths = []
             for path, rename_basename in layer.files_to_upload.items():
@@ -104,20 +129,26 @@ def _upload_raw_dataset_to_s3(
                 )
 
                 layer_paths.append(path_within)
+                files[path] = path_within
 
                 logger.debug(f"upload to {path_within}")
 
-                try:
-                    fs.put(path, path_within, recursive=True)
-                except Exception as e:
-                    logger.error(e)
-                    errors_encountered = True
-
             if any(x.lower().endswith(".shp") for x in layer_paths):
                 layer_paths = [x for x in layer_paths if x.lower().endswith(".shp")]
 
             dataset_paths[key] = layer_paths
 
+        # Upload all new files at once (concurrently, using multipart uploads
+        # for large files)
+        if store is None:
+            store = RawStore(bucket, path_within_bucket, fs)
+        store.put(
+            files,
+            batch_size=UPLOAD_BATCH_SIZE,
+            chunksize=UPLOAD_CHUNKSIZE,
+            max_concurrency=UPLOAD_MAX_CONCURRENCY,
+        )
+
     except Exception as e:
         logger.error(e)
         errors_encountered = True
@@ -127,7 +158,7 @@ def _upload_raw_dataset_to_s3(
         shutil.rmtree(result["root_cleanup"])
 
     if not errors_encountered:
-        # NOW WRITE MD5 IN BUCKET ROOT (in case of error, should be skipped
+        # NOW REGISTER MD5 (in case of error, should be skipped
         # to allow for further tentatives)
         dataset.update_json_md5(result["hash"])
         return dataset_paths
@@ -216,6 +247,38 @@ def _download_sources(
                 }
             }
     """
+    combinations = _expand_combinations(
+        providers, dataset_families, sources, territories, years
+    )
+    return _download_combinations(
+        combinations, bucket, path_within_bucket, fs, upload
+    )
+
+
+def _expand_combinations(
+    providers: Union[list[str, ...], str],
+    dataset_families: Union[list[str, ...], str],
+    sources: Union[list[str, ...], str],
+    territories: Union[list[str, ...], str],
+    years: Union[list[str, ...], str],
+    index: dict = None,
+) -> list[tuple]:
+    """
+    Compute all combinations of the given arguments, pruning those which are
+    not described in the yaml file (without instanciating any Dataset).
+
+    Parameters
+    ----------
+    index : dict, optional
+        Index of the yaml file, as computed by compile_sources_index. The
+        default is None, which will compile it from the yaml file.
+
+    Returns
+    -------
+    list[tuple]
+        List of (source, territory, year, provider, dataset_family) tuples
+
+    """
     kwargs = OrderedDict()
     items = [
         ("sources", sources),
@@ -232,13 +295,55 @@ def _download_sources(
         elif isinstance(val, list) or isinstance(val, tuple) or isinstance(val, set):
             kwargs[key] = list(val)
 
+    if index is None:
+        index = compile_sources_index()
+
     combinations = list(product(*kwargs.values()))
+    valid = [
+        (source, territory, year, provider, dataset_family)
+        for source, territory, year, provider, dataset_family in combinations
+        if is_described(index, provider, dataset_family, source, territory, year)
+    ]
+    logger.debug(
+        f"{len(combinations) - len(valid)} combinations not described in yaml"
+    )
+    return valid
 
-    files = {}
-    with MasterScraper() as s:
 
-        def func(args):
-            source, territory, year, provider, dataset_family = args
+def _prepare_datasets(
+    combinations: list[tuple],
+    bucket: str = BUCKET,
+    path_within_bucket: str = PATH_WITHIN_BUCKET,
+    fs: s3fs.S3FileSystem = FS,
+    registry: Md5Registry = None,
+) -> Tuple[list[tuple], Dict[tuple, Dataset], list[Tuple[tuple, str]]]:
+    """
+    Instanciate the Dataset of each combination and resolve it's url.
+
+    Parameters
+    ----------
+    combinations : list[tuple]
+        List of (source, territory, year, provider, dataset_family) tuples
+    bucket : str, optional
+        Bucket to use. The default is BUCKET.
+    path_within_bucket : str, optional
+        path within bucket. The default is PATH_WITHIN_BUCKET.
+    fs : s3fs.S3FileSystem, optional
+        S3 file system to use. The default is FS.
+    registry : Md5Registry, optional
+        Registry shared by all Datasets. The default is None.
+
+    Returns
+    -------
+    Tuple[list[tuple], Dict[tuple, Dataset], list[Tuple[tuple, str]]]
+        Combinations which are not described in the yaml, Dataset of each
+        valid combination and the (combination, url) jobs to download.
+
+    """
+
+    def prepare(args):
+        source, territory, year, provider, dataset_family = args
+        try:
             datafile = Dataset(
                 dataset_family,
                 source,
@@ -247,60 +352,358 @@ def _download_sources(
                 territory,
                 bucket,
                 path_within_bucket,
+                fs,
+                registry=registry,
             )
+            url = datafile.get_path_from_provider()
+        except ValueError as e:
+            logger.warning(e)
+            return args, None, None
+        except Exception as e:
+            logger.error(e)
+            logger.error(traceback.format_exc())
+            return None
+        return args, datafile, url
+
+    if THREADS_DOWNLOAD > 1:
+        with ThreadPool(THREADS_DOWNLOAD) as pool:
+            futures = [
+                pool.schedule(prepare, args=(args,)) for args in combinations
+            ]
+            prepared = [future.result() for future in futures]
+    else:
+        prepared = [prepare(args) for args in combinations]
+
+    undescribed = []
+    datafiles = {}
+    jobs = []
+    for args, datafile, url in filter(None, prepared):
+        if datafile is None:
+            undescribed.append(args)
+        else:
+            datafiles[args] = datafile
+            jobs.append((args, url))
+    return undescribed, datafiles, jobs
+
+
+def _share_archive(downloaded: tuple, n: int) -> list[tuple]:
+    """
+    Share a downloaded archive (as returned by MasterScraper.download_archive)
+    among n combinations : each one gets it's own hard link to the archive
+    (or copy, if hard links are not supported), as it will be removed after
+    unpacking.
+    """
+    if not downloaded or not downloaded[0] or n == 1:
+        return [downloaded] * n
+
+    _, filetype, path = downloaded
+    shared = [downloaded]
+    for k in range(1, n):
+        other_path = f"{path}.{k}"
+        try:
+            os.link(path, other_path)
+        except OSError:
+            shutil.copyfile(path, other_path)
+        shared.append((True, filetype, other_path))
+    return shared
+
+
+def _download_combinations(
+    combinations: list[tuple],
+    bucket: str = BUCKET,
+    path_within_bucket: str = PATH_WITHIN_BUCKET,
+    fs: s3fs.S3FileSystem = FS,
+    upload: bool = True,
+    report: RunReport = None,
+) -> dict:
+    """
+    Perform the downloads of the datasets described by each combination and
+    store them on the s3, using a single DownloadScheduler for all of them
+    (each downloaded dataset being then unpacked and uploaded through the
+    following stages of a StagedPipeline while other downloads are running)
+    and a single Md5Registry (which is read once and written at the end of
+    the run). Combinations sharing the same url are downloaded only once and
+    files already present in the RawStore are not uploaded again. See
+    _download_sources for a complete description of the arguments and
+    results.
+
+    Parameters
+    ----------
+    combinations : list[tuple]
+        List of (source, territory, year, provider, dataset_family) tuples
+    bucket : str, optional
+        Bucket to use. The default is BUCKET.
+    path_within_bucket : str, optional
+        path within bucket. The default is PATH_WITHIN_BUCKET.
+    fs : s3fs.S3FileSystem, optional
+        S3 file system to use. The default is FS.
+    upload : bool, optional
+        Use for debugging: whether to store the files into the s3 or not.
+        The default is True.
+    report : RunReport, optional
+        Report in which the timings of each stage will be stored. The default
+        is None.
+
+    Returns
+    -------
+    dict
+        Nested dict of results (datasets which failed to be unpacked or
+        stored being described with an "error" key)
+
+    """
+
+    def not_downloaded(args, error=None):
+        source, territory, year, provider, dataset_family = args
+        result = {"downloaded": False, "paths": None}
+        if error:
+            # failure while unpacking or storing the dataset
+            result["error"] = error
+        return {provider: {dataset_family: {source: {territory: {year: result}}}}}
+
+    registry = Md5Registry(bucket, path_within_bucket, fs)
+    undescribed, datafiles, jobs = _prepare_datasets(
+        combinations, bucket, path_within_bucket, fs, registry
+    )
+
+    files = {}
+    for args in undescribed:
+        files = deep_dict_update(files, not_downloaded(args))
+
+    # Combinations sharing the same url (ie several vintages pointing to the
+    # same file) are downloaded only once
+    by_url = dict()
+    for args, url in jobs:
+        by_url.setdefault(url, []).append(args)
+
+    raw_store = RawStore(bucket, path_within_bucket, fs)
+
+    # The layers' pool is opened before any download/unpack thread starts
+    with layers_pool() as pool, MasterScraper() as s, registry:
+
+        # Each item carries the BudgetTicket of it's archive, released once
+        # the item leaves the pipeline (whether it succeeded or not) : the
+        # archive is counted in the disk budget while it is queued, unpacked
+        # and uploaded
+        def unpack(args, value):
+            downloaded, ticket = value
             try:
-                result = s.download_unpack(datafile)
-            except ValueError as e:
-                logger.warning(e)
-
-                this_result = {
-                    provider: {
-                        dataset_family: {
-                            source: {
-                                territory: {
-                                    year: {
-                                        "downloaded": False,
-                                        "paths": None,
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
+                if downloaded is None:
+                    return None, ticket
+                try:
+                    result = s.unpack_layers(
+                        datafiles[args], *downloaded, pool=pool, report=report
+                    )
+                except ValueError as e:
+                    logger.warning(e)
+                    result = None
+            except Exception:
+                ticket.release()
+                raise
+            return result, ticket
+
+        def store(args, value):
+            result, ticket = value
+            try:
+                return _store(args, result)
+            finally:
+                ticket.release()
 
-            else:
-                if upload:
+        def _store(args, result):
+            source, territory, year, provider, dataset_family = args
+            if result is None:
+                return not_downloaded(args)
+
+            if upload:
+                dataset = str(datafiles[args])
+                with measure(report, "upload", dataset=dataset) as event:
+                    event["bytes"] = sum(
+                        os.path.getsize(path)
+                        for layer in (result["layers"] or {}).values()
+                        for path in layer.files_to_upload
+                    )
                     paths = _upload_raw_dataset_to_s3(
-                        datafile, result, bucket, path_within_bucket, fs
+                        datafiles[args],
+                        result,
+                        bucket,
+                        path_within_bucket,
+                        fs,
+                        raw_store,
                     )
-                else:
-                    paths = {}
-                    # cleanup temp files
-                    if result["root_cleanup"]:
-                        shutil.rmtree(result["root_cleanup"])
+            else:
+                paths = {}
+                # cleanup temp files
+                if result["root_cleanup"]:
+                    shutil.rmtree(result["root_cleanup"])
+
+            del result["hash"], result["root_cleanup"], result["layers"]
+            result["paths"] = paths
+
+            return {provider: {dataset_family: {source: {territory: {year: result}}}}}
+
+        # Downloads are handled by the scheduler, unpacking and uploads by
+        # the following stages of the pipeline
+        stages = [(unpack, THREADS_UNPACK), (store, THREADS_UPLOAD)]
+        scheduler = DownloadScheduler(s)
+        with StagedPipeline(stages, sequential=THREADS_DOWNLOAD <= 1) as pipeline:
+
+            def download(url, ticket):
+                members = by_url[url]
+                host = scheduler.get_host(url)
+                with measure(report, "download", host=host, url=url) as event:
+                    try:
+                        downloaded = s.download_archive(datafiles[members[0]])
+                    except ValueError as e:
+                        logger.warning(e)
+                        downloaded = None
+                    if downloaded and downloaded[0]:
+                        event["bytes"] = os.path.getsize(downloaded[2])
+                # Blocks while the unpacking stage is busy
+                shared = _share_archive(downloaded, len(members))
+                for args, this_downloaded in zip(members, shared):
+                    ticket.add_holder()
+                    pipeline.put(args, (this_downloaded, ticket))
+
+            # Each combination sharing an archive gets it's own copy (hard
+            # link) and unpacks it : every copy is counted in the budget
+            jobs = [(url, url) for url in by_url]
+            copies = {url: len(members) for url, members in by_url.items()}
+            for _ in scheduler.run(jobs, download, hold=True, copies=copies):
+                pass
+
+        for args, stage, e in pipeline.failures:
+            files = deep_dict_update(files, not_downloaded(args, error=repr(e)))
+        for args, this_result in pipeline.results:
+            files = deep_dict_update(files, this_result)
+
+    return files
 
-                del result["hash"], result["root_cleanup"], result["layers"]
-                result["paths"] = paths
 
-                this_result = {
-                    provider: {dataset_family: {source: {territory: {year: result}}}}
-                }
+def _plan_combinations(
+    combinations: list[tuple],
+    bucket: str = BUCKET,
+    path_within_bucket: str = PATH_WITHIN_BUCKET,
+    fs: s3fs.S3FileSystem = FS,
+) -> dict:
+    """
+    Evaluate what a synchronization of the datasets described by each
+    combination would download, without downloading anything : each url is
+    checked (once) through a (fresh) HEAD request and compared to the md5
+    registry. Every available dataset is downloaded by a synchronization, the status
+    telling whether it's content is expected to change.
+
+    Each dataset gets one of the following status :
+        - "new" : not referenced in the registry
+        - "changed" : the md5 announced by the provider differs from the
+          registered one
+        - "unchanged" : the md5 announced by the provider matches the
+          registered one
+        - "unknown" : no md5 announced by the provider, the file will be
+          compared after it's download
+        - "unavailable" : the HEAD request failed (no download)
 
-            return this_result
+    Parameters
+    ----------
+    combinations : list[tuple]
+        List of (source, territory, year, provider, dataset_family) tuples
+    bucket : str, optional
+        Bucket to use. The default is BUCKET.
+    path_within_bucket : str, optional
+        path within bucket. The default is PATH_WITHIN_BUCKET.
+    fs : s3fs.S3FileSystem, optional
+        S3 file system to use. The default is FS.
 
-        if THREADS_DOWNLOAD > 1:
-            with ThreadPool(THREADS_DOWNLOAD) as pool:
-                iterator = pool.map(func, combinations).result()
-                while True:
-                    try:
-                        files = deep_dict_update(files, next(iterator))
-                    except StopIteration:
-                        break
-                    except Exception as e:
-                        logger.error(e)
-                        logger.error(traceback.format_exc())
-        else:
-            for args in combinations:
-                files = deep_dict_update(files, func(args))
+    Returns
+    -------
+    dict
+        Plan of the synchronization, of the following form :
+            {
+                "datasets": list of dict (one per dataset, largest first)
+                    with keys provider, dataset_family, source, territory,
+                    year, url, status and size (in bytes, None if unknown),
+                "to_download": number of datasets to download,
+                "downloads": number of urls to download (datasets sharing
+                    an url being downloaded once),
+                "changed": number of datasets whose content may have changed
+                    (new, changed or unknown status),
+                "unknown_sizes": number of datasets to download with unknown
+                    size,
+                "transfer_bytes": volume to download (in bytes, each url
+                    counted once),
+                "disk_bytes": estimated peak volume of archives held on disk
+                    (in bytes, given DOWNLOAD_DISK_BUDGET, each dataset
+                    sharing an url holding it's own copy)
+            }
 
-    return files
+    """
+    registry = Md5Registry(bucket, path_within_bucket, fs)
+    _, datafiles, jobs = _prepare_datasets(
+        combinations, bucket, path_within_bucket, fs, registry
+    )
+
+    # Combinations sharing the same url are downloaded only once (see
+    # _download_combinations) : one HEAD request per url
+    by_url = dict()
+    for args, url in jobs:
+        by_url.setdefault(url, []).append(args)
+
+    datasets = []
+    sizes = {}
+    with MasterScraper() as s:
+        scheduler = DownloadScheduler(s)
+        jobs = [(url, url) for url in by_url]
+        for url, r in scheduler.head(jobs, force_refresh=True):
+            size = expected_md5 = None
+            if r is not None and r.ok:
+                try:
+                    size = int(r.headers["Content-length"])
+                except (KeyError, ValueError):
+                    pass
+                expected_md5 = r.headers.get("content-md5")
+                sizes[url] = size
+
+            for args in by_url[url]:
+                source, territory, year, provider, dataset_family = args
+                datafile = datafiles[args]
+                if r is None or not r.ok:
+                    status = "unavailable"
+                elif not datafile.md5:
+                    status = "new"
+                elif not expected_md5:
+                    status = "unknown"
+                elif expected_md5 == datafile.md5:
+                    status = "unchanged"
+                else:
+                    status = "changed"
+
+                datasets.append(
+                    {
+                        "provider": provider,
+                        "dataset_family": dataset_family,
+                        "source": source,
+                        "territory": territory,
+                        "year": year,
+                        "url": url,
+                        "status": status,
+                        "size": size,
+                    }
+                )
+
+    datasets.sort(key=lambda x: x["size"] or 0, reverse=True)
+    to_download = [x for x in datasets if x["status"] != "unavailable"]
+    changed = [x for x in datasets if x["status"] in {"new", "changed", "unknown"}]
+
+    # Each url is transfered once, but every combination sharing it unpacks
+    # it's own copy, each copy being counted in the disk budget
+    transfer_bytes = sum(size or 0 for size in sizes.values())
+    held = [(size or 0) * len(by_url[url]) for url, size in sizes.items()]
+    disk_bytes = min(sum(held), max(DOWNLOAD_DISK_BUDGET, max(held, default=0)))
+
+    return {
+        "datasets": datasets,
+        "to_download": len(to_download),
+        "downloads": len(sizes),
+        "changed": len(changed),
+        "unknown_sizes": sum(x["size"] is None for x in to_download),
+        "transfer_bytes": transfer_bytes,
+        "disk_bytes": disk_bytes,
+    }
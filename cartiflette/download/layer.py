@@ -1,17 +1,49 @@
 # -*- coding: utf-8 -*-
 from charset_normalizer import from_bytes, is_binary
-import fiona
 import geopandas as gpd
 import logging
 import os
+import pyogrio
+from pyproj import CRS
 from shapely.geometry import box
+from typing import NamedTuple
 
 from cartiflette.download.dataset import Dataset
+from cartiflette.utils import transcode_dbf
 from cartiflette.constants import REFERENCES
 
 logger = logging.getLogger(__name__)
 
 
+class DatasetDescription(NamedTuple):
+    """
+    Picklable description of a Dataset, holding only what a Layer needs
+    (the Dataset itself holds it's sources catalog, md5 registry and file
+    system, which should not be sent to worker processes).
+    """
+
+    dataset_family: str
+    source: str
+    year: int
+    territory: str
+    provider: str
+    name: str
+
+    @classmethod
+    def from_dataset(cls, dataset: Dataset) -> "DatasetDescription":
+        return cls(
+            dataset.dataset_family,
+            dataset.source,
+            dataset.year,
+            dataset.territory,
+            dataset.provider,
+            str(dataset),
+        )
+
+    def __str__(self):
+        return self.name
+
+
 class Layer:
     def __init__(self, dataset: Dataset, cluster_name: str, files: dict):
         """
@@ -27,7 +59,7 @@ class Layer:
         Parameters
         ----------
         dataset : Dataset
-            Dataset containing layers
+            Dataset containing layers (or it's DatasetDescription)
         cluster_name : str
             Unique name for a layer (computed by the scraper after data
             unpacking) and corresponding to the minimum recursive distinct path
@@ -69,16 +101,21 @@ class Layer:
             # assume there is only one file
             self.format = list(self.files_to_upload)[0].split(".")[-1]
 
-    def _get_encoding(self):
-        ref_cpg_file = [x for x in self.files if x.lower().split(".")[-1] == "cpg"]
+    def _get_file_by_extension(self, extension: str) -> str:
+        files = [x for x in self.files if x.lower().split(".")[-1] == extension]
         try:
-            ref_cpg_file = ref_cpg_file[0]
+            return files[0]
         except IndexError:
             return None
+
+    def _get_encoding(self):
+        ref_cpg_file = self._get_file_by_extension("cpg")
+        if not ref_cpg_file:
+            return None
         with open(ref_cpg_file, "r") as f:
             encoding = f.read()
 
-        return encoding.lower()
+        return encoding.strip().lower()
 
     def _get_gis_file(self):
         ref_gis_file = [x for x in self.files if x.lower().split(".")[-1] == "shp"]
@@ -90,14 +127,45 @@ class Layer:
 
         return ref_gis_file
 
+    def _probe_gis_file(self, ref_gis_file: str, **kwargs) -> tuple:
+        """
+        Read only the metadata of a GIS file (header, projection and extent),
+        without loading any geometry.
+
+        Parameters
+        ----------
+        ref_gis_file : str
+            Path to the GIS file
+        **kwargs :
+            Optional arguments passed to pyogrio.read_info (encoding, ...)
+
+        Returns
+        -------
+        tuple
+            crs : pyproj.CRS (or None if the file has no projection)
+            bounds : tuple of (xmin, ymin, xmax, ymax) or None
+
+        """
+        info = pyogrio.read_info(ref_gis_file, force_total_bounds=True, **kwargs)
+        if not info["crs"]:
+            return None, None
+        return CRS.from_user_input(info["crs"]), info["total_bounds"]
+
     def _gis_and_encoding_evaluation(self):
         encoding = self._get_encoding()
         kwargs = {"encoding": encoding} if encoding else {}
         ref_gis_file = self._get_gis_file()
         try:
-            # Note : read all rows to evaluate bbox / territory
-            gdf = gpd.read_file(ref_gis_file, **kwargs)
-            self.crs = gdf.crs.to_epsg()
+            # Note : only probe metadata to evaluate projection and bbox /
+            # territory ; geometries are loaded only if the layer has to be
+            # rewritten
+            crs, bounds = self._probe_gis_file(ref_gis_file, **kwargs)
+        except (pyogrio.errors.DataSourceError, pyogrio.errors.DataLayerError):
+            # Non-native-GIS dataset
+            crs = None
+
+        if crs:
+            self.crs = crs.to_epsg()
 
             if not self.crs:
                 logger.warning(
@@ -106,26 +174,32 @@ class Layer:
                 )
 
                 # Let's reproject...
+                gdf = gpd.read_file(ref_gis_file, **kwargs)
                 gdf = gdf.to_crs(4326)
+                crs = gdf.crs
+                bounds = gdf.total_bounds
                 self.crs = 4326
 
                 # let's overwrite initial files
                 gdf.to_file(ref_gis_file, encoding="utf-8")
 
-            elif encoding and encoding != "utf-8":
+            elif encoding and encoding not in {"utf-8", "utf8"}:
                 logger.warning(
                     f"{self} - encoding={encoding}, " "layer will be re-encoded to UTF8"
                 )
-                # let's overwrite initial files with utf8...
-                gdf.to_file(ref_gis_file, encoding="utf-8")
-
-        except (AttributeError, fiona.errors.DriverError):
-            # Non-native-GIS dataset
+                # let's overwrite initial attributes with utf8 (geometries are
+                # left untouched)
+                transcode_dbf(
+                    self._get_file_by_extension("dbf"),
+                    encoding,
+                    cpg_path=self._get_file_by_extension("cpg"),
+                )
+        else:
             self.crs = None
 
         if self.crs:
-            bbox = box(*gdf.total_bounds)
-            bbox = gpd.GeoSeries([bbox], crs=gdf.crs)
+            bbox = box(*bounds)
+            bbox = gpd.GeoSeries([bbox], crs=crs)
 
             intersects = REFERENCES.sjoin(
                 bbox.to_frame().to_crs(REFERENCES.crs),
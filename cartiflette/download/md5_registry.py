@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import s3fs
+import threading
+
+from cartiflette.config import (
+    BUCKET,
+    PATH_WITHIN_BUCKET,
+    FS,
+    MD5_REGISTRY_BATCH_SIZE,
+    MD5_REGISTRY_COMPACTION,
+)
+from cartiflette.utils import deep_dict_update
+
+logger = logging.getLogger(__name__)
+
+
+class Md5Registry:
+    """
+    In-memory registry of the md5 hash values of the raw sources, shared
+    among all Datasets of a pipeline run.
+
+    On the s3, each dataset's hash is stored in it's own small object
+    ({path_within_bucket}/md5/{provider}/{dataset_family}/{source}/
+    {territory}/{year}.json) : each write is a single atomic PUT touching
+    only that dataset, so that concurrent pods never overwrite each other's
+    updates. The legacy md5.json (if any) is still read as a baseline, but
+    never written.
+    The registry is read once (at first lookup) and updates are batched.
+
+    To keep the reads bounded, the per-dataset objects are periodically
+    compacted into a snapshot ({path_within_bucket}/md5_snapshot.json),
+    which records the version (ETag) of each object it includes : a run
+    reads the snapshot, lists the objects (a single LIST request per 1000
+    objects) and only fetches those newer than the snapshot. Once there are
+    at least `compaction` of them, the snapshot is rewritten (a single PUT,
+    objects written concurrently by other pods being caught up by the next
+    run).
+    """
+
+    def __init__(
+        self,
+        bucket: str = BUCKET,
+        path_within_bucket: str = PATH_WITHIN_BUCKET,
+        fs: s3fs.S3FileSystem = FS,
+        batch_size: int = MD5_REGISTRY_BATCH_SIZE,
+        compaction: int = MD5_REGISTRY_COMPACTION,
+    ):
+        """
+        Initialize the registry (lazily : nothing is read from the s3 until
+        the first lookup).
+
+        Parameters
+        ----------
+        bucket : str, optional
+            Bucket to use. The default is BUCKET.
+        path_within_bucket : str, optional
+            path within bucket. The default is PATH_WITHIN_BUCKET.
+        fs : s3fs.S3FileSystem, optional
+            S3 file system to use. The default is FS.
+        batch_size : int, optional
+            Number of updates to keep in memory before writing them to the
+            s3. The default is MD5_REGISTRY_BATCH_SIZE.
+        compaction : int, optional
+            Number of objects newer than the snapshot triggering it's
+            rewriting when read. The default is MD5_REGISTRY_COMPACTION.
+
+        """
+        self.json_md5 = f"{bucket}/{path_within_bucket}/md5.json"
+        self.shards_dir = f"{bucket}/{path_within_bucket}/md5"
+        self.snapshot = f"{bucket}/{path_within_bucket}/md5_snapshot.json"
+        self.fs = fs
+        self.batch_size = batch_size
+        self.compaction = compaction
+        self._md5 = None
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _keys(
+        provider: str,
+        dataset_family: str,
+        source: str,
+        territory: str,
+        year: int,
+    ) -> tuple:
+        # Mimic keys as they are stored in json
+        territory = json.loads(json.dumps({territory: None})).popitem()[0]
+        return provider, dataset_family, source, territory, str(year)
+
+    @staticmethod
+    def _nest(keys: tuple, value) -> dict:
+        for key in reversed(keys):
+            value = {key: value}
+        return value
+
+    def _shard_path(self, keys: tuple) -> str:
+        *dirs, year = keys
+        return "/".join([self.shards_dir, *dirs, f"{year}.json"])
+
+    @staticmethod
+    def _version(info: dict) -> str:
+        # Version of an object, as listed by the file system (None if
+        # unknown : the object is then always read)
+        for key in ("ETag", "LastModified", "mtime", "created"):
+            if info.get(key) is not None:
+                return str(info[key])
+        return None
+
+    def _read_baseline(self) -> tuple:
+        # Read the snapshot (or the legacy md5.json, which it supersedes)
+        try:
+            with self.fs.open(self.snapshot, "r") as f:
+                snapshot = json.load(f)
+            return snapshot["md5"], snapshot["shards"]
+        except FileNotFoundError:
+            pass
+        try:
+            with self.fs.open(self.json_md5, "r") as f:
+                return json.load(f), {}
+        except FileNotFoundError:
+            return {}, {}
+
+    def _write_snapshot(self, all_md5: dict, versions: dict) -> None:
+        snapshot = {"md5": all_md5, "shards": versions}
+        try:
+            self.fs.pipe(self.snapshot, json.dumps(snapshot).encode())
+        except Exception as e:
+            logger.error(e)
+            logger.error("md5 snapshot not written")
+
+    def _read(self) -> dict:
+        all_md5, versions = self._read_baseline()
+
+        try:
+            shards = self.fs.find(self.shards_dir, detail=True)
+        except FileNotFoundError:
+            shards = {}
+
+        def shard_key(path):
+            return "/".join(path.rsplit("/", 5)[-5:])
+
+        newer = {}
+        for path, info in shards.items():
+            version = self._version(info)
+            if version is None or versions.get(shard_key(path)) != version:
+                newer[shard_key(path)] = (path, version)
+
+        if newer:
+            # Fetch all objects at once (concurrent requests on s3fs)
+            paths = [path for path, _ in newer.values()]
+            contents = self.fs.cat(paths, on_error="omit")
+            for path, content in contents.items():
+                key = shard_key(path)
+                *keys, year = key.split("/")
+                keys = (*keys, year.rsplit(".", maxsplit=1)[0])
+                md5 = json.loads(content)["md5"]
+                all_md5 = deep_dict_update(all_md5, self._nest(keys, md5))
+                version = newer[key][1]
+                if version is not None:
+                    versions[key] = version
+            if len(newer) >= self.compaction:
+                self._write_snapshot(all_md5, versions)
+        return all_md5
+
+    def _load(self) -> dict:
+        with self._lock:
+            if self._md5 is None:
+                try:
+                    self._md5 = self._read()
+                except Exception as e:
+                    logger.error(e)
+                    logger.error("md5 registry could not be read on MinIO")
+                    self._md5 = {}
+            return self._md5
+
+    def get(
+        self,
+        provider: str,
+        dataset_family: str,
+        source: str,
+        territory: str,
+        year: int,
+    ) -> str:
+        """
+        Get the last md5 hash value of a dataset (None if the dataset is not
+        referenced in the registry).
+        """
+        d = self._load()
+        try:
+            for key in self._keys(provider, dataset_family, source, territory, year):
+                d = d[key]
+        except (KeyError, TypeError):
+            logger.debug("file not referenced in md5 json")
+            return None
+        return d
+
+    def update(
+        self,
+        provider: str,
+        dataset_family: str,
+        source: str,
+        territory: str,
+        year: int,
+        md5: str,
+    ) -> bool:
+        """
+        Register the new md5 hash value of a dataset. The update will be
+        written on the s3 once batch_size updates are pending (or on flush).
+
+        Returns
+        -------
+        bool
+            False if an attempted write to the s3 failed, True otherwise
+
+        """
+        keys = self._keys(provider, dataset_family, source, territory, year)
+        with self._lock:
+            self._md5 = deep_dict_update(self._load(), self._nest(keys, md5))
+            self._pending[keys] = md5
+            if len(self._pending) >= self.batch_size:
+                return self.flush()
+        return True
+
+    def flush(self) -> bool:
+        """
+        Write all pending updates to the s3 (one object per dataset).
+
+        Returns
+        -------
+        bool
+            True if the json has been written (or if no update was pending)
+
+        """
+        with self._lock:
+            if not self._pending:
+                return True
+            objects = {
+                self._shard_path(keys): json.dumps({"md5": md5}).encode()
+                for keys, md5 in self._pending.items()
+            }
+            try:
+                self.fs.pipe(objects)
+            except Exception as e:
+                logger.error(e)
+                logger.error("md5 not written")
+                return False
+            self._pending = {}
+            return True
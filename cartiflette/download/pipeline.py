@@ -1,24 +1,47 @@
 # -*- coding: utf-8 -*-
 
 from datetime import date
-import json
 import logging
-from pebble import ThreadPool
 import s3fs
 
-from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET, FS, THREADS_DOWNLOAD
+from cartiflette.config import (
+    BUCKET,
+    PATH_WITHIN_BUCKET,
+    FS,
+    HOSTS_CONCURRENCY,
+    THREADS_DOWNLOAD,
+    THREADS_UNPACK,
+    THREADS_UPLOAD,
+)
 from cartiflette.constants import DOWNLOAD_PIPELINE_ARGS
-from cartiflette.download.download import _download_sources
-from cartiflette.utils import deep_dict_update
+from cartiflette.download.download import (
+    _expand_combinations,
+    _download_combinations,
+    _plan_combinations,
+)
+from cartiflette.download.report import RunReport
+from cartiflette.utils import compile_sources_index
 
 logger = logging.getLogger(__name__)
 
 
+def _pipeline_combinations() -> list[tuple]:
+    "Gather every combination described by DOWNLOAD_PIPELINE_ARGS"
+    years = list(range(2015, date.today().year + 1))[-1::-1]
+    index = compile_sources_index()
+    return [
+        combination
+        for args in DOWNLOAD_PIPELINE_ARGS.values()
+        for combination in _expand_combinations(*args, years=years, index=index)
+    ]
+
+
 def download_all(
     bucket: str = BUCKET,
     path_within_bucket: str = PATH_WITHIN_BUCKET,
     fs: s3fs.S3FileSystem = FS,
     upload: bool = True,
+    report_path: str = None,
 ) -> dict:
     """
     Performs a full pipeline to download data and store them on MinIO. The
@@ -27,8 +50,9 @@ def download_all(
     described in the cartiflette/utils/sources.yaml file.
 
     Note: to perform an easy debugging task, please overwrite
-    cartiflette.config.THREADS_DOWNLOAD to 1 (to avoid multithreading which
-    could be gruesome to debug).
+    cartiflette.config.THREADS_DOWNLOAD and cartiflette.config.PROCESSES_LAYERS
+    to 1 (to avoid multithreading/multiprocessing which could be gruesome to
+    debug).
 
     Parameters
     ----------
@@ -42,6 +66,11 @@ def download_all(
         Whether to store data on MinIO or not. This argument should only be
         used for debugging purposes. The default is True, to upload data on
         MinIO.
+    report_path : str, optional
+        Path of a json file where to write the run report (timings, volumes
+        and concurrency of each stage : download, hash, unpack, layers and
+        upload, with a summary by host for downloads). The default is None,
+        which will only log the summary of each stage.
 
     Returns
     -------
@@ -103,50 +132,79 @@ def download_all(
     if not upload:
         logger.warning("no upload to s3 will be done, set upload=True to upload")
 
-    # Initialize MD5 json if absent
-    json_md5 = f"{bucket}/{path_within_bucket}/md5.json"
-    try:
-        json_md5 in fs.ls(json_md5.rsplit("/", maxsplit=1)[0])
-    except FileNotFoundError:
-        with fs.open(json_md5, "w") as f:
-            json.dump({}, f)
-
+    # Downloads are limited per host (see DownloadScheduler)
+    report = RunReport(
+        workers={
+            "hash": THREADS_UNPACK,
+            "unpack": THREADS_UNPACK,
+            "layers": THREADS_UNPACK,
+            "upload": THREADS_UPLOAD,
+        },
+        hosts_workers=HOSTS_CONCURRENCY,
+        default_host_workers=THREADS_DOWNLOAD,
+    )
     kwargs = {
         "bucket": bucket,
         "path_within_bucket": path_within_bucket,
         "fs": fs,
         "upload": upload,
+        "report": report,
     }
-    years = list(range(2015, date.today().year + 1))[-1::-1]
-
-    results = {}
 
     logger.info("Synchronize raw sources")
 
-    def func(args):
-        key, args = args
-        results = _download_sources(*args, years=years, **kwargs)
-        logger.info(f"{key} done")
-        return results
-
-    datasets_args = DOWNLOAD_PIPELINE_ARGS
-
-    if THREADS_DOWNLOAD > 1:
-        with ThreadPool(THREADS_DOWNLOAD) as pool:
-            iterator = pool.map(func, datasets_args.items()).result()
-            while True:
-                try:
-                    results = deep_dict_update(results, next(iterator))
-                except StopIteration:
-                    break
-                except Exception as e:
-                    logger.error(e)
-    else:
-        for args in datasets_args.items():
-            results = deep_dict_update(results, func(args))
+    # Gather every combination to let a single scheduler handle all downloads
+    combinations = _pipeline_combinations()
+    results = _download_combinations(combinations, **kwargs)
+    logger.info("Raw sources synchronized")
+
+    report.log()
+    if report_path:
+        report.to_json(report_path)
+        logger.info(f"Run report written to {report_path}")
+
     return results
 
 
+def plan_download_all(
+    bucket: str = BUCKET,
+    path_within_bucket: str = PATH_WITHIN_BUCKET,
+    fs: s3fs.S3FileSystem = FS,
+) -> dict:
+    """
+    Dry-run of download_all : evaluate which files would be downloaded (by
+    comparing the providers' headers to the md5 registry) and the volume to
+    transfer, without downloading anything.
+
+    Parameters
+    ----------
+    bucket : str, optional
+        Bucket to use. The default is BUCKET.
+    path_within_bucket : str, optional
+        path within bucket. The default is PATH_WITHIN_BUCKET.
+    fs : s3fs.S3FileSystem, optional
+        S3 file system to use. The default is FS.
+
+    Returns
+    -------
+    dict
+        Plan of the synchronization (see
+        cartiflette.download.download._plan_combinations)
+
+    """
+    plan = _plan_combinations(
+        _pipeline_combinations(), bucket, path_within_bucket, fs
+    )
+    logger.info(
+        f"{plan['to_download']} files to download out of "
+        f"{len(plan['datasets'])} ({plan['changed']} possibly changed), "
+        f"{plan['transfer_bytes'] / 1024**3:.2f} GiB "
+        f"to transfer ({plan['unknown_sizes']} files of unknown size), "
+        f"{plan['disk_bytes'] / 1024**3:.2f} GiB of peak disk usage"
+    )
+    return plan
+
+
 # def download_all_option2():
 #     # Dérouler le yaml comme dans le test
 
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import inspect
+import json
+import logging
+import os
+import s3fs
+import threading
+from typing import Dict, List
+
+from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET, FS
+from cartiflette.utils import hash_file
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest"
+
+
+class RawStore:
+    """
+    Content-addressed store of the raw files : each file is stored once
+    ({path_within_bucket}/raw-store/{md5[:2]}/{md5}{extension}), whatever the
+    number of vintages or territories sharing it. Each folder of raw files
+    (as given by create_path_bucket) only holds a manifest mapping the
+    files' names to their objects in the store (see list_raw_files and
+    resolve_raw_file to read them) ; the manifest is made of one small
+    object per file ({folder}/manifest/{name}.json), so that concurrent
+    uploads to the same folder never overwrite each other's entries.
+    The content of the store is listed once (at the first upload) and
+    shared among all uploads of a pipeline run.
+    """
+
+    def __init__(
+        self,
+        bucket: str = BUCKET,
+        path_within_bucket: str = PATH_WITHIN_BUCKET,
+        fs: s3fs.S3FileSystem = FS,
+    ):
+        """
+        Initialize the store (lazily : nothing is read from the s3 until the
+        first upload).
+
+        Parameters
+        ----------
+        bucket : str, optional
+            Bucket to use. The default is BUCKET.
+        path_within_bucket : str, optional
+            path within bucket. The default is PATH_WITHIN_BUCKET.
+        fs : s3fs.S3FileSystem, optional
+            S3 file system to use. The default is FS.
+
+        """
+        self.root = f"{bucket}/{path_within_bucket}/raw-store"
+        self.fs = fs
+        self._stored = None
+        self._lock = threading.Lock()
+
+    def store_path(self, file_path: str) -> str:
+        "Path in the store of a local file"
+        md5 = hash_file(file_path)
+        extension = os.path.splitext(file_path)[-1].lower()
+        return f"{self.root}/{md5[:2]}/{md5}{extension}"
+
+    def _load(self) -> set:
+        with self._lock:
+            if self._stored is None:
+                try:
+                    stored = self.fs.find(self.root)
+                except FileNotFoundError:
+                    stored = []
+                self._stored = {x.rsplit("/", maxsplit=1)[-1] for x in stored}
+            return self._stored
+
+    def put(self, files: Dict[str, str], **kwargs) -> Dict[str, str]:
+        """
+        Store local files, skipping those whose content is already stored,
+        and reference them in the manifests of their folders.
+
+        Parameters
+        ----------
+        files : Dict[str, str]
+            Local paths mapped to the (logical) paths of the files on the s3,
+            ie {"/tmp/xxx/COMMUNE.shp": "bucket/.../territory=metropole/
+            simplification=0/COMMUNE.shp"}
+        **kwargs :
+            Optional arguments passed to fs.put (batch_size, chunksize...)
+
+        Returns
+        -------
+        Dict[str, str]
+            Logical paths mapped to the paths of the objects in the store
+
+        """
+        stored = self._load()
+        targets = {path: self.store_path(path) for path in files}
+
+        to_upload = {}
+        for path, target in targets.items():
+            name = target.rsplit("/", maxsplit=1)[-1]
+            if name not in stored:
+                to_upload[target] = path
+        logger.debug(
+            f"{len(to_upload)} files to upload, {len(files) - len(to_upload)} "
+            "already stored"
+        )
+        if to_upload:
+            kwargs = supported_put_kwargs(self.fs, kwargs)
+            self.fs.put(list(to_upload.values()), list(to_upload), **kwargs)
+            with self._lock:
+                stored.update(x.rsplit("/", maxsplit=1)[-1] for x in to_upload)
+
+        pointers = {files[path]: target for path, target in targets.items()}
+        self.fs.pipe(
+            {
+                _manifest_entry(logical): json.dumps({"object": target}).encode()
+                for logical, target in pointers.items()
+            }
+        )
+
+        return pointers
+
+
+def supported_put_kwargs(fs: s3fs.S3FileSystem, kwargs: dict) -> dict:
+    """
+    Drop the max_concurrency argument of fs.put if the file system doesn't
+    handle it (concurrent multipart uploads are only supported by recent
+    versions of s3fs ; older versions would forward it to the S3 API).
+    """
+    if "max_concurrency" in kwargs and isinstance(fs, s3fs.S3FileSystem):
+        if "max_concurrency" not in inspect.signature(fs._put_file).parameters:
+            kwargs = {k: v for k, v in kwargs.items() if k != "max_concurrency"}
+    return kwargs
+
+
+def _manifest_entry(path: str) -> str:
+    "Path of the manifest entry of a raw file, given it's (logical) path"
+    folder, name = path.rsplit("/", maxsplit=1)
+    return f"{folder}/{MANIFEST}/{name}.json"
+
+
+def list_raw_files(fs: s3fs.S3FileSystem, folder: str) -> List[str]:
+    """
+    List the (logical) paths of the raw files of a folder, whether they are
+    referenced in it's manifest or stored directly in the folder.
+
+    Parameters
+    ----------
+    fs : s3fs.S3FileSystem
+        S3 file system to use.
+    folder : str
+        Folder of raw files (as given by create_path_bucket)
+
+    Returns
+    -------
+    List[str]
+        Paths of the files
+
+    """
+    folder = folder.rstrip("/")
+    try:
+        files = [
+            x
+            for x in fs.ls(folder, detail=False)
+            if x.rstrip("/").rsplit("/", maxsplit=1)[-1] != MANIFEST
+        ]
+    except FileNotFoundError:
+        files = []
+    try:
+        entries = fs.ls(f"{folder}/{MANIFEST}", detail=False)
+    except FileNotFoundError:
+        entries = []
+    files += [
+        f"{folder}/{x.rsplit('/', maxsplit=1)[-1].removesuffix('.json')}"
+        for x in entries
+    ]
+    return sorted(set(files))
+
+
+def resolve_raw_file(fs: s3fs.S3FileSystem, path: str) -> str:
+    """
+    Get the path of the object holding the content of a raw file (the path
+    itself if the file is not referenced in it's folder's manifest).
+
+    Parameters
+    ----------
+    fs : s3fs.S3FileSystem
+        S3 file system to use.
+    path : str
+        (Logical) path of the raw file
+
+    Returns
+    -------
+    str
+        Path of the object to read
+
+    """
+    try:
+        with fs.open(_manifest_entry(path), "r") as f:
+            return json.load(f)["object"]
+    except FileNotFoundError:
+        return path
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import json
+import logging
+import threading
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class RunReport:
+    """
+    Collector of the timings of each stage of a pipeline run (download,
+    hash, unpack, layers, upload...), shared among all threads. Each measure
+    is stored as an event ; events are then summarized by stage (and by host
+    for downloads) into a machine-readable report.
+    """
+
+    def __init__(
+        self,
+        workers: Dict[str, int] = None,
+        hosts_workers: Dict[str, int] = None,
+        default_host_workers: int = None,
+    ):
+        """
+        Initialize the report.
+
+        Parameters
+        ----------
+        workers : Dict[str, int], optional
+            Configured number of workers of each stage, reported alongside
+            the observed concurrency. The default is None.
+        hosts_workers : Dict[str, int], optional
+            Configured number of workers of each host (ie the concurrency of
+            downloads, which is limited per host) : the workers of the stages
+            measured by host are reported as the limits of each host met.
+            The default is None.
+        default_host_workers : int, optional
+            Number of workers of the hosts not described in hosts_workers.
+            The default is None.
+
+        """
+        self.workers = workers or {}
+        self.hosts_workers = hosts_workers or {}
+        self.default_host_workers = default_host_workers
+        self.events = []
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self._active = {}
+        self._max_active = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, stage: str, **labels):
+        """
+        Measure the duration of a stage. Labels (ie dataset, host) are
+        stored in the event, which is yielded so that other values (ie
+        "bytes") can be added during the measure.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        **labels :
+            Labels of the event
+
+        Yields
+        ------
+        dict
+            The event
+
+        """
+        event = {"stage": stage, **labels}
+        # concurrency is tracked by stage, and by host within each stage
+        keys = [stage] + ([(stage, labels["host"])] if "host" in labels else [])
+        with self._lock:
+            for key in keys:
+                self._active[key] = self._active.get(key, 0) + 1
+                self._max_active[key] = max(
+                    self._max_active.get(key, 0), self._active[key]
+                )
+        start = time.perf_counter()
+        try:
+            yield event
+        except Exception:
+            event["error"] = True
+            raise
+        finally:
+            end = time.perf_counter()
+            event["start"] = round(start - self._start, 3)
+            event["duration"] = round(end - start, 3)
+            with self._lock:
+                for key in keys:
+                    self._active[key] -= 1
+                self.events.append(event)
+
+    @staticmethod
+    def _summarize(events: list) -> dict:
+        seconds = sum(x["duration"] for x in events)
+        size = sum(x.get("bytes", 0) for x in events)
+        throughput = round(size / 1024**2 / seconds, 3) if seconds else None
+        return {
+            "count": len(events),
+            "errors": sum(x.get("error", False) for x in events),
+            "seconds": round(seconds, 3),
+            "max_seconds": max((x["duration"] for x in events), default=0),
+            "bytes": size,
+            "throughput_mb_s": throughput,
+        }
+
+    def summary(self) -> dict:
+        """
+        Summarize the events by stage.
+
+        Returns
+        -------
+        dict
+            For each stage, the number of events (and errors), cumulated and
+            maximum duration (in seconds), cumulated volume (in bytes),
+            throughput (in MiB/s per worker), configured workers and maximum
+            observed concurrency. The workers of the stages measured by host
+            (downloads) are the limits of each host met.
+
+        """
+        with self._lock:
+            events = list(self.events)
+        stages = {}
+        for event in events:
+            stages.setdefault(event["stage"], []).append(event)
+        return {
+            stage: {
+                **self._summarize(these_events),
+                "workers": self._workers(stage, these_events),
+                "max_concurrency": self._max_active.get(stage),
+            }
+            for stage, these_events in stages.items()
+        }
+
+    def _host_workers(self, host: str) -> int:
+        return self.hosts_workers.get(host, self.default_host_workers)
+
+    def _workers(self, stage: str, events: list):
+        hosts = sorted({x["host"] for x in events if "host" in x})
+        if not hosts:
+            return self.workers.get(stage)
+        return {host: self._host_workers(host) for host in hosts}
+
+    def to_dict(self) -> dict:
+        """
+        Full report : global informations, summary by stage and by host (for
+        downloads) and every event.
+        """
+        with self._lock:
+            events = list(self.events)
+        hosts = {}
+        for event in events:
+            if "host" in event:
+                hosts.setdefault(event["host"], []).append(event)
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_seconds": round(time.perf_counter() - self._start, 3),
+            "stages": self.summary(),
+            "hosts": {
+                host: {
+                    **self._summarize(these_events),
+                    "workers": self._host_workers(host),
+                    "max_concurrency": max(
+                        self._max_active.get((x["stage"], host), 0)
+                        for x in these_events
+                    ),
+                }
+                for host, these_events in hosts.items()
+            },
+            "events": sorted(events, key=lambda x: x["start"]),
+        }
+
+    def to_json(self, path: str) -> None:
+        "Write the full report to a json file"
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+
+    def log(self) -> None:
+        "Log the summary of each stage"
+        for stage, summary in self.summary().items():
+            concurrency = f"{summary['max_concurrency']}/{summary['workers']}"
+            if isinstance(summary["workers"], dict):
+                # limits of each host
+                limits = ", ".join(f"{k}:{v}" for k, v in summary["workers"].items())
+                concurrency = f"{summary['max_concurrency']} (hosts limits {limits})"
+            logger.info(
+                f"{stage} : {summary['count']} done ({summary['errors']} "
+                f"errors) in {summary['seconds']}s cumulated, "
+                f"{summary['bytes'] / 1024**2:.1f} MiB, max concurrency "
+                f"{concurrency}"
+            )
+
+
+def measure(report: RunReport, stage: str, **labels):
+    """
+    Measure a stage in report (see RunReport.measure) ; does nothing if
+    report is None.
+    """
+    if report is None:
+        return nullcontext({})
+    return report.measure(stage, **labels)
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from pebble import ThreadPool
+import queue
+import threading
+import traceback
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from urllib.parse import urlparse
+import requests
+
+from cartiflette.config import (
+    THREADS_DOWNLOAD,
+    HOSTS_CONCURRENCY,
+    DOWNLOAD_DISK_BUDGET,
+    PIPELINE_QUEUE_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ByteBudget:
+    """
+    Counter of bytes currently held on local disk, shared among threads.
+    Acquiring blocks until the budget allows it ; a single job larger than
+    the whole budget is still allowed when nothing else is in flight.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int) -> None:
+        with self._condition:
+            while self.used and self.used + size > self.budget:
+                self._condition.wait()
+            self.used += size
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class BudgetTicket:
+    """
+    Share of a ByteBudget held by a downloaded file, which may be handed to
+    several holders (ie the items of a StagedPipeline processing the file) :
+    the bytes are given back to the budget once every holder has released
+    the ticket.
+    """
+
+    def __init__(self, budget: ByteBudget, size: int):
+        self.budget = budget
+        self.size = size
+        self.holders = 1
+        self._lock = threading.Lock()
+
+    def add_holder(self) -> None:
+        with self._lock:
+            if not self.holders:
+                raise RuntimeError("ticket already released")
+            self.holders += 1
+
+    def release(self) -> None:
+        with self._lock:
+            if not self.holders:
+                return
+            self.holders -= 1
+            if self.holders:
+                return
+        self.budget.release(self.size)
+
+
+class _DoneFuture:
+    "Synchronous stand-in for a pebble future (debugging mode)"
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def result(self):
+        return self.func(*self.args)
+
+
+class DownloadScheduler:
+    """
+    Global scheduler for downloads : each host gets its own pool of workers
+    (to avoid being throttled by providers), jobs are launched largest first
+    and the total volume of files held on disk is kept under a budget.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        hosts_concurrency: Dict[str, int] = HOSTS_CONCURRENCY,
+        default_concurrency: int = THREADS_DOWNLOAD,
+        disk_budget: int = DOWNLOAD_DISK_BUDGET,
+    ):
+        """
+        Initialize the scheduler.
+
+        Parameters
+        ----------
+        session : requests.Session
+            Session used to evaluate the size of each file (HEAD requests).
+        hosts_concurrency : Dict[str, int], optional
+            Maximum number of concurrent jobs per host. The default is
+            HOSTS_CONCURRENCY.
+        default_concurrency : int, optional
+            Maximum number of concurrent jobs for hosts not described in
+            hosts_concurrency. The default is THREADS_DOWNLOAD.
+        disk_budget : int, optional
+            Maximum number of bytes of archives to hold simultaneously on
+            disk. The default is DOWNLOAD_DISK_BUDGET.
+
+        """
+        self.session = session
+        self.hosts_concurrency = hosts_concurrency
+        self.default_concurrency = default_concurrency
+        self.budget = ByteBudget(disk_budget)
+
+    @staticmethod
+    def get_host(url: str) -> str:
+        return urlparse(url).netloc
+
+    def get_concurrency(self, host: str) -> int:
+        return self.hosts_concurrency.get(host, self.default_concurrency)
+
+    def get_size(self, url: str) -> int:
+        """
+        Evaluate the size of a remote file through a HEAD request. Returns 0
+        if the size could not be evaluated.
+        """
+        try:
+            r = self.session.head(url)
+            return int(r.headers["Content-length"])
+        except Exception as e:
+            logger.debug(f"size of {url} could not be evaluated : {e}")
+            return 0
+
+    def head(
+        self, jobs: List[Tuple[Any, str]], **kwargs
+    ) -> Iterator[Tuple[Any, requests.Response]]:
+        """
+        Perform a HEAD request on each (key, url) job, honouring the
+        concurrency of each host, and yield (key, response) for each one of
+        them (response being None if the request failed). Additional kwargs
+        are passed to session.head.
+        """
+
+        def head(key, url):
+            try:
+                return self.session.head(url, **kwargs)
+            except Exception as e:
+                logger.warning(f"HEAD request failed on {url} : {e}")
+                return None
+
+        for key, future in self._map_by_host(jobs, head):
+            yield key, future.result()
+
+    def _by_host(self, jobs: List[Tuple[Any, str]]) -> Dict[str, list]:
+        by_host = dict()
+        for key, url in jobs:
+            by_host.setdefault(self.get_host(url), []).append((key, url))
+        return by_host
+
+    def _map_by_host(self, jobs: List[Tuple[Any, str]], func: Callable):
+        """
+        Run func(key, url) for each job, honouring the concurrency of each
+        host, and yield (key, future) in jobs' order within each host.
+        """
+        if self.default_concurrency <= 1:
+            # Debugging mode : deactivate multithreading
+            for key, url in jobs:
+                yield key, _DoneFuture(func, key, url)
+            return
+
+        pools = []
+        try:
+            futures = []
+            for host, host_jobs in self._by_host(jobs).items():
+                pool = ThreadPool(self.get_concurrency(host))
+                pools.append(pool)
+                futures += [
+                    (key, pool.schedule(func, args=(key, url)))
+                    for key, url in host_jobs
+                ]
+            yield from futures
+        finally:
+            for pool in pools:
+                pool.close()
+                pool.join()
+
+    def run(
+        self,
+        jobs: List[Tuple[Any, str]],
+        func: Callable[..., Any],
+        hold: bool = False,
+        copies: Dict[Any, int] = None,
+    ) -> Iterator[Tuple[Any, Any]]:
+        """
+        Run func(key) for each (key, url) job and yield (key, result) for
+        each one of them. Failed jobs are logged and skipped.
+
+        Parameters
+        ----------
+        jobs : List[Tuple[Any, str]]
+            Jobs to run, described by a key (passed to func) and the url of the
+            file which will be downloaded by func.
+        func : Callable[..., Any]
+            Function performing the download (and any related processing
+            needing the downloaded file on disk).
+        hold : bool, optional
+            If True, func is called as func(key, ticket), ticket being the
+            BudgetTicket of the file : the file's bytes are kept in the disk
+            budget after func returns, until every holder added by func
+            (see BudgetTicket.add_holder) has released the ticket. Use this
+            if the file is handed to later processing stages. The default is
+            False, the bytes being released as soon as func returns.
+        copies : Dict[Any, int], optional
+            Number of copies of each job's file held on disk (ie an archive
+            shared among several datasets, each one being unpacked on it's
+            own), each copy being counted in the disk budget. The default is
+            None (a single copy for each job).
+
+        Yields
+        ------
+        Iterator[Tuple[Any, Any]]
+            Key of each job and the result returned by func.
+
+        """
+        # Evaluate each file's size to start with the largest ones
+        sizes = {
+            key: future.result()
+            for key, future in self._map_by_host(
+                jobs, lambda key, url: self.get_size(url)
+            )
+        }
+        jobs = sorted(jobs, key=lambda job: sizes[job[0]], reverse=True)
+
+        copies = copies or {}
+
+        def budgeted_func(key, url):
+            size = sizes[key] * copies.get(key, 1)
+            self.budget.acquire(size)
+            ticket = BudgetTicket(self.budget, size)
+            try:
+                return func(key, ticket) if hold else func(key)
+            finally:
+                # func's own share (other holders release theirs)
+                ticket.release()
+
+        for key, future in self._map_by_host(jobs, budgeted_func):
+            try:
+                yield key, future.result()
+            except Exception as e:
+                logger.error(e)
+                logger.error(traceback.format_exc())
+
+
+class StagedPipeline:
+    """
+    Chain of processing stages linked by bounded queues, each stage having
+    it's own workers : items are fed to the first stage (blocking while it's
+    queue is full) and flow through all stages, so that the different
+    resources (network, CPU, s3 bandwidth) can be used at the same time.
+    Failed items are logged, recorded in failures (as (key, index of the
+    stage, exception) tuples) and skipped.
+    """
+
+    _stop = object()
+
+    def __init__(
+        self,
+        stages: List[Tuple[Callable[[Any, Any], Any], int]],
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        sequential: bool = False,
+    ):
+        """
+        Initialize the pipeline and start the workers.
+
+        Parameters
+        ----------
+        stages : List[Tuple[Callable[[Any, Any], Any], int]]
+            Stages, described by a function and a number of workers. Each
+            function is called as func(key, value) with the value returned by
+            the previous stage and must return the value passed to the next
+            one.
+        queue_size : int, optional
+            Maximum number of items waiting in front of each stage. The
+            default is PIPELINE_QUEUE_SIZE.
+        sequential : bool, optional
+            Debugging mode : run every stage in the thread feeding the
+            pipeline. The default is False.
+
+        """
+        self.stages = stages
+        self.sequential = sequential
+        self.results = []
+        self.failures = []
+        self._lock = threading.Lock()
+        self._queues = []
+        self._workers = []
+        if sequential:
+            return
+        for k, (func, workers) in enumerate(stages):
+            self._queues.append(queue.Queue(maxsize=queue_size))
+            threads = [
+                threading.Thread(target=self._work, args=(k, func), daemon=True)
+                for _ in range(max(workers, 1))
+            ]
+            for thread in threads:
+                thread.start()
+            self._workers.append(threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.join()
+
+    def _process(self, k: int, func: Callable, key: Any, value: Any) -> None:
+        try:
+            value = func(key, value)
+        except Exception as e:
+            logger.error(e)
+            logger.error(traceback.format_exc())
+            with self._lock:
+                self.failures.append((key, k, e))
+            return
+        if k + 1 < len(self.stages):
+            self._feed(k + 1, key, value)
+        else:
+            with self._lock:
+                self.results.append((key, value))
+
+    def _feed(self, k: int, key: Any, value: Any) -> None:
+        if self.sequential:
+            self._process(k, self.stages[k][0], key, value)
+        else:
+            self._queues[k].put((key, value))
+
+    def _work(self, k: int, func: Callable) -> None:
+        while True:
+            item = self._queues[k].get()
+            if item is self._stop:
+                return
+            self._process(k, func, *item)
+
+    def put(self, key: Any, value: Any = None) -> None:
+        """
+        Feed an item to the first stage (blocking while it's queue is full)
+        """
+        self._feed(0, key, value)
+
+    def join(self) -> List[Tuple[Any, Any]]:
+        """
+        Wait for all items to go through the pipeline and stop the workers.
+
+        Returns
+        -------
+        List[Tuple[Any, Any]]
+            Key of each item and the value returned by the last stage.
+
+        """
+        for q, threads in zip(self._queues, self._workers):
+            for _ in threads:
+                q.put(self._stop)
+            for thread in threads:
+                thread.join()
+        self._queues, self._workers = [], []
+        return self.results
@@ -1,26 +1,104 @@
 # -*- coding: utf-8 -*-
 
+from contextlib import contextmanager
 import magic
 from glob import glob
 import logging
+import multiprocessing
 import numpy as np
 import os
+from pebble import ProcessPool
 import re
 import requests
 import requests_cache
 import tempfile
 from tqdm import tqdm
-from typing import TypedDict
+from typing import Iterator, Tuple, TypedDict
 from unidecode import unidecode
 
 from cartiflette.utils import hash_file
 from cartiflette.download.dataset import Dataset
-from cartiflette.download.layer import Layer
-from cartiflette.config import LEAVE_TQDM
+from cartiflette.download.layer import Layer, DatasetDescription
+from cartiflette.download.report import RunReport, measure
+from cartiflette.config import (
+    LEAVE_TQDM,
+    PROCESSES_LAYERS,
+    CACHE_MAX_RESPONSE_SIZE,
+    CACHE_EXCLUDED_CONTENT_TYPES,
+)
 
 logger = logging.getLogger(__name__)
 
 
+def is_cacheable(response: requests.Response) -> bool:
+    """
+    Cache policy of MasterScraper : bodies of archives (or of any response
+    larger than CACHE_MAX_RESPONSE_SIZE) are streamed straight to their
+    destination instead of being duplicated in the SQLite cache. Headers
+    (HEAD requests) and small responses (html, csv, ...) are still cached.
+
+    Parameters
+    ----------
+    response : requests.Response
+        Response to evaluate
+
+    Returns
+    -------
+    bool
+        True if the response should be stored in the cache
+
+    """
+    if response.request.method == "HEAD":
+        return True
+
+    content_type = response.headers.get("Content-Type", "")
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type in CACHE_EXCLUDED_CONTENT_TYPES:
+        return False
+
+    try:
+        size = int(response.headers["Content-length"])
+    except (KeyError, ValueError):
+        # Unknown size : only cache text contents
+        return content_type.startswith("text/")
+    return size <= CACHE_MAX_RESPONSE_SIZE
+
+
+@contextmanager
+def layers_pool(processes: int = PROCESSES_LAYERS) -> Iterator[ProcessPool]:
+    """
+    Process pool used to evaluate the layers of the datasets (see
+    MasterScraper.unpack_layers), meant to be opened once, at top level,
+    before any download/unpack thread is started. The processes are spawned
+    (not forked) : forking while other threads hold locks (logging, the
+    SQLite http cache, ...) could deadlock the children.
+
+    Parameters
+    ----------
+    processes : int, optional
+        Number of processes. The default is PROCESSES_LAYERS.
+
+    Yields
+    ------
+    ProcessPool
+        The pool (None if processes <= 1, layers being then evaluated in the
+        calling thread)
+
+    """
+    if processes <= 1:
+        yield None
+        return
+    with ProcessPool(processes, context=multiprocessing.get_context("spawn")) as pool:
+        yield pool
+
+
+def _evaluate_layer(
+    description: DatasetDescription, cluster_name: str, files: dict
+) -> Layer:
+    "Evaluate a layer in a worker process of layers_pool"
+    return Layer(description, cluster_name, files)
+
+
 class MasterScraper(requests_cache.CachedSession):
     """
     Scraper class which could be used to perform either http/https get
@@ -45,7 +123,8 @@ class MasterScraper(requests_cache.CachedSession):
         """
         Initialize HttpScraper and set eventual proxies from os environment
         variables. *args and **kwargs are arguments that should be processed
-        by a requests.Session object.
+        by a requests.Session object. Unless another filter_fn is given,
+        large archives will not be stored in the cache (see is_cacheable).
 
         Parameters
         ----------
@@ -60,6 +139,8 @@ class MasterScraper(requests_cache.CachedSession):
             db_path=cache_name, wal=True, check_same_thread=False
         )
 
+        kwargs.setdefault("filter_fn", is_cacheable)
+
         # Initialisation de la session requests
         super().__init__(
             backend=backend,
@@ -76,7 +157,12 @@ class MasterScraper(requests_cache.CachedSession):
             except KeyError:
                 continue
 
-    def download_unpack(self, datafile: Dataset, **kwargs) -> DownloadReturn:
+    def download_unpack(
+        self,
+        datafile: Dataset,
+        processes: int = PROCESSES_LAYERS,
+        **kwargs,
+    ) -> DownloadReturn:
         """
         Performs a download (through http, https) to a tempfile
         which will be cleaned automatically ; unzip targeted files to a 2nd
@@ -98,6 +184,9 @@ class MasterScraper(requests_cache.CachedSession):
         ----------
         datafile : Dataset
             Dataset object to download.
+        processes : int, optional
+            Number of processes used to evaluate the dataset's layers. The
+            default is PROCESSES_LAYERS.
         **kwargs :
             Optional arguments to pass to requests.Session object.
 
@@ -135,15 +224,75 @@ class MasterScraper(requests_cache.CachedSession):
 
         """
 
-        hash_ = None
+        downloaded = self.download_archive(datafile, **kwargs)
+        with layers_pool(processes) as pool:
+            return self.unpack_layers(datafile, *downloaded, pool=pool)
+
+    def download_archive(
+        self, datafile: Dataset, **kwargs
+    ) -> Tuple[bool, str, str]:
+        """
+        Performs the download (through http, https) of a dataset to a
+        tempfile (first stage of download_unpack).
+
+        Parameters
+        ----------
+        datafile : Dataset
+            Dataset object to download.
+        **kwargs :
+            Optional arguments to pass to requests.Session object.
+
+        Returns
+        -------
+        Tuple[bool, str, str]
+            Same as download_to_tempfile_http : whether the file has been
+            downloaded, it's filetype and the path to the tempfile.
+
+        """
         url = datafile.get_path_from_provider()
+        return download_to_tempfile_http(url, None, self, **kwargs)
+
+    def unpack_layers(
+        self,
+        datafile: Dataset,
+        downloaded: bool,
+        filetype: str,
+        temp_archive_file_raw: str,
+        pool: ProcessPool = None,
+        report: RunReport = None,
+    ) -> DownloadReturn:
+        """
+        Unzip targeted files of a downloaded archive to a temporary file and
+        evaluate each layer (second stage of download_unpack). The archive
+        is removed in any case.
+
+        Parameters
+        ----------
+        datafile : Dataset
+            Dataset object downloaded.
+        downloaded : bool
+            Whether the file has been downloaded (as returned by
+            download_archive).
+        filetype : str
+            Filetype of the archive (as returned by download_archive).
+        temp_archive_file_raw : str
+            Path to the archive (as returned by download_archive).
+        pool : ProcessPool, optional
+            Pool used to evaluate the dataset's layers (see layers_pool) ;
+            only the paths of the layers' files and a description of the
+            dataset are sent to the workers. The default is None, which will
+            evaluate the layers in the calling thread.
+        report : RunReport, optional
+            Report in which the timings of the hash, unpack and layers stages
+            will be stored. The default is None.
+
+        Returns
+        -------
+        DownloadReturn
+            See download_unpack.
 
-        # Download to temporary file
-        (
-            downloaded,
-            filetype,
-            temp_archive_file_raw,
-        ) = download_to_tempfile_http(url, hash_, self, **kwargs)
+        """
+        hash_ = None
 
         if not downloaded:
             # Suppression du fichier temporaire
@@ -158,35 +307,41 @@ class MasterScraper(requests_cache.CachedSession):
                 "root_cleanup": None,
             }
 
+        dataset = str(datafile)
+        size = os.path.getsize(temp_archive_file_raw)
         try:
             # Calcul du hashage du fichier brut (avant dézipage)
-            hash_ = datafile._md5(temp_archive_file_raw)
+            with measure(report, "hash", dataset=dataset) as event:
+                event["bytes"] = size
+                hash_ = datafile._md5(temp_archive_file_raw)
 
             datafile.set_temp_file_path(temp_archive_file_raw)
 
-            if "7-zip" in filetype:
-                root_folder, files_locations = datafile.unpack(protocol="7z")
-            elif "Zip archive" in filetype:
-                root_folder, files_locations = datafile.unpack(
-                    protocol="zip"
-                )
-            elif "Unicode text" in filetype or "CSV text" in filetype:
-                # copy in temp directory without processing
-                root_folder = tempfile.mkdtemp()
-                with open(temp_archive_file_raw, "rb") as f:
-                    filename = unidecode(datafile.__str__().upper()).strip()
-                    filename = "_".join(
-                        x for x in re.split(r"\W+", filename) if x
+            with measure(report, "unpack", dataset=dataset) as event:
+                event["bytes"] = size
+                if "7-zip" in filetype:
+                    root_folder, files_locations = datafile.unpack(protocol="7z")
+                elif "Zip archive" in filetype:
+                    root_folder, files_locations = datafile.unpack(
+                        protocol="zip"
                     )
-                    path = os.path.join(root_folder, filename + ".csv")
-                    with open(path, "wb") as out:
-                        out.write(f.read())
-
-                logger.debug(f"Storing CSV to {root_folder}")
-                files_locations = ((path,),)
-
-            else:
-                raise NotImplementedError(f"{filetype} encountered")
+                elif "Unicode text" in filetype or "CSV text" in filetype:
+                    # copy in temp directory without processing
+                    root_folder = tempfile.mkdtemp()
+                    with open(temp_archive_file_raw, "rb") as f:
+                        filename = unidecode(datafile.__str__().upper()).strip()
+                        filename = "_".join(
+                            x for x in re.split(r"\W+", filename) if x
+                        )
+                        path = os.path.join(root_folder, filename + ".csv")
+                        with open(path, "wb") as out:
+                            out.write(f.read())
+
+                    logger.debug(f"Storing CSV to {root_folder}")
+                    files_locations = ((path,),)
+
+                else:
+                    raise NotImplementedError(f"{filetype} encountered")
         except Exception as e:
             raise e
         finally:
@@ -211,7 +366,7 @@ class MasterScraper(requests_cache.CachedSession):
             for basename, cluster in basenames.items()
         }
 
-        layers = dict()
+        layers_files = dict()
         for cluster_name, cluster_filtered in paths.items():
             cluster_pattern = {
                 os.path.splitext(x)[0] for x in cluster_filtered
@@ -228,7 +383,28 @@ class MasterScraper(requests_cache.CachedSession):
                 x: (x in cluster_filtered) for x in all_files_cluster
             }
 
-            layers[cluster_name] = Layer(datafile, cluster_name, dict_files)
+            layers_files[cluster_name] = dict_files
+
+        # Evaluate layers (GIS reading, reprojection, territory recognition)
+        with measure(report, "layers", dataset=dataset) as event:
+            event["layers"] = len(layers_files)
+            if pool is not None and len(layers_files) > 1:
+                description = DatasetDescription.from_dataset(datafile)
+                futures = {
+                    cluster_name: pool.schedule(
+                        _evaluate_layer, args=(description, cluster_name, files)
+                    )
+                    for cluster_name, files in layers_files.items()
+                }
+                layers = {}
+                for cluster_name, future in futures.items():
+                    layers[cluster_name] = future.result()
+                    layers[cluster_name].dataset = datafile
+            else:
+                layers = {
+                    cluster_name: Layer(datafile, cluster_name, dict_files)
+                    for cluster_name, dict_files in layers_files.items()
+                }
 
         return {
             "downloaded": True,
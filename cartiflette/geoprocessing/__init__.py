@@ -0,0 +1,15 @@
+"""
+Handling spatial data in-process (shapely/geopandas), as an alternative to
+mapshaper
+"""
+from .closer import bring_closer, bring_closer_file
+from .dissolve import dissolve_levels
+from .split import python_split, python_split_merge
+
+__all__ = [
+    "bring_closer",
+    "bring_closer_file",
+    "dissolve_levels",
+    "python_split",
+    "python_split_merge",
+]
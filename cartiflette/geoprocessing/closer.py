@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+In-process equivalent of mapshaper_bring_closer : the layer is read once,
+each area is selected with a vectorized mask and moved by an affine
+transform applied to it's coordinates arrays.
+"""
+
+import logging
+import os
+from typing import Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from cartiflette.mapshaper.mapshaper_closer import logical_conditions, shift, scale
+
+logger = logging.getLogger(__name__)
+
+IDF_SHIFT = (-650000, 275000)
+
+
+def _parse_bbox(condition: str) -> Tuple[float, float, float, float]:
+    "Parse a mapshaper bbox=xmin,ymin,xmax,ymax filter"
+    return tuple(float(x) for x in condition.split("=", maxsplit=1)[1].split(","))
+
+
+def _bbox_mask(bounds: np.ndarray, bbox: Tuple[float, float, float, float]):
+    "Mask of the features intersecting bbox (as mapshaper's -filter bbox=)"
+    xmin, ymin, xmax, ymax = bbox
+    return (
+        (bounds[:, 0] <= xmax)
+        & (bounds[:, 2] >= xmin)
+        & (bounds[:, 1] <= ymax)
+        & (bounds[:, 3] >= ymin)
+    )
+
+
+def _isin(column: pd.Series, values: list) -> np.ndarray:
+    """
+    Mask of the features whose column equals one of the values, as
+    ile_de_france_expression : numeric columns are compared as numbers (so
+    that 1109.0 matches "1109"), other columns as strings
+    """
+    if pd.api.types.is_numeric_dtype(column):
+        return column.isin(pd.to_numeric(values)).to_numpy()
+    return column.astype(str).isin(values).to_numpy()
+
+
+def _affine(
+    gdf: gpd.GeoDataFrame, shift_value: Tuple[float, float], scale_value: float
+) -> gpd.GeoDataFrame:
+    """
+    Scale geometries around the center of their (global) bounding box, then
+    shift them (as mapshaper's -affine).
+    """
+    if gdf.empty:
+        return gdf
+    xmin, ymin, xmax, ymax = gdf.total_bounds
+    anchor = np.array([(xmin + xmax) / 2, (ymin + ymax) / 2])
+    offset = anchor * (1 - scale_value) + np.asarray(shift_value, dtype=float)
+    geometries = shapely.transform(
+        gdf.geometry.values, lambda coords: coords * scale_value + offset
+    )
+    return gdf.set_geometry(gpd.GeoSeries(geometries, index=gdf.index, crs=gdf.crs))
+
+
+def bring_closer(
+    gdf: gpd.GeoDataFrame, level_agreg: str = "DEPARTEMENT"
+) -> gpd.GeoDataFrame:
+    """
+    Bring the DROM (and a zoom on Ile-de-France) closer to metropolitan
+    France.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Layer covering France (metropolitan France and DROM)
+    level_agreg : str, optional
+        Level used to select Ile-de-France (see logical_conditions). The
+        default is "DEPARTEMENT".
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Transformed layer, in EPSG:4326 : metropolitan France, then the zoom
+        on Ile-de-France, then each DROM (in the order of `shift`)
+
+    """
+    gdf = gdf.to_crs(3857)
+    bounds = shapely.bounds(gdf.geometry.values)
+
+    emprises = logical_conditions["EMPRISES"]
+    metropole = _bbox_mask(bounds, _parse_bbox(emprises["metropole"]))
+    parts = [gdf[metropole]]
+
+    field, values = logical_conditions[level_agreg]["ile de france"]
+    idf = _isin(gdf[field], values)
+    zoom_idf = float(logical_conditions[level_agreg]["zoom idf"])
+    parts.append(_affine(gdf[idf], IDF_SHIFT, zoom_idf))
+
+    for region, shift_value in shift.items():
+        mask = _bbox_mask(bounds, _parse_bbox(emprises[region]))
+        shift_value = tuple(float(x) for x in shift_value.split(","))
+        parts.append(_affine(gdf[mask], shift_value, float(scale[region])))
+
+    transformed = pd.concat(parts, ignore_index=True)
+    transformed = gpd.GeoDataFrame(
+        transformed, geometry=gdf.geometry.name, crs=gdf.crs
+    )
+    logger.debug(f"{len(transformed)} features after bringing DROM closer")
+    return transformed.to_crs(4326)
+
+
+def bring_closer_file(
+    france_vector_path: str = "temp.geojson",
+    output_path: str = "temp/preprocessed_transformed/idf_combined.geojson",
+    level_agreg: str = "DEPARTEMENT",
+) -> str:
+    """
+    Bring the DROM (and a zoom on Ile-de-France) closer to metropolitan
+    France, from file to file (see bring_closer).
+
+    Parameters
+    ----------
+    france_vector_path : str, optional
+        Path of the layer covering France. The default is "temp.geojson".
+    output_path : str, optional
+        Path of the output file. The default is
+        "temp/preprocessed_transformed/idf_combined.geojson".
+    level_agreg : str, optional
+        Level used to select Ile-de-France. The default is "DEPARTEMENT".
+
+    Returns
+    -------
+    str
+        output_path
+
+    """
+    gdf = gpd.read_file(france_vector_path, engine="pyogrio")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    bring_closer(gdf, level_agreg).to_file(output_path, engine="pyogrio")
+    return output_path
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Hierarchical dissolve of the (enriched) commune layer : each level is
+dissolved once, from the finest level it is nested in (ie REGION from
+DEPARTEMENT, which is itself dissolved from COMMUNE) instead of the full
+commune layer.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+from typing import Dict, List
+
+import geopandas as gpd
+import pandas as pd
+
+from cartiflette.config import DISSOLVE_PARTITION, DISSOLVE_MAX_WORKERS
+from cartiflette.utils import DICT_CORRESP_ADMINEXPRESS
+from .wrangling import dissolve_by
+
+logger = logging.getLogger(__name__)
+
+DISSOLVE_PARENTS = {
+    "DEPARTEMENT": "COMMUNE",
+    "REGION": "DEPARTEMENT",
+    "FRANCE_ENTIERE": "REGION",
+    "BASSIN_VIE": "COMMUNE",
+    "ZONE_EMPLOI": "COMMUNE",
+    "UNITE_URBAINE": "COMMUNE",
+    "AIRE_ATTRACTION_VILLES": "COMMUNE",
+}
+# Nota : each level is dissolved from it's parent level, in which it must be
+# nested (each polygon of the parent level belongs to a single polygon of
+# the level)
+
+DISSOLVE_COPIED_LEVELS = {
+    "DEPARTEMENT": ["REGION", "TERRITOIRE", "FRANCE_ENTIERE"],
+    "REGION": ["TERRITOIRE", "FRANCE_ENTIERE"],
+    "FRANCE_ENTIERE": [],
+    "BASSIN_VIE": ["TERRITOIRE", "FRANCE_ENTIERE"],
+    "ZONE_EMPLOI": ["TERRITOIRE", "FRANCE_ENTIERE"],
+    "UNITE_URBAINE": ["TERRITOIRE", "FRANCE_ENTIERE"],
+    "AIRE_ATTRACTION_VILLES": ["TERRITOIRE", "FRANCE_ENTIERE"],
+}
+# Nota : coarser levels whose fields are kept in each dissolved level, so
+# that it can be split by any of them (and used to dissolve coarser levels)
+
+
+def level_fields(
+    level: str, dict_corresp: dict = DICT_CORRESP_ADMINEXPRESS
+) -> List[str]:
+    """
+    Fields of a dissolved level : it's own code and label, and those of the
+    coarser levels it can be split by (see DISSOLVE_COPIED_LEVELS).
+
+    Parameters
+    ----------
+    level : str
+        The level (ie "DEPARTEMENT")
+    dict_corresp : dict, optional
+        A dictionary giving correspondance between levels and variable names.
+        The default is DICT_CORRESP_ADMINEXPRESS.
+
+    Returns
+    -------
+    List[str]
+        The fields (POPULATION excluded)
+
+    """
+    fields = []
+    for niveau in [level, *DISSOLVE_COPIED_LEVELS[level]]:
+        for field in (dict_corresp[niveau], dict_corresp.get(f"LIBELLE_{niveau}")):
+            if field and field not in fields:
+                fields.append(field)
+    return fields
+
+
+def splittable_by(level: str) -> List[str]:
+    """
+    Levels a dissolved level (as stored by the dissolve stage) can be split
+    by : it's own level, the coarser levels whose fields it keeps, and
+    FRANCE_ENTIERE_DROM_RAPPROCHES.
+    """
+    return [
+        level,
+        *DISSOLVE_COPIED_LEVELS.get(level, []),
+        "FRANCE_ENTIERE_DROM_RAPPROCHES",
+    ]
+
+
+def _dissolve_partition(
+    part: gpd.GeoDataFrame, by: str, copy_fields: List[str]
+) -> gpd.GeoDataFrame:
+    "Map step of parallel_dissolve_by : dissolve a single partition"
+    return dissolve_by(part, by, [*copy_fields, "_POSITION"])
+
+
+def parallel_dissolve_by(
+    gdf: gpd.GeoDataFrame,
+    by: str,
+    copy_fields: List[str],
+    partition: str,
+    max_workers: int = DISSOLVE_MAX_WORKERS,
+) -> gpd.GeoDataFrame:
+    """
+    Dissolve a layer by a field, as dissolve_by, in a map-reduce fashion :
+    the layer is split by the partition field, each partition is dissolved on
+    a process pool, then the partial results are dissolved together (which
+    only merges the polygons spanning several partitions, along their shared
+    boundaries). The result is the same as dissolve_by's, features and
+    copied fields being ordered by the first feature of each group.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        The layer to dissolve
+    by : str
+        The field to dissolve by
+    copy_fields : List[str]
+        The fields to copy (missing fields are ignored)
+    partition : str
+        The field used to partition the layer (ie INSEE_DEP)
+    max_workers : int, optional
+        Number of processes. The default is DISSOLVE_MAX_WORKERS.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        The dissolved layer
+
+    """
+    if partition not in gdf.columns or max_workers == 1:
+        return dissolve_by(gdf, by, copy_fields)
+
+    columns = [by, *dict.fromkeys(x for x in copy_fields if x != by), partition]
+    columns += ["POPULATION", "geometry"]
+    gdf = gdf[[x for x in dict.fromkeys(columns) if x in gdf.columns]].copy()
+    # Position of the first feature of each group, to keep the serial order
+    gdf["_POSITION"] = range(len(gdf))
+    parts = [part for _, part in gdf.groupby(partition, dropna=False, sort=False)]
+    if len(parts) == 1:
+        return dissolve_by(gdf, by, copy_fields)
+
+    logger.info(f"dissolving {len(parts)} partitions by {by}")
+    with ProcessPoolExecutor(max_workers) as pool:
+        partials = list(
+            pool.map(
+                _dissolve_partition,
+                parts,
+                [by] * len(parts),
+                [copy_fields] * len(parts),
+            )
+        )
+
+    partials = pd.concat(partials, ignore_index=True)
+    partials = gpd.GeoDataFrame(partials, geometry="geometry", crs=gdf.crs)
+    partials = partials.sort_values("_POSITION", kind="stable")
+    return dissolve_by(partials, by, copy_fields)
+
+
+def dissolve_levels(
+    communes: gpd.GeoDataFrame,
+    levels: List[str] = None,
+    dict_corresp: dict = DICT_CORRESP_ADMINEXPRESS,
+    max_workers: int = DISSOLVE_MAX_WORKERS,
+) -> Dict[str, gpd.GeoDataFrame]:
+    """
+    Dissolve the (enriched) commune layer into each level, each one being
+    computed once, from it's parent level (see DISSOLVE_PARENTS).
+
+    Parameters
+    ----------
+    communes : gpd.GeoDataFrame
+        The enriched commune layer
+    levels : List[str], optional
+        The levels to compute (their parent levels are computed as well). The
+        default is None, which will compute every level of DISSOLVE_PARENTS.
+    dict_corresp : dict, optional
+        A dictionary giving correspondance between levels and variable names.
+        The default is DICT_CORRESP_ADMINEXPRESS.
+    max_workers : int, optional
+        Number of processes used to dissolve the levels computed from the
+        commune layer, partitioned by DISSOLVE_PARTITION (see
+        parallel_dissolve_by). The default is DISSOLVE_MAX_WORKERS.
+
+    Returns
+    -------
+    Dict[str, gpd.GeoDataFrame]
+        The dissolved layers, for each level computed (including parent
+        levels, excluding COMMUNE)
+
+    """
+    if levels is None:
+        levels = list(DISSOLVE_PARENTS)
+
+    dissolved = {"COMMUNE": communes}
+
+    def get(level):
+        try:
+            return dissolved[level]
+        except KeyError:
+            pass
+        parent = get(DISSOLVE_PARENTS[level])
+        logger.info(f"dissolving {level} from {len(parent)} features")
+        by, fields = dict_corresp[level], level_fields(level, dict_corresp)
+        if DISSOLVE_PARENTS[level] == "COMMUNE":
+            dissolved[level] = parallel_dissolve_by(
+                parent, by, fields, dict_corresp[DISSOLVE_PARTITION], max_workers
+            )
+        else:
+            dissolved[level] = dissolve_by(parent, by, fields)
+        return dissolved[level]
+
+    for level in levels:
+        get(level)
+
+    del dissolved["COMMUNE"]
+    return dissolved
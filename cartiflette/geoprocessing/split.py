@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+In-process equivalents of mapshaperize_split and mapshaperize_split_merge,
+built on shapely/geopandas (no Node nor mapshaper needed) ; as every step
+runs in the Python process, those functions can be run on a process pool.
+"""
+
+import logging
+import os
+
+import geopandas as gpd
+import pandas as pd
+
+from cartiflette.utils import DICT_CORRESP_ADMINEXPRESS, split_outputs
+from .closer import bring_closer
+from .wrangling import read_metadata, enrich, dissolve, simplify, split
+
+logger = logging.getLogger(__name__)
+
+# Communes split into arrondissements (Paris, Lyon, Marseille)
+COMMUNES_WITH_ARRONDISSEMENTS = ["69123", "13055", "75056"]
+
+
+def read_layer(path: str) -> gpd.GeoDataFrame:
+    "Read a layer (geoparquet or any format supported by pyogrio)"
+    if path.endswith(".parquet"):
+        return gpd.read_parquet(path)
+    return gpd.read_file(path, engine="pyogrio")
+
+
+def merge_arrondissements(
+    communes: gpd.GeoDataFrame, arrondissements: gpd.GeoDataFrame
+) -> gpd.GeoDataFrame:
+    """
+    Merge the commune and arrondissement layers, Paris, Lyon and Marseille
+    being replaced by their arrondissements (INSEE_COG holding either the
+    commune or the arrondissement code).
+    """
+    # PREPROCESS CITIES
+    communes = communes.to_crs(4326)
+    communes = communes[~communes["INSEE_COM"].isin(COMMUNES_WITH_ARRONDISSEMENTS)]
+    communes["INSEE_COG"] = communes["INSEE_COM"]
+
+    # PREPROCESS ARRONDISSEMENT
+    arrondissements = arrondissements.to_crs(4326)
+    arrondissements = arrondissements.rename(columns={"INSEE_ARM": "INSEE_COG"})
+    arrondissements["STATUT"] = "Arrondissement municipal"
+
+    # MERGE CITIES AND ARRONDISSEMENT
+    return gpd.GeoDataFrame(
+        pd.concat([communes, arrondissements], ignore_index=True),
+        geometry="geometry",
+        crs=4326,
+    )
+
+
+def _finalize(
+    gdf: gpd.GeoDataFrame,
+    outputs: dict,
+    niveau_polygons: str,
+    niveau_agreg: str,
+    provider: str,
+    source: str,
+    crs: int,
+    dict_corresp: dict,
+) -> None:
+    # IF WE DESIRE TO BRING "DROM" CLOSER TO FRANCE
+    if niveau_agreg.upper() == "FRANCE_ENTIERE_DROM_RAPPROCHES":
+        niveau_filter_drom = "DEPARTEMENT"
+        if niveau_polygons not in ("COMMUNE", "COMMUNE_ARRONDISSEMENT"):
+            niveau_filter_drom = niveau_polygons
+        gdf = bring_closer(gdf, level_agreg=niveau_filter_drom)
+
+    # STEP 2: SPLIT ET SIMPLIFIE (PROGRESSIVELY, EACH SIMPLIFICATION LEVEL
+    # BEING COMPUTED FROM THE PREVIOUS ONE, AND WRITTEN TO EACH FORMAT)
+    gdf = gdf.to_crs(crs)
+    retained = 100
+    for (format_output, simplification), output_path in outputs.items():
+        if (simplification or 100) != retained:
+            gdf = simplify(gdf, 100 * simplification / retained)
+            retained = simplification
+        split(
+            gdf,
+            split_variable=dict_corresp[niveau_agreg],
+            output_path=output_path,
+            format_output=format_output,
+            crs=crs,
+            source_identifier=f"{provider}:{source}",
+        )
+
+
+def python_split(
+    local_dir="temp",
+    config_file_city={},
+    format_output="topojson",
+    niveau_polygons="COMMUNE",
+    niveau_agreg="DEPARTEMENT",
+    provider="IGN",
+    source="EXPRESS-COG-CARTO-TERRITOIRE",
+    territory="metropole",
+    crs=4326,
+    simplification=0,
+    dict_corresp=DICT_CORRESP_ADMINEXPRESS,
+    metadata_file="temp/tagc.csv",
+):
+    """
+    Processes the commune layer and splits it based on specified parameters,
+    in-process (see mapshaperize_split for the arguments).
+
+    Returns
+    -------
+    str or dict
+        The output path of the processed and split files (the output path of
+        each (format, simplification) if several formats or simplification
+        levels are given).
+
+    """
+    directory_city = config_file_city.get("location", local_dir)
+    initial_filename_city = config_file_city.get("filename", "COMMUNE")
+    extension_initial_city = config_file_city.get("extension", "shp")
+
+    outputs = split_outputs(
+        local_dir, territory, niveau_agreg, format_output, simplification
+    )
+    for output_path in outputs.values():
+        os.makedirs(output_path, exist_ok=True)
+
+    gdf = read_layer(
+        f"{directory_city}/{initial_filename_city}.{extension_initial_city}"
+    )
+
+    # STEP 1: ENRICHISSEMENT AVEC COG (UNLESS ALREADY ENRICHED)
+    if not config_file_city.get("enriched", False):
+        gdf = enrich(gdf, read_metadata(metadata_file), dict_corresp)
+
+    # STEP 1B: DISSOLVE IF NEEDED
+    if niveau_polygons != initial_filename_city:
+        gdf = dissolve(gdf, niveau_polygons, niveau_agreg, dict_corresp)
+
+    _finalize(
+        gdf, outputs, niveau_polygons, niveau_agreg, provider, source, crs, dict_corresp
+    )
+    if isinstance(format_output, str) and not isinstance(simplification, (list, tuple)):
+        return output_path
+    return outputs
+
+
+def python_split_merge(
+    format_output="topojson",
+    niveau_agreg="DEPARTEMENT",
+    provider="IGN",
+    source="EXPRESS-COG-CARTO-TERRITOIRE",
+    territory="metropole",
+    config_file_city={},
+    config_file_arrondissement={},
+    local_dir="temp",
+    crs=4326,
+    simplification=0,
+    dict_corresp=DICT_CORRESP_ADMINEXPRESS,
+    metadata_file="temp/tagc.csv",
+):
+    """
+    Merges the commune and arrondissement layers (Paris, Lyon and Marseille
+    being replaced by their arrondissements) and splits the result based on
+    specified parameters, in-process (see mapshaperize_split_merge for the
+    arguments).
+
+    Returns
+    -------
+    str or dict
+        The output path of the processed and split files (the output path of
+        each (format, simplification) if several formats or simplification
+        levels are given).
+
+    """
+    directory_city = config_file_city.get("location", local_dir)
+    initial_filename_city = config_file_city.get("filename", "COMMUNE")
+    extension_initial_city = config_file_city.get("extension", "shp")
+
+    directory_arrondissement = config_file_arrondissement.get("location", local_dir)
+    initial_filename_arrondissement = config_file_arrondissement.get(
+        "filename", "ARRONDISSEMENT_MUNICIPAL"
+    )
+    extension_initial_arrondissement = config_file_arrondissement.get(
+        "extension", "shp"
+    )
+
+    outputs = split_outputs(
+        local_dir, territory, niveau_agreg, format_output, simplification
+    )
+    for output_path in outputs.values():
+        os.makedirs(output_path, exist_ok=True)
+
+    gdf = merge_arrondissements(
+        read_layer(
+            f"{directory_city}/{initial_filename_city}.{extension_initial_city}"
+        ),
+        read_layer(
+            f"{directory_arrondissement}/"
+            f"{initial_filename_arrondissement}.{extension_initial_arrondissement}"
+        ),
+    )
+
+    # STEP 1: ENRICHISSEMENT AVEC COG
+    gdf = enrich(gdf, read_metadata(metadata_file), DICT_CORRESP_ADMINEXPRESS)
+
+    _finalize(
+        gdf,
+        outputs,
+        "COMMUNE_ARRONDISSEMENT",
+        niveau_agreg,
+        provider,
+        source,
+        crs,
+        dict_corresp,
+    )
+    if isinstance(format_output, str) and not isinstance(simplification, (list, tuple)):
+        return output_path
+    return outputs
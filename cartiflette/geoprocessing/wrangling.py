@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Data wrangling (geo)operations, in-process equivalents of the mapshaper
+commands used by cartiflette (see cartiflette.mapshaper.mapshaper_wrangling)
+"""
+
+import logging
+import os
+import re
+from typing import List
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import topojson
+
+from cartiflette.utils import DICT_CORRESP_ADMINEXPRESS
+
+logger = logging.getLogger(__name__)
+
+# Fields removed from the commune layer when enriched (-filter-fields invert)
+ENRICH_DROPPED_FIELDS = [
+    "INSEE_CAN",
+    "INSEE_ARR",
+    "SIREN_EPCI",
+    "INSEE_DEP",
+    "INSEE_REG",
+    "NOM_M",
+]
+
+# Fields renamed once enriched (new name: old name, as -rename-fields)
+ENRICH_RENAMED_FIELDS = {"INSEE_DEP": "DEP", "INSEE_REG": "REG"}
+
+# Numbers as detected by mapshaper when importing a csv (codes with leading
+# zeros are kept as strings)
+NUMERIC = re.compile(r"^-?(0|[1-9]\d*)(\.\d+)?$")
+
+# Number of geometries used to estimate the tolerance of a simplification
+SIMPLIFY_SAMPLE_SIZE = 2000
+
+
+def read_metadata(metadata_file: str = "temp/tagc.csv") -> pd.DataFrame:
+    """
+    Read the csv metadata file, with mapshaper's type detection : columns
+    holding only numbers (without leading zeros) are converted to numbers,
+    the join key CODGEO is always a string.
+
+    Parameters
+    ----------
+    metadata_file : str, optional
+        The path of the csv metadata file. The default is "temp/tagc.csv".
+
+    Returns
+    -------
+    pd.DataFrame
+        The metadata
+
+    """
+    metadata = pd.read_csv(metadata_file, dtype=str)
+    metadata = metadata.loc[:, ~metadata.columns.str.startswith("Unnamed:")]
+    for column in metadata.columns.drop("CODGEO"):
+        values = metadata[column].dropna()
+        if len(values) and values.str.match(NUMERIC).all():
+            metadata[column] = pd.to_numeric(metadata[column])
+    return metadata
+
+
+def enrich(
+    gdf: gpd.GeoDataFrame,
+    metadata: pd.DataFrame,
+    dict_corresp: dict = DICT_CORRESP_ADMINEXPRESS,
+) -> gpd.GeoDataFrame:
+    """
+    Enrich the commune layer with the COG metadata (equivalent of
+    enrich_commands).
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        The commune layer
+    metadata : pd.DataFrame
+        The metadata, as returned by read_metadata
+    dict_corresp : dict, optional
+        A dictionary containing correspondences for field renaming and value
+        assignment. The default is DICT_CORRESP_ADMINEXPRESS.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        The enriched layer, in EPSG:4326
+
+    """
+    gdf = gdf.to_crs(4326)
+    gdf["INSEE_COM"] = gdf["INSEE_COM"].astype("string").astype(object)
+
+    # -join : every feature is kept, joined fields replace existing ones
+    metadata = metadata.drop_duplicates("CODGEO").set_index("CODGEO")
+    joined = metadata.reindex(gdf["INSEE_COM"].values)
+    joined.index = gdf.index
+    gdf = gdf.drop(columns=[x for x in metadata.columns if x in gdf.columns])
+    gdf = pd.concat([gdf, joined], axis=1)
+
+    gdf = gdf.drop(columns=[x for x in ENRICH_DROPPED_FIELDS if x in gdf.columns])
+    gdf = gdf.rename(columns={old: new for new, old in ENRICH_RENAMED_FIELDS.items()})
+    gdf[dict_corresp["FRANCE_ENTIERE"]] = "France"
+    return gpd.GeoDataFrame(gdf, geometry="geometry", crs=4326)
+
+
+def dissolve_by(
+    gdf: gpd.GeoDataFrame, by: str, copy_fields: List[str]
+) -> gpd.GeoDataFrame:
+    """
+    Dissolve a layer by a field (equivalent of mapshaper's -dissolve) :
+    polygons are merged with GEOS' coverage union, POPULATION is summed and
+    copy_fields are copied from the first feature of each group.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        The layer to dissolve
+    by : str
+        The field to dissolve by
+    copy_fields : List[str]
+        The fields to copy (missing fields are ignored)
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        The dissolved layer
+
+    """
+    aggfunc = {x: "first" for x in copy_fields if x != by and x in gdf.columns}
+    if "POPULATION" in gdf.columns:
+        aggfunc["POPULATION"] = "sum"
+
+    gdf = gdf[[by, *aggfunc, "geometry"]]
+    dissolved = gdf.dissolve(
+        by=by, aggfunc=aggfunc, method="coverage", dropna=False, sort=False
+    )
+    return dissolved.reset_index()[[by, *aggfunc, "geometry"]]
+
+
+def dissolve(
+    gdf: gpd.GeoDataFrame,
+    niveau_polygons: str = "DEPARTEMENT",
+    niveau_agreg: str = "DEPARTEMENT",
+    dict_corresp: dict = DICT_CORRESP_ADMINEXPRESS,
+) -> gpd.GeoDataFrame:
+    """
+    Dissolve the (enriched) commune layer into niveau_polygons, keeping the
+    fields needed to split it by niveau_agreg (equivalent of
+    dissolve_commands).
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        The enriched layer
+    niveau_polygons : str, optional
+        The level of the resulting polygons. The default is "DEPARTEMENT".
+    niveau_agreg : str, optional
+        The level of aggregation of the later split. The default is
+        "DEPARTEMENT".
+    dict_corresp : dict, optional
+        A dictionary giving correspondance between levels and variable names.
+        The default is DICT_CORRESP_ADMINEXPRESS.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        The dissolved layer
+
+    """
+    copy_fields = [dict_corresp[niveau_agreg]]
+    copy_fields += [
+        dict_corresp[f"LIBELLE_{niveau}"]
+        for niveau in (niveau_polygons, niveau_agreg)
+        if dict_corresp.get(f"LIBELLE_{niveau}", "") != ""
+    ]
+    return dissolve_by(gdf, dict_corresp[niveau_polygons], copy_fields)
+
+
+def _coverage_simplify(geometries: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Simplify a coverage (polygons sharing their boundaries) without creating
+    gaps or overlaps, with GEOS' coverage simplification (Visvalingam-Whyatt)
+    if available (shapely >= 2.1, which needs python >= 3.10). Otherwise, the
+    arcs shared by the polygons are simplified with topojson (Douglas-Peucker,
+    without the guarantee that the polygons are still valid).
+    """
+    if hasattr(shapely, "coverage_simplify"):
+        return shapely.coverage_simplify(geometries, tolerance)
+    topology = topojson.Topology(
+        gpd.GeoDataFrame(geometry=geometries),
+        prequantize=False,
+        toposimplify=tolerance,
+    )
+    return np.asarray(topology.to_gdf().geometry.values)
+
+
+def simplify(gdf: gpd.GeoDataFrame, percentage: float) -> gpd.GeoDataFrame:
+    """
+    Simplify a layer while preserving it's topology (equivalent of
+    mapshaper's -simplify {percentage}%), with GEOS' coverage
+    simplification. The tolerance retaining approximately the given
+    percentage of vertices is estimated on a sample of the geometries.
+
+    The result is close to, but not the same as, mapshaper's : mapshaper
+    retains exactly {percentage}% of the removable vertices (the vertices
+    shared by three polygons or more are never removed), ranked by their
+    weighted Visvalingam effective area. Here, a single tolerance is
+    applied (plain Visvalingam-Whyatt), retaining approximately
+    {percentage}% of all the vertices.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        The layer to simplify
+    percentage : float
+        Percentage of vertices to retain
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        The simplified layer
+
+    """
+    if not percentage or percentage >= 100 or gdf.empty:
+        return gdf
+
+    geometries = gdf.geometry.values
+    sample = geometries
+    if len(sample) > SIMPLIFY_SAMPLE_SIZE:
+        rng = np.random.default_rng(0)
+        sample = sample[rng.choice(len(sample), SIMPLIFY_SAMPLE_SIZE, replace=False)]
+    sample = np.asarray(sample)
+    target = shapely.get_num_coordinates(sample).sum() * percentage / 100
+
+    # Bisection (on a log scale) of the tolerance
+    xmin, ymin, xmax, ymax = gdf.total_bounds
+    low, high = max(xmax - xmin, ymax - ymin) * 1e-9, max(xmax - xmin, ymax - ymin)
+    for _ in range(30):
+        tolerance = np.sqrt(low * high)
+        simplified = _coverage_simplify(sample, tolerance)
+        if shapely.get_num_coordinates(simplified).sum() > target:
+            low = tolerance
+        else:
+            high = tolerance
+        if high / low < 1.05:
+            break
+
+    logger.debug(f"simplifying with tolerance {tolerance}")
+    simplified = _coverage_simplify(np.asarray(geometries), tolerance)
+    return gdf.set_geometry(gpd.GeoSeries(simplified, index=gdf.index, crs=gdf.crs))
+
+
+def _split_name(value) -> str:
+    "Name of a part, as mapshaper's -split"
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if value is None or pd.isna(value):
+        return "null"
+    return str(value)
+
+
+def write(gdf: gpd.GeoDataFrame, path: str, format_output: str) -> None:
+    """
+    Write a layer to a file.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        The layer to write
+    path : str
+        The path of the file
+    format_output : str
+        The format : "topojson", "geojson", "gpkg", "shp" or "parquet"
+
+    """
+    if format_output == "topojson":
+        topology = topojson.Topology(gdf, prequantize=False)
+        with open(path, "w", encoding="utf8") as f:
+            f.write(topology.to_json())
+    elif format_output == "parquet":
+        gdf.to_parquet(path)
+    else:
+        drivers = {"geojson": "GeoJSON", "gpkg": "GPKG", "shp": "ESRI Shapefile"}
+        gdf.to_file(path, driver=drivers[format_output], engine="pyogrio")
+
+
+def split(
+    gdf: gpd.GeoDataFrame,
+    split_variable: str = "DEPARTEMENT",
+    output_path: str = "temp",
+    format_output: str = "geojson",
+    crs: int = 4326,
+    simplification: float = 0,
+    source_identifier: str = "",
+) -> List[str]:
+    """
+    Reproject, simplify and split a layer, and write each part to it's own
+    file (equivalent of split_commands).
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        The layer to split
+    split_variable : str, optional
+        The variable used for splitting the layer. The default is
+        "DEPARTEMENT".
+    output_path : str, optional
+        The directory for the output files. The default is "temp".
+    format_output : str, optional
+        The format for the output files. The default is "geojson".
+    crs : int, optional
+        The coordinate reference system EPSG code. The default is 4326.
+    simplification : float, optional
+        Percentage of vertices to retain (0 for no simplification). The
+        default is 0.
+    source_identifier : str, optional
+        Identifier for the data source. The default is "".
+
+    Returns
+    -------
+    List[str]
+        Paths of the written files
+
+    """
+    os.makedirs(output_path, exist_ok=True)
+    gdf = simplify(gdf.to_crs(crs), simplification)
+    gdf["SOURCE"] = source_identifier
+
+    written = []
+    keys = gdf[split_variable].map(_split_name)
+    for name, part in gdf.groupby(keys, sort=False):
+        path = f"{output_path}/{name}.{format_output}"
+        write(part.reset_index(drop=True), path, format_output)
+        written.append(path)
+    return written
@@ -1,6 +1,7 @@
-import subprocess
 import os
 
+from .mapshaper_wrangling import mapshaper_command, run_mapshaper
+
 logical_conditions = {
     "EMPRISES": {
         "metropole": "bbox=-572324.2901945524,5061666.243842439,1064224.7522608414,6638201.7541528195",
@@ -11,32 +12,36 @@ logical_conditions = {
         "mayotte": 'bbox=5011418.778972076,-1460351.1566339568,5042772.003914668,-1418243.6428180535'
     },
     "DEPARTEMENT": {
-        "ile de france": "['75', '92', '93', '94'].includes(INSEE_DEP)",
+        "ile de france": ("INSEE_DEP", ["75", "92", "93", "94"]),
         "zoom idf": 4,
     },
     "REGION": {
-        "ile de france": "INSEE_REG == 11",
+        "ile de france": ("INSEE_REG", ["11"]),
         "zoom idf": 1.5
     },
     "BASSIN_VIE": {
-        "ile de france": "BV2012 == 75056",
+        "ile de france": ("BV2012", ["75056"]),
         "zoom idf": 1.5
     },
     "UNITE_URBAINE": {
-        "ile de france": "UU2020 == '00851'",
+        "ile de france": ("UU2020", ["00851"]),
         "zoom idf": 1.5
     },
     "ZONE_EMPLOI": {
-        "ile de france": 'ZE2020 == 1109',
+        "ile de france": ("ZE2020", ["1109"]),
         "zoom idf": 1.5
     },
     "AIRE_ATTRACTION_VILLES": {
-        "ile de france": "AAV2020 == '001'",
+        "ile de france": ("AAV2020", ["001"]),
         "zoom idf": 1.5
     }
 
 }
 
+# Nota : "ile de france" is given as (field, values), from which both the
+# mapshaper expression (see ile_de_france_expression) and the in-process mask
+# (see cartiflette.geoprocessing.closer) are derived
+
 shift = {
     'guadeloupe': '6355000,3330000',
     'martinique': '6480000,3505000',
@@ -54,81 +59,91 @@ scale = {
 }
 
 
-def mapshaper_bring_closer(
-    france_vector_path="temp.geojson",
-    level_agreg="DEPARTEMENT"
-    ):
-
-    output_path = "temp/preprocessed_transformed/idf_combined.geojson"
-    output_dir = os.path.dirname(output_path)
-
-    logical_idf = logical_conditions[level_agreg]["ile de france"]
+def ile_de_france_expression(field, values):
+    """
+    Mapshaper expression selecting the features whose field equals one of
+    the values. Javascript's loose equality is used, so numeric fields match
+    too (1109 == '1109').
+
+    Parameters
+    ----------
+    field : str
+        Field to test.
+    values : list
+        Accepted values (as strings).
+
+    Returns
+    -------
+    str
+        The mapshaper expression.
+
+    """
+    return " || ".join(f"{field} == '{value}'" for value in values)
+
+
+def bring_closer_commands(level_agreg="DEPARTEMENT"):
+    """
+    Mapshaper commands bringing the DROM (and a zoom on Ile-de-France)
+    closer to metropolitan France, all in memory : each area is copied from
+    the source layer (filter with `+`), moved (affine) and the copies are
+    then merged into a single layer.
+
+    Parameters
+    ----------
+    level_agreg : str, optional
+        Level used to select Ile-de-France (see logical_conditions). The
+        default is "DEPARTEMENT".
+
+    Returns
+    -------
+    str
+        The mapshaper commands.
+
+    """
+    logical_idf = ile_de_france_expression(
+        *logical_conditions[level_agreg]["ile de france"]
+    )
     zoom_idf = logical_conditions[level_agreg]["zoom idf"]
     logical_metropole = logical_conditions["EMPRISES"]["metropole"]
 
-    idf_zoom = (
-        f"mapshaper -i {france_vector_path} "
-        f"-proj EPSG:3857 "
-        f'-filter "{logical_idf}" '
-        f"-affine shift=-650000,275000 scale={zoom_idf} "
-        f"-o {output_dir}/idf_zoom.geojson"
-    )
-
-    france_metropolitaine = (
-        f"mapshaper -i {france_vector_path} "
-        f"-proj EPSG:3857 "
-        f'-filter "{logical_metropole}" '
-        f"-o {output_dir}/metropole.geojson"
-    )
+    commands = [
+        "-rename-layers SOURCE",
+        "-proj EPSG:3857",
+        f'-filter "{logical_metropole}" target=SOURCE + name=FRANCE',
+        f'-filter "{logical_idf}" target=SOURCE + name=IDF',
+        f"-affine shift=-650000,275000 scale={zoom_idf} target=IDF",
+    ]
+    for region, shift_value in shift.items():
+        commands += [
+            f'-filter "{logical_conditions["EMPRISES"][region]}" '
+            f"target=SOURCE + name={region}",
+            f"-affine shift={shift_value} scale={scale[region]} target={region}",
+        ]
+    layers = ",".join(["FRANCE", "IDF", *shift])
+    # Nota : the merged layer is left unnamed, as the source layer (-split
+    # would otherwise prefix the names of the parts with the layer's name)
+    commands += [
+        "-drop target=SOURCE",
+        f"-merge-layers target={layers} force",
+        "-proj wgs84",
+        "-rename-layers ''",
+    ]
+    return " ".join(commands)
 
-    subprocess.run(
-        idf_zoom,
-        shell=True,
-        check=True,
-    )
 
-    subprocess.run(
-        france_metropolitaine,
-        shell=True,
-        check=True,
-    )
+def mapshaper_bring_closer(
+    france_vector_path="temp.geojson",
+    level_agreg="DEPARTEMENT"
+    ):
 
-    for region, shift_value in shift.items():
-        print(f"Processing {region}")
-        cmd = (
-            f"mapshaper -i {france_vector_path} "
-            f"-proj EPSG:3857 "
-            f'-filter "{logical_conditions["EMPRISES"][region]}" '
-            f'-affine shift={shift_value} scale={scale[region]} '
-            f"-o {output_dir}/{region}.geojson"
-        )
-        subprocess.run(
-            cmd,
-            shell=True,
-            check=True,
-        )
-
-    cmd_combined = (
-        f"mapshaper "
-        f"{output_dir}/metropole.geojson "
-        f"{output_dir}/idf_zoom.geojson "
-        f"{output_dir}/guadeloupe.geojson "
-        f"{output_dir}/martinique.geojson "
-        f"{output_dir}/guyane.geojson "
-        f"{output_dir}/reunion.geojson "
-        f"{output_dir}/mayotte.geojson "
-        f"snap combine-files "
-        f'-proj wgs84 init="EPSG:3857" target=* '
-        f"-rename-layers FRANCE,IDF,GDP,MTQ,GUY,REU,MAY "
-        f"-merge-layers target=FRANCE,IDF,GDP,MTQ,GUY,REU,MAY force "
-        f"-rename-layers FRANCE_TRANSFORMED "
-        f"-o {output_dir}/idf_combined.geojson "
-    )
+    output_path = "temp/preprocessed_transformed/idf_combined.geojson"
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    subprocess.run(
-        cmd_combined,
-        shell=True,
-        check=True,
+    cmd = mapshaper_command(
+        f"-i {france_vector_path}",
+        bring_closer_commands(level_agreg),
+        f"-o {output_path}",
     )
+    run_mapshaper(cmd)
 
-    return f"{output_dir}/idf_combined.geojson"
\ No newline at end of file
+    return output_path
@@ -0,0 +1,109 @@
+// Long-lived mapshaper worker, driven by cartiflette/mapshaper/mapshaper_worker.py
+//
+// Reads one JSON request per line on stdin :
+//     {"id": 1, "args": ["-i", "input.geojson", "-proj", "EPSG:4326", ...]}
+// runs it through mapshaper's programmatic API (one request at a time) and
+// answers one JSON line on the file descriptor given as second argument (a
+// pipe dedicated to the protocol, so that anything written on stdout by
+// mapshaper or its dependencies can't be mistaken for an answer) :
+//     {"id": 1, "ok": true} or {"id": 1, "ok": false, "error": "..."}
+//
+// Input files are kept in memory between requests (invalidated when the file
+// is modified), up to a maximum volume given (in bytes) as first argument
+// (0 to disable the cache).
+
+const fs = require("fs");
+const path = require("path");
+const readline = require("readline");
+const mapshaper = require("mapshaper");
+
+const maxCacheSize = Number(process.argv[2] || 0);
+const channel = Number(process.argv[3]);
+
+const send = (message) => fs.writeSync(channel, JSON.stringify(message) + "\n");
+
+// Shapefiles are read along with their auxiliary files
+const SHAPEFILE_EXTENSIONS = [".shp", ".shx", ".dbf", ".prj", ".cpg"];
+
+const cache = new Map();
+let cacheSize = 0;
+
+function inputFiles(args) {
+  // Files given to -i (or before the first command) and to -join
+  const files = [];
+  let reading = true;
+  for (let i = 0; i < args.length; i++) {
+    const arg = args[i];
+    if (arg === "-i") {
+      reading = true;
+    } else if (arg === "-join") {
+      if (i + 1 < args.length) files.push(args[i + 1]);
+      reading = false;
+    } else if (arg.startsWith("-")) {
+      reading = false;
+    } else if (reading && !arg.includes("=") && !arg.includes(" ")) {
+      files.push(arg);
+    }
+  }
+  const expanded = [];
+  for (const file of files) {
+    if (path.extname(file).toLowerCase() === ".shp") {
+      const root = file.slice(0, -4);
+      const extension = path.extname(file);
+      for (const ext of SHAPEFILE_EXTENSIONS) {
+        const sibling = root + (extension === ".SHP" ? ext.toUpperCase() : ext);
+        if (fs.existsSync(sibling)) expanded.push(sibling);
+      }
+    } else if (fs.existsSync(file)) {
+      expanded.push(file);
+    }
+  }
+  return expanded;
+}
+
+function load(file) {
+  const mtime = fs.statSync(file).mtimeMs;
+  const cached = cache.get(file);
+  if (cached && cached.mtime === mtime) {
+    // refresh position (least recently used are evicted first)
+    cache.delete(file);
+    cache.set(file, cached);
+    return cached.content;
+  }
+  if (cached) {
+    cache.delete(file);
+    cacheSize -= cached.content.length;
+  }
+  const content = fs.readFileSync(file);
+  if (content.length <= maxCacheSize) {
+    cache.set(file, { mtime, content });
+    cacheSize += content.length;
+    for (const [key, value] of cache) {
+      if (cacheSize <= maxCacheSize) break;
+      cache.delete(key);
+      cacheSize -= value.content.length;
+    }
+  }
+  return content;
+}
+
+async function run(request) {
+  // mapshaper consumes the contents it is given : pass a fresh object
+  const input = {};
+  for (const file of inputFiles(request.args)) {
+    input[file] = load(file);
+  }
+  await mapshaper.runCommands(request.args, input);
+}
+
+let queue = Promise.resolve();
+readline.createInterface({ input: process.stdin }).on("line", (line) => {
+  if (!line.trim()) return;
+  const request = JSON.parse(line);
+  queue = queue
+    .then(() => run(request))
+    .then(
+      () => send({ id: request.id, ok: true }),
+      (error) => send({ id: request.id, ok: false, error: String(error) })
+    );
+});
@@ -0,0 +1,306 @@
+"""
+Long-lived mapshaper workers : Node processes running mapshaper's
+programmatic API, to which mapshaper command lines are sent one after the
+other (see mapshaper_worker.js). Node startup and mapshaper loading are paid
+once per worker, and input files can be kept in memory between commands.
+Each Python process gets a small pool of workers, so that threads can run
+commands concurrently.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import shlex
+import shutil
+import subprocess
+import threading
+from typing import Optional
+
+from cartiflette.config import (
+    MAPSHAPER_WORKER,
+    MAPSHAPER_WORKERS,
+    MAPSHAPER_WORKER_CACHE_SIZE,
+    MAPSHAPER_WORKER_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), "mapshaper_worker.js")
+
+
+class MapshaperWorkerUnavailable(Exception):
+    "Raised when the worker can't be started or has died"
+
+
+class MapshaperWorker:
+    """
+    Handle on a mapshaper worker process. Commands are sent through stdin
+    and acknowledged through a pipe dedicated to the protocol (one JSON line
+    each) ; the worker is thread-safe, commands being run one at a time (see
+    MapshaperWorkerPool to run commands concurrently).
+    """
+
+    def __init__(
+        self,
+        cache_size: int = MAPSHAPER_WORKER_CACHE_SIZE,
+        timeout: float = MAPSHAPER_WORKER_TIMEOUT,
+    ):
+        """
+        Initialize the worker (lazily : the Node process is started on the
+        first command).
+
+        Parameters
+        ----------
+        cache_size : int, optional
+            Maximum volume (in bytes) of input files kept in memory by the
+            worker, 0 to disable the cache. The default is
+            MAPSHAPER_WORKER_CACHE_SIZE.
+        timeout : float, optional
+            Maximum duration (in seconds) of a command : past this deadline,
+            the worker is killed (and restarted on the next command). None
+            to wait indefinitely. The default is MAPSHAPER_WORKER_TIMEOUT.
+
+        """
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.process = None
+        self._responses = None
+        self._id = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _node_path() -> str:
+        # mapshaper is installed globally (npm link) : make it importable
+        node_path = os.environ.get("NODE_PATH")
+        if node_path:
+            return node_path
+        npm = shutil.which("npm")
+        if not npm:
+            return ""
+        try:
+            return subprocess.run(
+                [npm, "root", "-g"], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except subprocess.CalledProcessError:
+            return ""
+
+    @staticmethod
+    def _read_responses(channel, responses: queue.Queue) -> None:
+        # Forward the answers of the worker to run (None once it has died)
+        with channel:
+            for line in channel:
+                responses.put(line)
+        responses.put(None)
+
+    def start(self) -> None:
+        """
+        Start the Node process.
+
+        Raises
+        ------
+        MapshaperWorkerUnavailable
+            If node (or mapshaper) is not available.
+
+        """
+        node = shutil.which("node")
+        if not node:
+            raise MapshaperWorkerUnavailable("node not found")
+        env = {**os.environ, "NODE_PATH": self._node_path()}
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                [node, WORKER_SCRIPT, str(self.cache_size), str(write_fd)],
+                stdin=subprocess.PIPE,
+                text=True,
+                bufsize=1,
+                env=env,
+                pass_fds=(write_fd,),
+            )
+        except OSError as e:
+            os.close(read_fd)
+            raise MapshaperWorkerUnavailable(str(e))
+        finally:
+            os.close(write_fd)
+        self._responses = queue.Queue()
+        threading.Thread(
+            target=self._read_responses,
+            args=(os.fdopen(read_fd), self._responses),
+            daemon=True,
+        ).start()
+        logger.debug(f"mapshaper worker started (pid {self.process.pid})")
+
+    def _kill(self) -> None:
+        self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def run(self, cmd: str) -> None:
+        """
+        Run a mapshaper command line in the worker.
+
+        Parameters
+        ----------
+        cmd : str
+            The command line (as it would be given to the shell, starting with
+            "mapshaper").
+
+        Raises
+        ------
+        subprocess.CalledProcessError
+            If mapshaper failed to run the command (as would the CLI).
+        subprocess.TimeoutExpired
+            If the command didn't complete before the worker's timeout (the
+            worker is then restarted on the next command).
+        MapshaperWorkerUnavailable
+            If the worker can't be started or has died ; the command was not
+            run.
+
+        """
+        args = shlex.split(cmd)
+        if args and args[0] == "mapshaper":
+            args = args[1:]
+
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            self._id += 1
+            request = {"id": self._id, "args": args}
+            try:
+                self.process.stdin.write(json.dumps(request) + "\n")
+                self.process.stdin.flush()
+                line = self._responses.get(timeout=self.timeout)
+            except (BrokenPipeError, OSError) as e:
+                raise MapshaperWorkerUnavailable(str(e))
+            except queue.Empty:
+                logger.error(
+                    f"mapshaper worker timed out after {self.timeout}s, "
+                    "restarting it"
+                )
+                self._kill()
+                raise subprocess.TimeoutExpired(cmd, self.timeout)
+            if not line:
+                raise MapshaperWorkerUnavailable("mapshaper worker died")
+
+        response = json.loads(line)
+        if not response["ok"]:
+            logger.error(response["error"])
+            raise subprocess.CalledProcessError(1, cmd, stderr=response["error"])
+
+    def close(self) -> None:
+        "Stop the Node process"
+        with self._lock:
+            if self.process is not None and self.process.poll() is None:
+                self.process.stdin.close()
+                try:
+                    self.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+            self.process = None
+
+
+class MapshaperWorkerPool:
+    """
+    Pool of mapshaper workers : each command is run by an idle worker (the
+    most recently used one, whose cache is the most likely to be relevant),
+    at most `size` commands running concurrently.
+    """
+
+    def __init__(
+        self,
+        size: int = MAPSHAPER_WORKERS,
+        cache_size: int = MAPSHAPER_WORKER_CACHE_SIZE,
+        timeout: float = MAPSHAPER_WORKER_TIMEOUT,
+    ):
+        """
+        Initialize the pool (lazily : workers are started as needed).
+
+        Parameters
+        ----------
+        size : int, optional
+            Maximum number of workers. The default is MAPSHAPER_WORKERS.
+        cache_size : int, optional
+            Maximum volume (in bytes) of input files kept in memory by each
+            worker. The default is MAPSHAPER_WORKER_CACHE_SIZE.
+        timeout : float, optional
+            Maximum duration (in seconds) of a command. The default is
+            MAPSHAPER_WORKER_TIMEOUT.
+
+        """
+        self.size = max(size, 1)
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.workers = []
+        self._idle = queue.LifoQueue()
+        self._slots = threading.Semaphore(self.size)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _checkout(self) -> MapshaperWorker:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            worker = MapshaperWorker(self.cache_size, self.timeout)
+            with self._lock:
+                self.workers.append(worker)
+            return worker
+
+    def run(self, cmd: str) -> None:
+        """
+        Run a mapshaper command line on an idle worker (waiting for one if
+        all are busy). See MapshaperWorker.run.
+        """
+        with self._slots:
+            worker = self._checkout()
+            try:
+                worker.run(cmd)
+            finally:
+                self._idle.put(worker)
+
+    def close(self) -> None:
+        "Stop the workers' Node processes"
+        with self._lock:
+            for worker in self.workers:
+                worker.close()
+
+
+_worker = None
+_worker_pid = None
+_worker_lock = threading.Lock()
+
+
+def get_mapshaper_worker() -> Optional[MapshaperWorkerPool]:
+    """
+    Get the mapshaper workers of the current process (each process of a pool
+    gets it's own), or None if the workers are deactivated or unavailable.
+    """
+    global _worker, _worker_pid
+    if not MAPSHAPER_WORKER:
+        return None
+    with _worker_lock:
+        if _worker_pid != os.getpid():
+            _worker = MapshaperWorkerPool()
+            _worker_pid = os.getpid()
+            atexit.register(_worker.close)
+        return _worker
+
+
+def disable_mapshaper_worker() -> None:
+    "Stop using the workers in the current process (fallback to the CLI)"
+    global _worker
+    with _worker_lock:
+        if _worker is not None:
+            _worker.close()
+        _worker = None
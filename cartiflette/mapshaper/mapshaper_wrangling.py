@@ -1,9 +1,204 @@
 """
 Data wrangling (geo)operations wrappers from mapshaper.
+
+Each operation is available both as a standalone wrapper (which runs
+mapshaper on files) and as a command builder returning the mapshaper
+commands of the operation, so that several operations can be chained in a
+single mapshaper invocation (see mapshaper_command) : the data is then
+parsed once, processed in memory and written once.
 """
 
+import logging
 import subprocess
 from cartiflette.utils import DICT_CORRESP_ADMINEXPRESS
+from .mapshaper_worker import (
+    MapshaperWorkerUnavailable,
+    get_mapshaper_worker,
+    disable_mapshaper_worker,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def mapshaper_command(input_file: str, *steps: str, layer_name: str = "") -> str:
+    """
+    Compose a single mapshaper invocation from an input file and a sequence
+    of mapshaper commands (as returned by the *_commands builders).
+
+    Parameters:
+    - input_file (str): The input file(s) to be read by mapshaper.
+    - steps (str): Mapshaper commands to chain, in order. Empty steps are
+      ignored.
+    - layer_name (str): The name of the layer read from the input file
+      (default is "").
+
+    Returns:
+    - str: The mapshaper command line.
+    """
+    steps = [step.strip() for step in steps if step and step.strip()]
+    return " ".join([f"mapshaper {input_file} name='{layer_name}'"] + steps)
+
+
+def run_mapshaper(cmd: str) -> None:
+    """
+    Run a mapshaper command line, through the process' long-lived mapshaper
+    worker if available (see MAPSHAPER_WORKER), else through the CLI.
+
+    Parameters:
+    - cmd (str): The command line, as returned by mapshaper_command.
+
+    Returns:
+    - None
+    """
+    worker = get_mapshaper_worker()
+    if worker is not None:
+        try:
+            return worker.run(cmd)
+        except MapshaperWorkerUnavailable as e:
+            logger.warning(f"mapshaper worker unavailable ({e}), using the CLI")
+            disable_mapshaper_worker()
+
+    subprocess.run(cmd, shell=True, check=True)
+
+
+def enrich_commands(
+    metadata_file: str = "temp/tagc.csv",
+    dict_corresp: dict = DICT_CORRESP_ADMINEXPRESS,
+) -> str:
+    """
+    Mapshaper commands enriching the commune layer with the COG metadata.
+
+    Parameters:
+    - metadata_file (str): The path of the csv metadata file to join
+      (default is "temp/tagc.csv").
+    - dict_corresp (dict): A dictionary containing correspondences for field renaming
+      and value assignment (default is DICT_CORRESP_ADMINEXPRESS).
+
+    Returns:
+    - str: The mapshaper commands.
+    """
+    return (
+        "-proj EPSG:4326 "
+        f"-join {metadata_file} "
+        f"keys=INSEE_COM,CODGEO field-types=INSEE_COM:str,CODGEO:str "
+        f"-filter-fields INSEE_CAN,INSEE_ARR,SIREN_EPCI,INSEE_DEP,INSEE_REG,NOM_M invert "
+        f"-rename-fields INSEE_DEP=DEP,INSEE_REG=REG "
+        f"-each \"{dict_corresp['FRANCE_ENTIERE']}='France'\""
+    )
+
+
+def dissolve_commands(
+    niveau_polygons: str = "DEPARTEMENT",
+    niveau_agreg: str = "DEPARTEMENT",
+    dict_corresp: dict = DICT_CORRESP_ADMINEXPRESS,
+) -> str:
+    """
+    Mapshaper commands dissolving the (enriched) commune layer into
+    niveau_polygons, keeping the fields needed to split it by niveau_agreg.
+
+    Parameters:
+    - niveau_polygons (str): The level of the resulting polygons (default is
+      "DEPARTEMENT").
+    - niveau_agreg (str): The level of aggregation of the later split (default
+      is "DEPARTEMENT").
+    - dict_corresp (dict): A dictionary giving correspondance between levels
+      and variable names (default is DICT_CORRESP_ADMINEXPRESS).
+
+    Returns:
+    - str: The mapshaper commands.
+    """
+    list_vars = [dict_corresp[niveau_polygons], dict_corresp[niveau_agreg]]
+    list_vars += [
+        dict_corresp[f"LIBELLE_{niveau}"]
+        for niveau in (niveau_polygons, niveau_agreg)
+        if dict_corresp.get(f"LIBELLE_{niveau}", "") != ""
+    ]
+    return (
+        f"-dissolve {dict_corresp[niveau_polygons]} "
+        f"calc='POPULATION=sum(POPULATION)' "
+        f"copy-fields={','.join(list_vars)}"
+    )
+
+
+def split_commands(
+    split_variable: str = "DEPARTEMENT",
+    output_path: str = "temp2.geojson",
+    format_output: str = "geojson",
+    crs: int = 4326,
+    option_simplify: str = "",
+    source_identifier: str = "",
+) -> str:
+    """
+    Mapshaper commands reprojecting, simplifying and splitting a layer, and
+    writing each part to it's own file.
+
+    Parameters:
+    - split_variable (str): The variable used for splitting the layer
+      (default is "DEPARTEMENT").
+    - output_path (str): The path for the output files (default is
+      "temp2.geojson").
+    - format_output (str): The format for the output files (default is "geojson").
+    - crs (int): The coordinate reference system EPSG code (default is 4326).
+    - option_simplify (str): Additional options for simplifying geometries (default is "").
+    - source_identifier (str): Identifier for the data source (default is "").
+
+    Returns:
+    - str: The mapshaper commands.
+    """
+    return (
+        f"-proj EPSG:{crs} "
+        f"{option_simplify}"
+        f"-each \"SOURCE='{source_identifier}'\" "
+        f"-split {split_variable} "
+        f'-o {output_path} format={format_output} extension=".{format_output}" singles'
+    )
+
+
+def multi_split_commands(
+    split_variable: str = "DEPARTEMENT",
+    outputs: dict = {},
+    crs: int = 4326,
+    source_identifier: str = "",
+) -> str:
+    """
+    Mapshaper commands reprojecting a layer once, then simplifying it
+    progressively and splitting it to each format, for several simplification
+    levels and formats (equivalent of split_commands for each output).
+
+    Parameters:
+    - split_variable (str): The variable used for splitting the layer
+      (default is "DEPARTEMENT").
+    - outputs (dict): The output directory of each (format, simplification),
+      ordered from the least to the most simplified (see
+      cartiflette.utils.split_outputs).
+    - crs (int): The coordinate reference system EPSG code (default is 4326).
+    - source_identifier (str): Identifier for the data source (default is "").
+
+    Returns:
+    - str: The mapshaper commands.
+    """
+    # Nota : -simplify only sets the retained vertices of the (shared) arcs,
+    # the layer being copied (and the copy split, written and dropped) for
+    # each output
+    commands = [
+        f"-proj EPSG:{crs}",
+        f"-each \"SOURCE='{source_identifier}'\"",
+        "-rename-layers SPLIT_SOURCE",
+    ]
+    current_simplification = 0
+    for (format_output, simplification), output_path in outputs.items():
+        if (simplification or 0) != current_simplification:
+            commands.append(f"-simplify {simplification}% target=SPLIT_SOURCE")
+            current_simplification = simplification
+        commands += [
+            "-filter true target=SPLIT_SOURCE + name=SPLIT_PART",
+            "-rename-layers '' target=SPLIT_PART",
+            f"-split {split_variable}",
+            f'-o {output_path} format={format_output} extension=".{format_output}" '
+            "singles",
+            "-drop",
+        ]
+    return " ".join(commands)
 
 
 def mapshaper_enrich(
@@ -35,19 +230,14 @@ def mapshaper_enrich(
     """
 
     # Mapshaper command for the enrichment process
-    cmd_step1 = (
-        f"mapshaper {local_dir}/{filename_initial}.{extension_initial} "
-        f"name='' -proj EPSG:4326 "
-        f"-join {metadata_file} "
-        f"keys=INSEE_COM,CODGEO field-types=INSEE_COM:str,CODGEO:str "
-        f"-filter-fields INSEE_CAN,INSEE_ARR,SIREN_EPCI,INSEE_DEP,INSEE_REG,NOM_M invert "
-        f"-rename-fields INSEE_DEP=DEP,INSEE_REG=REG "
-        f"-each \"{dict_corresp['FRANCE_ENTIERE']}='France'\" "
-        f"-o {output_path}"
+    cmd_step1 = mapshaper_command(
+        f"{local_dir}/{filename_initial}.{extension_initial}",
+        enrich_commands(metadata_file, dict_corresp),
+        f"-o {output_path}",
     )
 
     # Run Mapshaper command
-    subprocess.run(cmd_step1, shell=True, check=True)
+    run_mapshaper(cmd_step1)
 
 
 def mapshaper_split(
@@ -80,13 +270,18 @@ def mapshaper_split(
     """
 
     # Mapshaper command for the splitting process
-    cmd_step2 = (
-        f"mapshaper {input_file} name='{layer_name}' -proj EPSG:{crs} "
-        f"{option_simplify}"
-        f"-each \"SOURCE='{source_identifier}'\" "
-        f"-split {split_variable} "
-        f'-o {output_path} format={format_output} extension=".{format_output}" singles'
+    cmd_step2 = mapshaper_command(
+        input_file,
+        split_commands(
+            split_variable,
+            output_path,
+            format_output,
+            crs,
+            option_simplify,
+            source_identifier,
+        ),
+        layer_name=layer_name,
     )
 
     # Run Mapshaper command
-    subprocess.run(cmd_step2, shell=True, check=True)
+    run_mapshaper(cmd_step2)
@@ -1,9 +1,36 @@
 import os
-import subprocess
 
-from cartiflette.utils import DICT_CORRESP_ADMINEXPRESS
-from .mapshaper_wrangling import mapshaper_enrich, mapshaper_split
-from .mapshaper_closer import mapshaper_bring_closer
+from cartiflette.utils import DICT_CORRESP_ADMINEXPRESS, split_outputs
+from .mapshaper_wrangling import (
+    mapshaper_command,
+    run_mapshaper,
+    enrich_commands,
+    dissolve_commands,
+    split_commands,
+    multi_split_commands,
+)
+from .mapshaper_closer import bring_closer_commands
+
+
+def _split_steps(
+    outputs: dict, split_variable: str, crs: int, source_identifier: str
+) -> str:
+    "Split commands for one output (split_commands) or several outputs"
+    if len(outputs) > 1:
+        return multi_split_commands(split_variable, outputs, crs, source_identifier)
+
+    ((format_output, simplification), output_path), = outputs.items()
+    option_simplify = ""
+    if simplification:
+        option_simplify = f"-simplify {simplification}% "
+    return split_commands(
+        split_variable=split_variable,
+        output_path=output_path,
+        format_output=format_output,
+        crs=crs,
+        option_simplify=option_simplify,
+        source_identifier=source_identifier,
+    )
 
 
 def mapshaperize_split(
@@ -30,8 +57,8 @@ def mapshaperize_split(
         The initial filename, by default "COMMUNE".
     extension_initial : str, optional
         The initial file extension, by default "shp".
-    format_output : str, optional
-        The output format, by default "topojson".
+    format_output : str or list of str, optional
+        The output format(s), by default "topojson".
     niveau_agreg : str, optional
         The level of aggregation for the split, by default "DEPARTEMENT".
     provider : str, optional
@@ -46,99 +73,69 @@ def mapshaperize_split(
         The territory of the data, by default "metropole".
     crs : int, optional
         The coordinate reference system (CRS) code, by default 4326.
-    simplification : int, optional
-        The degree of simplification, by default 0.
+    simplification : int or list of int, optional
+        The degree(s) of simplification, by default 0.
     dict_corresp: dict
         A dictionary giving correspondance between niveau_agreg argument
         and variable names.
 
     Returns
     -------
-    str
-        The output path of the processed and split shapefiles.
+    str or dict
+        The output path of the processed and split shapefiles (the output path
+        of each (format, simplification) if several formats or simplification
+        levels are given, which are all produced from a single loading of the
+        layer, simplified progressively).
 
     """
 
-    simplification_percent = simplification if simplification is not None else 0
-
     # City level borders, file location
     directory_city = config_file_city.get("location", local_dir)
     initial_filename_city = config_file_city.get("filename", "COMMUNE")
     extension_initial_city = config_file_city.get("extension", "shp")
 
-    output_path = (
-        f"{local_dir}/{territory}/{niveau_agreg}/{format_output}/{simplification=}"
+    outputs = split_outputs(
+        local_dir, territory, niveau_agreg, format_output, simplification
     )
+    for output_path in outputs.values():
+        os.makedirs(output_path, exist_ok=True)
 
-    os.makedirs(output_path, exist_ok=True)
-
-    if simplification_percent != 0:
-        option_simplify = f"-simplify {simplification_percent}% "
-    else:
-        option_simplify = ""
+    # Nota : all steps are chained in a single mapshaper invocation, the
+    # data being parsed once and written once (no intermediate geojson)
+    steps = []
 
-    temp_filename = "temp.geojson"
-
-    # STEP 1: ENRICHISSEMENT AVEC COG
-    mapshaper_enrich(
-        local_dir=directory_city,
-        filename_initial=initial_filename_city,
-        extension_initial=extension_initial_city,
-        dict_corresp=dict_corresp,
-        output_path=temp_filename,
-    )
+    # STEP 1: ENRICHISSEMENT AVEC COG (UNLESS ALREADY ENRICHED)
+    if not config_file_city.get("enriched", False):
+        steps.append(enrich_commands(dict_corresp=dict_corresp))
 
+    # STEP 1B: DISSOLVE IF NEEDED
     if niveau_polygons != initial_filename_city:
-        csv_list_vars = (
-            f"{dict_corresp[niveau_polygons]}," f"{dict_corresp[niveau_agreg]}"
-        )
-        libelle_niveau_polygons = dict_corresp.get("LIBELLE_" + niveau_polygons, "")
-        if libelle_niveau_polygons != "":
-            libelle_niveau_polygons = f",{libelle_niveau_polygons}"
-        libelle_niveau_agreg = dict_corresp.get("LIBELLE_" + niveau_agreg, "")
-        if libelle_niveau_polygons != "":
-            libelle_niveau_agreg = f",{libelle_niveau_agreg}"
-        csv_list_vars = (
-            f"{csv_list_vars}{libelle_niveau_polygons}{libelle_niveau_agreg}"
-        )
-
-        # STEP 1B: DISSOLVE IF NEEDED
-        cmd_dissolve = (
-            f"mapshaper {temp_filename} "
-            f"name='' -proj EPSG:4326 "
-            f"-dissolve {dict_corresp[niveau_polygons]} "
-            f"calc='POPULATION=sum(POPULATION)' "
-            f"copy-fields={csv_list_vars} "
-            "-o temp.geojson force"
-        )
-        subprocess.run(cmd_dissolve, shell=True, check=True)
+        steps.append(dissolve_commands(niveau_polygons, niveau_agreg, dict_corresp))
 
     # IF WE DESIRE TO BRING "DROM" CLOSER TO FRANCE
     if niveau_agreg.upper() == "FRANCE_ENTIERE_DROM_RAPPROCHES":
         niveau_filter_drom = "DEPARTEMENT"
         if niveau_polygons != "COMMUNE":
             niveau_filter_drom = niveau_polygons
-        input_path = mapshaper_bring_closer(
-            temp_filename, level_agreg=niveau_filter_drom
-        )
-    else:
-        input_path = "temp.geojson"
-
-    print(input_path)
+        steps.append(bring_closer_commands(level_agreg=niveau_filter_drom))
 
     # STEP 2: SPLIT ET SIMPLIFIE
-    mapshaper_split(
-        input_file=input_path,
-        layer_name="",
-        split_variable=dict_corresp[niveau_agreg],
-        output_path=output_path,
-        format_output=format_output,
-        crs=crs,
-        option_simplify=option_simplify,
-        source_identifier=f"{provider}:{source}",
+    steps.append(
+        _split_steps(
+            outputs, dict_corresp[niveau_agreg], crs, f"{provider}:{source}"
+        )
     )
 
-    return output_path
+    run_mapshaper(
+        mapshaper_command(
+            f"{directory_city}/{initial_filename_city}.{extension_initial_city}",
+            *steps,
+        )
+    )
+
+    if isinstance(format_output, str) and not isinstance(simplification, (list, tuple)):
+        return output_path
+    return outputs
 
 
 def mapshaperize_split_merge(
@@ -154,7 +151,6 @@ def mapshaperize_split_merge(
     simplification=0,
     dict_corresp=DICT_CORRESP_ADMINEXPRESS,
 ):
-    simplification_percent = simplification if simplification is not None else 0
 
     # City level borders, file location
     directory_city = config_file_city.get("location", local_dir)
@@ -170,93 +166,55 @@ def mapshaperize_split_merge(
         "extension", "shp"
     )
 
-    # Intermediate output location
-    output_path = (
-        f"{local_dir}/{territory}/{niveau_agreg}/{format_output}/{simplification=}"
+    # Intermediate output location(s)
+    outputs = split_outputs(
+        local_dir, territory, niveau_agreg, format_output, simplification
     )
+    for output_path in outputs.values():
+        os.makedirs(output_path, exist_ok=True)
 
-    if simplification_percent != 0:
-        option_simplify = f"-simplify {simplification_percent}% "
-    else:
-        option_simplify = ""
-
-    format_intermediate = "geojson"
-
-    # PREPROCESS CITIES
     file_city = f"{directory_city}/{initial_filename_city}.{extension_initial_city}"
-    subprocess.run(
-        (
-            f"mapshaper {file_city} name='COMMUNE' "
-            f"-proj EPSG:4326 "
-            f"-filter '\"69123,13055,75056\".indexOf(INSEE_COM) > -1' invert "
-            f'-each "INSEE_COG=INSEE_COM" '
-            f"-o {output_path}/communes_simples.{format_intermediate} "
-            f'format={format_intermediate} extension=".{format_intermediate}" singles'
-        ),
-        shell=True,
-        check=True,
-    )
-
-    # PREPROCESS ARRONDISSEMENT
     file_arrondissement = (
         f"{directory_arrondissement}/"
         f"{initial_filename_arrondissement}.{extension_initial_arrondissement}"
     )
-    subprocess.run(
-        (
-            f"mapshaper {file_arrondissement} "
-            f"name='ARRONDISSEMENT_MUNICIPAL' "
-            f"-proj EPSG:4326 "
-            f"-rename-fields INSEE_COG=INSEE_ARM "
-            f"-each 'STATUT=\"Arrondissement municipal\" ' "
-            f"-o {output_path}/arrondissements.{format_intermediate} "
-            f'format={format_intermediate} extension=".{format_intermediate}"'
-        ),
-        shell=True,
-        check=True,
-    )
-
-    # MERGE CITIES AND ARRONDISSEMENT
-    subprocess.run(
-        (
-            f"mapshaper "
-            f"{output_path}/communes_simples.{format_intermediate} "
-            f"{output_path}/arrondissements.{format_intermediate} snap combine-files "
-            f"-proj EPSG:4326 "
-            f"-rename-layers COMMUNE,ARRONDISSEMENT_MUNICIPAL "
-            f"-merge-layers target=COMMUNE,ARRONDISSEMENT_MUNICIPAL force "
-            f"-rename-layers COMMUNE_ARRONDISSEMENT "
-            f"-o {output_path}/raw.{format_intermediate} "
-            f'format={format_intermediate} extension=".{format_intermediate}"'
-        ),
-        shell=True,
-        check=True,
-    )
 
-    # STEP 1: ENRICHISSEMENT AVEC COG
-    mapshaper_enrich(
-        local_dir=output_path,
-        filename_initial="raw",
-        extension_initial=format_intermediate,
-        output_path=f"{output_path}/raw2.{format_intermediate}",
-        dict_corresp=DICT_CORRESP_ADMINEXPRESS,
-    )
-
-    input_path = f"{output_path}/raw2.{format_intermediate}"
+    # Nota : all steps are chained in a single mapshaper invocation, both
+    # layers being loaded once and merged in memory
+    steps = [
+        # PREPROCESS CITIES AND ARRONDISSEMENT
+        "-rename-layers COMMUNE,ARRONDISSEMENT_MUNICIPAL "
+        "-proj EPSG:4326 target=* "
+        "-filter '\"69123,13055,75056\".indexOf(INSEE_COM) > -1' invert "
+        "target=COMMUNE "
+        '-each "INSEE_COG=INSEE_COM" target=COMMUNE '
+        "-rename-fields INSEE_COG=INSEE_ARM target=ARRONDISSEMENT_MUNICIPAL "
+        "-each 'STATUT=\"Arrondissement municipal\" ' "
+        "target=ARRONDISSEMENT_MUNICIPAL",
+        # MERGE CITIES AND ARRONDISSEMENT (unnamed, so that -split names the
+        # parts after the split values only)
+        "-merge-layers target=COMMUNE,ARRONDISSEMENT_MUNICIPAL force "
+        "-rename-layers ''",
+        # STEP 1: ENRICHISSEMENT AVEC COG
+        enrich_commands(dict_corresp=DICT_CORRESP_ADMINEXPRESS),
+    ]
 
     if niveau_agreg.upper() == "FRANCE_ENTIERE_DROM_RAPPROCHES":
-        input_path = mapshaper_bring_closer(input_path)
+        steps.append(bring_closer_commands())
 
     # TRANSFORM AS NEEDED
-    mapshaper_split(
-        input_file=input_path,
-        layer_name="",
-        split_variable=dict_corresp[niveau_agreg],
-        output_path=output_path,
-        format_output=format_output,
-        crs=crs,
-        option_simplify=option_simplify,
-        source_identifier=f"{provider}:{source}",
+    steps.append(
+        _split_steps(
+            outputs, dict_corresp[niveau_agreg], crs, f"{provider}:{source}"
+        )
+    )
+
+    run_mapshaper(
+        mapshaper_command(
+            f"-i {file_city} {file_arrondissement} snap combine-files", *steps
+        )
     )
 
-    return output_path
+    if isinstance(format_output, str) and not isinstance(simplification, (list, tuple)):
+        return output_path
+    return outputs
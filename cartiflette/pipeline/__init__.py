@@ -8,6 +8,15 @@ from .mapshaper_split_from_s3 import (
     mapshaperize_split_from_s3,
     mapshaperize_merge_split_from_s3,
 )
+from .enrich_communes import enrich_communes_from_s3
+from .dissolve_levels import dissolve_levels_from_s3, download_dissolved_level
+from .planner import (
+    ExecutionPlan,
+    plan_from_crossproduct,
+    local_handlers,
+    execute_plan,
+)
+from .split_batch import split_batch_from_s3
 
 __all__ = [
     "restructure_nested_dict_borders",
@@ -15,4 +24,12 @@ __all__ = [
     "prepare_local_directory_mapshaper",
     "mapshaperize_split_from_s3",
     "mapshaperize_merge_split_from_s3",
+    "enrich_communes_from_s3",
+    "dissolve_levels_from_s3",
+    "download_dissolved_level",
+    "ExecutionPlan",
+    "plan_from_crossproduct",
+    "local_handlers",
+    "execute_plan",
+    "split_batch_from_s3",
 ]
@@ -8,7 +8,7 @@ from .prepare_mapshaper import prepare_local_directory_mapshaper
 
 
 def combine_adminexpress_territory(
-    intermediate_dir="temp", path_within_bucket=PATH_WITHIN_BUCKET, fs=FS
+    intermediate_dir="temp", path_within_bucket=PATH_WITHIN_BUCKET, fs=FS, year=2022
 ):
     local_dir = intermediate_dir
     format_intermediate = "geojson"
@@ -21,7 +21,7 @@ def combine_adminexpress_territory(
 
     list_location_raw = {
         territ: upload_s3_raw(
-            path_within_bucket=path_within_bucket, year=2022, territory=territ
+            path_within_bucket=path_within_bucket, year=year, territory=territ
         )
         for territ in list_territories
     }
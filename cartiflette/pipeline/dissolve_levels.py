@@ -0,0 +1,232 @@
+import logging
+import os
+from typing import Dict, List
+
+import geopandas as gpd
+import s3fs
+
+from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET, FS, GEOPROCESSING_ENGINE
+from cartiflette.utils import create_path_bucket, DICT_CORRESP_ADMINEXPRESS
+from cartiflette.geoprocessing.dissolve import (
+    DISSOLVE_PARENTS,
+    dissolve_levels,
+    level_fields,
+)
+from cartiflette.mapshaper.mapshaper_wrangling import mapshaper_command, run_mapshaper
+from .enrich_communes import path_enriched_layer, enrich_communes_from_s3
+
+logger = logging.getLogger(__name__)
+
+
+def path_dissolved_level(
+    level: str,
+    year: int = 2022,
+    source: str = "EXPRESS-COG-CARTO-TERRITOIRE",
+    bucket: str = BUCKET,
+    path_within_bucket: str = PATH_WITHIN_BUCKET,
+) -> str:
+    "Path on the s3 of a dissolved (and enriched) level, stored as geoparquet"
+    return create_path_bucket(
+        {
+            "bucket": bucket,
+            "path_within_bucket": path_within_bucket,
+            "year": year,
+            "borders": level,
+            "crs": 4326,
+            "filter_by": "preprocessed",
+            "value": "dissolved",
+            "vectorfile_format": "parquet",
+            "provider": "IGN",
+            "dataset_family": "ADMINEXPRESS",
+            "source": source,
+            "territory": "france",
+            "simplification": 0,
+        }
+    )
+
+
+def mapshaper_dissolve_levels(
+    communes_path: str,
+    levels: List[str] = None,
+    local_dir: str = "temp",
+    dict_corresp: dict = DICT_CORRESP_ADMINEXPRESS,
+) -> Dict[str, str]:
+    """
+    Equivalent of dissolve_levels with mapshaper : each level is dissolved
+    once, from it's parent level (see DISSOLVE_PARENTS), from file to file.
+
+    Parameters
+    ----------
+    communes_path : str
+        Path of the enriched commune layer (in a format mapshaper can read)
+    levels : List[str], optional
+        The levels to compute (their parent levels are computed as well). The
+        default is None, which will compute every level of DISSOLVE_PARENTS.
+    local_dir : str, optional
+        Working directory, the levels being written to {local_dir}/dissolved.
+        The default is "temp".
+    dict_corresp : dict, optional
+        A dictionary giving correspondance between levels and variable names.
+        The default is DICT_CORRESP_ADMINEXPRESS.
+
+    Returns
+    -------
+    Dict[str, str]
+        Local path (geojson) of each level computed (including parent levels,
+        excluding COMMUNE)
+
+    """
+    if levels is None:
+        levels = list(DISSOLVE_PARENTS)
+
+    paths = {"COMMUNE": communes_path}
+    os.makedirs(f"{local_dir}/dissolved", exist_ok=True)
+
+    def get(level):
+        try:
+            return paths[level]
+        except KeyError:
+            pass
+        parent = get(DISSOLVE_PARENTS[level])
+        path = f"{local_dir}/dissolved/{level}.geojson"
+        logger.info(f"dissolving {level} from {parent}")
+        run_mapshaper(
+            mapshaper_command(
+                parent,
+                f"-dissolve {dict_corresp[level]} "
+                "calc='POPULATION=sum(POPULATION)' "
+                f"copy-fields={','.join(level_fields(level, dict_corresp))}",
+                f"-o {path} format=geojson",
+            )
+        )
+        paths[level] = path
+        return path
+
+    for level in levels:
+        get(level)
+
+    del paths["COMMUNE"]
+    return paths
+
+
+def dissolve_levels_from_s3(
+    config: dict, levels: List[str] = None, fs: s3fs.S3FileSystem = FS
+) -> Dict[str, str]:
+    """
+    Dissolve stage of the pipeline : the enriched commune layer (see
+    enrich_communes_from_s3) is dissolved into each level (each one from it's
+    parent level, see DISSOLVE_PARENTS) and each level is stored on the s3 as
+    geoparquet, to be used by the split jobs. The levels are dissolved by the
+    engine of the run (GEOPROCESSING_ENGINE unless configured otherwise), as
+    the split jobs would have.
+
+    Parameters
+    ----------
+    config : dict
+        Configuration of the run (year, source, bucket, path_within_bucket,
+        local_dir, metadata_file and engine keys are used)
+    levels : List[str], optional
+        Levels to compute. The default is None, which will compute every
+        level of DISSOLVE_PARENTS.
+    fs : s3fs.S3FileSystem, optional
+        S3 file system to use. The default is FS.
+
+    Returns
+    -------
+    Dict[str, str]
+        Path on the s3 of each dissolved level
+
+    """
+    year = config.get("year", 2022)
+    source = config.get("source", "EXPRESS-COG-CARTO-TERRITOIRE")
+    bucket = config.get("bucket", BUCKET)
+    path_within_bucket = config.get("path_within_bucket", PATH_WITHIN_BUCKET)
+    local_dir = config.get("local_dir", "temp")
+    engine = config.get("engine", GEOPROCESSING_ENGINE)
+
+    # Start from the enriched layer (computed by the enrichment stage)
+    path_enriched = path_enriched_layer(year, source, bucket, path_within_bucket)
+    local_path = f"{local_dir}/enriched/COMMUNE.parquet"
+    if fs.exists(path_enriched):
+        os.makedirs(f"{local_dir}/enriched", exist_ok=True)
+        fs.download(path_enriched, local_path)
+    else:
+        enrich_communes_from_s3(config, fs=fs)
+    communes = gpd.read_parquet(local_path)
+
+    if engine == "mapshaper":
+        # mapshaper can't read geoparquet
+        communes_path = f"{local_dir}/enriched/COMMUNE.geojson"
+        communes.to_file(communes_path, engine="pyogrio")
+        dissolved = {
+            level: gpd.read_file(path, engine="pyogrio")
+            for level, path in mapshaper_dissolve_levels(
+                communes_path, levels, local_dir
+            ).items()
+        }
+    else:
+        dissolved = dissolve_levels(communes, levels)
+
+    paths = {}
+    os.makedirs(f"{local_dir}/dissolved", exist_ok=True)
+    for level, gdf in dissolved.items():
+        local_path = f"{local_dir}/dissolved/{level}.parquet"
+        gdf.to_parquet(local_path)
+        paths[level] = path_dissolved_level(
+            level, year, source, bucket, path_within_bucket
+        )
+        fs.put_file(local_path, paths[level])
+        logger.info(f"{level} : {len(gdf)} polygons stored at {paths[level]}")
+    return paths
+
+
+def download_dissolved_level(
+    level: str,
+    year: int = 2022,
+    source: str = "EXPRESS-COG-CARTO-TERRITOIRE",
+    bucket: str = BUCKET,
+    path_within_bucket: str = PATH_WITHIN_BUCKET,
+    local_dir: str = "temp",
+    engine: str = "python",
+    fs: s3fs.S3FileSystem = FS,
+) -> dict:
+    """
+    Download a dissolved level (if it has been computed by the dissolve
+    stage), or the enriched commune layer (level COMMUNE, if it has been
+    computed by the enrichment stage), in a format readable by the engine.
+
+    Returns
+    -------
+    dict
+        The config_file_city to give to the split function (None if the level
+        has not been preprocessed)
+
+    """
+    if level == "COMMUNE":
+        path = path_enriched_layer(year, source, bucket, path_within_bucket)
+        location = f"{local_dir}/enriched"
+    elif level in DISSOLVE_PARENTS:
+        path = path_dissolved_level(level, year, source, bucket, path_within_bucket)
+        location = f"{local_dir}/dissolved"
+    else:
+        return None
+    if not fs.exists(path):
+        logger.info(f"{level} has not been preprocessed")
+        return None
+
+    os.makedirs(location, exist_ok=True)
+    fs.download(path, f"{location}/{level}.parquet")
+    extension = "parquet"
+    if engine == "mapshaper":
+        # mapshaper can't read geoparquet
+        gpd.read_parquet(f"{location}/{level}.parquet").to_file(
+            f"{location}/{level}.geojson", engine="pyogrio"
+        )
+        extension = "geojson"
+
+    return {
+        "location": location,
+        "filename": level,
+        "extension": extension,
+        "enriched": True,
+    }
@@ -0,0 +1,133 @@
+import logging
+import os
+
+import geopandas as gpd
+import s3fs
+
+from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET, FS, GEOPROCESSING_ENGINE
+from cartiflette.utils import create_path_bucket, DICT_CORRESP_ADMINEXPRESS
+from cartiflette.geoprocessing.wrangling import read_metadata, enrich
+from cartiflette.mapshaper.mapshaper_wrangling import (
+    enrich_commands,
+    mapshaper_command,
+    run_mapshaper,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def path_combined_layer(
+    year: int = 2022,
+    source: str = "EXPRESS-COG-CARTO-TERRITOIRE",
+    bucket: str = BUCKET,
+    path_within_bucket: str = PATH_WITHIN_BUCKET,
+) -> str:
+    "Path on the s3 of the combined commune layer (before COG enrichment)"
+    return create_path_bucket(
+        {
+            "bucket": bucket,
+            "path_within_bucket": path_within_bucket,
+            "year": year,
+            "borders": "france",
+            "crs": 4326,
+            "filter_by": "preprocessed",
+            "value": "before_cog",
+            "vectorfile_format": "geojson",
+            "provider": "IGN",
+            "dataset_family": "ADMINEXPRESS",
+            "source": source,
+            "territory": "france",
+            "filename": "raw.geojson",
+            "simplification": 0,
+        }
+    )
+
+
+def path_enriched_layer(
+    year: int = 2022,
+    source: str = "EXPRESS-COG-CARTO-TERRITOIRE",
+    bucket: str = BUCKET,
+    path_within_bucket: str = PATH_WITHIN_BUCKET,
+) -> str:
+    "Path on the s3 of the enriched commune layer, stored as geoparquet"
+    return create_path_bucket(
+        {
+            "bucket": bucket,
+            "path_within_bucket": path_within_bucket,
+            "year": year,
+            "borders": "COMMUNE",
+            "crs": 4326,
+            "filter_by": "preprocessed",
+            "value": "enriched",
+            "vectorfile_format": "parquet",
+            "provider": "IGN",
+            "dataset_family": "ADMINEXPRESS",
+            "source": source,
+            "territory": "france",
+            "simplification": 0,
+        }
+    )
+
+
+def enrich_communes_from_s3(config: dict, fs: s3fs.S3FileSystem = FS) -> str:
+    """
+    Enrichment stage of the pipeline : the combined commune layer is joined
+    with the COG metadata (tagc.csv) once per year and source, and stored on
+    the s3 as geoparquet, to be used by the dissolve stage and the split
+    jobs. The layer is enriched by the engine of the run
+    (GEOPROCESSING_ENGINE unless configured otherwise), as the split jobs
+    would have.
+
+    Parameters
+    ----------
+    config : dict
+        Configuration of the run (year, source, bucket, path_within_bucket,
+        local_dir, metadata_file and engine keys are used)
+    fs : s3fs.S3FileSystem, optional
+        S3 file system to use. The default is FS.
+
+    Returns
+    -------
+    str
+        Path on the s3 of the enriched layer (it is also kept locally, in
+        {local_dir}/enriched/COMMUNE.parquet)
+
+    """
+    year = config.get("year", 2022)
+    source = config.get("source", "EXPRESS-COG-CARTO-TERRITOIRE")
+    bucket = config.get("bucket", BUCKET)
+    path_within_bucket = config.get("path_within_bucket", PATH_WITHIN_BUCKET)
+    local_dir = config.get("local_dir", "temp")
+    metadata_file = config.get("metadata_file", "temp/tagc.csv")
+    engine = config.get("engine", GEOPROCESSING_ENGINE)
+
+    os.makedirs(f"{local_dir}/preprocessed_combined", exist_ok=True)
+    local_path = f"{local_dir}/preprocessed_combined/COMMUNE.geojson"
+    fs.download(
+        path_combined_layer(year, source, bucket, path_within_bucket), local_path
+    )
+
+    os.makedirs(f"{local_dir}/enriched", exist_ok=True)
+    if engine == "mapshaper":
+        enriched_path = f"{local_dir}/enriched/COMMUNE.geojson"
+        run_mapshaper(
+            mapshaper_command(
+                local_path,
+                enrich_commands(metadata_file, DICT_CORRESP_ADMINEXPRESS),
+                f"-o {enriched_path} format=geojson",
+            )
+        )
+        communes = gpd.read_file(enriched_path, engine="pyogrio")
+    else:
+        communes = enrich(
+            gpd.read_file(local_path, engine="pyogrio"),
+            read_metadata(metadata_file),
+            DICT_CORRESP_ADMINEXPRESS,
+        )
+
+    local_path = f"{local_dir}/enriched/COMMUNE.parquet"
+    communes.to_parquet(local_path)
+    path = path_enriched_layer(year, source, bucket, path_within_bucket)
+    fs.put_file(local_path, path)
+    logger.info(f"{len(communes)} enriched communes stored at {path}")
+    return path
@@ -1,26 +1,48 @@
 import os
 import shutil
 
-from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET, FS
+from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET, FS, GEOPROCESSING_ENGINE
 from cartiflette.utils import create_path_bucket
+from cartiflette.s3 import list_raw_files_level, download_files_from_list
 from cartiflette.mapshaper import mapshaperize_split, mapshaperize_split_merge
-from .prepare_mapshaper import prepare_local_directory_mapshaper
+from cartiflette.geoprocessing import python_split, python_split_merge
+from cartiflette.geoprocessing.dissolve import splittable_by
+from .dissolve_levels import download_dissolved_level
 
+ENGINES = {
+    "mapshaper": (mapshaperize_split, mapshaperize_split_merge),
+    "python": (python_split, python_split_merge),
+}
 
-def mapshaperize_split_from_s3(config, fs=FS):
-    format_output = config.get("format_output", "topojson")
+
+def get_engine(config: dict) -> tuple:
+    """
+    Get the split and split-merge functions of the engine selected by the
+    job's config (or GEOPROCESSING_ENGINE)
+    """
+    engine = config.get("engine", GEOPROCESSING_ENGINE)
+    try:
+        return ENGINES[engine]
+    except KeyError:
+        raise ValueError(f"unknown engine {engine}, expected one of {list(ENGINES)}")
+
+
+def prepare_split_input(config: dict, fs=FS) -> dict:
+    """
+    Download the layer a split job starts from : the dissolved level (if it
+    can be split by filter_by), else the enriched commune layer, else the
+    combined commune layer.
+
+    Returns
+    -------
+    dict
+        The config_file_city to give to the split function
+    """
     filter_by = config.get("filter_by", "DEPARTEMENT")
-    territory = config.get("territory", "metropole")
     level_polygons = config.get("level_polygons", "COMMUNE")
-    territory = config.get("territory", "metropole")
 
-    provider = config.get("provider", "IGN")
     source = config.get("source", "EXPRESS-COG-CARTO-TERRITOIRE")
     year = config.get("year", 2022)
-    dataset_family = config.get("dataset_family", "ADMINEXPRESS")
-    territory = config.get("territory", "metropole")
-    crs = config.get("crs", 4326)
-    simplification = config.get("simplification", 0)
 
     bucket = config.get("bucket", BUCKET)
     path_within_bucket = config.get("path_within_bucket", PATH_WITHIN_BUCKET)
@@ -45,15 +67,65 @@ def mapshaperize_split_from_s3(config, fs=FS):
         }
     )
 
-    fs.download(path_raw_s3_combined, "temp/preprocessed_combined/COMMUNE.geojson")
+    # Start from the level dissolved by the dissolve stage if it can be split
+    # by filter_by, else from the enriched commune layer (if available)
+    config_file_city = None
+    if config.get("use_dissolved", True):
+        preprocessed_levels = ["COMMUNE"]
+        if filter_by in splittable_by(level_polygons):
+            preprocessed_levels.insert(0, level_polygons)
+        for level in dict.fromkeys(preprocessed_levels):
+            config_file_city = download_dissolved_level(
+                level,
+                year=year,
+                source=source,
+                bucket=bucket,
+                path_within_bucket=path_within_bucket,
+                local_dir=local_dir,
+                engine=config.get("engine", GEOPROCESSING_ENGINE),
+                fs=fs,
+            )
+            if config_file_city is not None:
+                break
 
-    output_path = mapshaperize_split(
-        local_dir=local_dir,
-        config_file_city={
-            "location": "temp/preprocessed_combined",
+    if config_file_city is None:
+        os.makedirs(f"{local_dir}/preprocessed_combined", exist_ok=True)
+        fs.download(
+            path_raw_s3_combined, f"{local_dir}/preprocessed_combined/COMMUNE.geojson"
+        )
+        config_file_city = {
+            "location": f"{local_dir}/preprocessed_combined",
             "filename": "COMMUNE",
             "extension": "geojson",
-        },
+        }
+
+    return config_file_city
+
+
+def mapshaperize_split_from_s3(config, fs=FS, config_file_city=None):
+    format_output = config.get("format_output", "topojson")
+    filter_by = config.get("filter_by", "DEPARTEMENT")
+    level_polygons = config.get("level_polygons", "COMMUNE")
+
+    provider = config.get("provider", "IGN")
+    source = config.get("source", "EXPRESS-COG-CARTO-TERRITOIRE")
+    year = config.get("year", 2022)
+    dataset_family = config.get("dataset_family", "ADMINEXPRESS")
+    territory = config.get("territory", "metropole")
+    crs = config.get("crs", 4326)
+    simplification = config.get("simplification", 0)
+
+    bucket = config.get("bucket", BUCKET)
+    path_within_bucket = config.get("path_within_bucket", PATH_WITHIN_BUCKET)
+    local_dir = config.get("local_dir", "temp")
+
+    if config_file_city is None:
+        config_file_city = prepare_split_input(config, fs=fs)
+
+    split_function, _ = get_engine(config)
+    outputs = split_function(
+        local_dir=local_dir,
+        config_file_city=config_file_city,
         format_output=format_output,
         niveau_agreg=filter_by,
         niveau_polygons=level_polygons,
@@ -62,42 +134,45 @@ def mapshaperize_split_from_s3(config, fs=FS):
         crs=crs,
         simplification=simplification,
     )
+    if isinstance(outputs, str):
+        outputs = {(format_output, simplification): outputs}
 
-    for values in os.listdir(output_path):
-        path_s3 = create_path_bucket(
-            {
-                "bucket": bucket,
-                "path_within_bucket": path_within_bucket,
-                "year": year,
-                "borders": level_polygons,
-                "crs": crs,
-                "filter_by": filter_by,
-                "value": values.replace(f".{format_output}", ""),
-                "vectorfile_format": format_output,
-                "provider": provider,
-                "dataset_family": dataset_family,
-                "source": source,
-                "territory": territory,
-                "simplification": simplification,
-            }
-        )
-        fs.put(f"{output_path}/{values}", path_s3)
+    for (vectorfile_format, simplification_level), output_path in outputs.items():
+        for values in os.listdir(output_path):
+            path_s3 = create_path_bucket(
+                {
+                    "bucket": bucket,
+                    "path_within_bucket": path_within_bucket,
+                    "year": year,
+                    "borders": level_polygons,
+                    "crs": crs,
+                    "filter_by": filter_by,
+                    "value": values.replace(f".{vectorfile_format}", ""),
+                    "vectorfile_format": vectorfile_format,
+                    "provider": provider,
+                    "dataset_family": dataset_family,
+                    "source": source,
+                    "territory": territory,
+                    "simplification": simplification_level,
+                }
+            )
+            fs.put(f"{output_path}/{values}", path_s3)
 
-    shutil.rmtree(output_path)
+        shutil.rmtree(output_path)
 
 
-def mapshaperize_merge_split_from_s3(config, fs=FS):
-    format_output = config.get("format_output", "topojson")
-    filter_by = config.get("filter_by", "DEPARTEMENT")
-    territory = config.get("territory", "metropole")
+def prepare_merge_split_inputs(config: dict, fs=FS) -> tuple:
+    """
+    Download the combined commune layer and the arrondissement layer a
+    merge split job starts from.
 
-    provider = config.get("provider", "IGN")
-    source = config.get("source", "EXPRESS-COG-CARTO-TERRITOIRE")
+    Returns
+    -------
+    tuple
+        The config_file_city and config_file_arrondissement to give to the
+        split-merge function
+    """
     year = config.get("year", 2022)
-    dataset_family = config.get("dataset_family", "ADMINEXPRESS")
-    territory = config.get("territory", "metropole")
-    crs = config.get("crs", 4326)
-    simplification = config.get("simplification", 0)
 
     bucket = config.get("bucket", BUCKET)
     path_within_bucket = config.get("path_within_bucket", PATH_WITHIN_BUCKET)
@@ -122,7 +197,10 @@ def mapshaperize_merge_split_from_s3(config, fs=FS):
         }
     )
 
-    fs.download(path_raw_s3_combined, "temp/preprocessed_combined/COMMUNE.geojson")
+    os.makedirs(f"{local_dir}/preprocessed_combined", exist_ok=True)
+    fs.download(
+        path_raw_s3_combined, f"{local_dir}/preprocessed_combined/COMMUNE.geojson"
+    )
 
     path_raw_s3_arrondissement = create_path_bucket(
         {
@@ -145,30 +223,58 @@ def mapshaperize_merge_split_from_s3(config, fs=FS):
 
     path_raw_s3_arrondissement = path_raw_s3_arrondissement.rsplit("/", maxsplit=1)[0]
 
-    # retrieve arrondissement
-    prepare_local_directory_mapshaper(
-        path_raw_s3_arrondissement,
-        borders="ARRONDISSEMENT_MUNICIPAL",
-        territory="metropole",
-        niveau_agreg=filter_by,
-        format_output="topojson",
-        simplification=simplification,
-        local_dir="temp",
-        fs=FS,
+    # retrieve arrondissement (only the raw files are needed : the merge split
+    # writes it's outputs for every format and simplification itself)
+    os.makedirs(f"{local_dir}/metropole", exist_ok=True)
+    download_files_from_list(
+        fs,
+        list_raw_files_level(
+            fs, path_raw_s3_arrondissement, borders="ARRONDISSEMENT_MUNICIPAL"
+        ),
+        local_dir=f"{local_dir}/metropole",
     )
 
-    output_path = mapshaperize_split_merge(
+    config_file_city = {
+        "location": f"{local_dir}/preprocessed_combined",
+        "filename": "COMMUNE",
+        "extension": "geojson",
+    }
+    config_file_arrondissement = {
+        "location": f"{local_dir}/metropole",
+        "filename": "ARRONDISSEMENT_MUNICIPAL",
+        "extension": "shp",
+    }
+    return config_file_city, config_file_arrondissement
+
+
+def mapshaperize_merge_split_from_s3(
+    config, fs=FS, config_file_city=None, config_file_arrondissement=None
+):
+    format_output = config.get("format_output", "topojson")
+    filter_by = config.get("filter_by", "DEPARTEMENT")
+
+    provider = config.get("provider", "IGN")
+    source = config.get("source", "EXPRESS-COG-CARTO-TERRITOIRE")
+    year = config.get("year", 2022)
+    dataset_family = config.get("dataset_family", "ADMINEXPRESS")
+    territory = config.get("territory", "metropole")
+    crs = config.get("crs", 4326)
+    simplification = config.get("simplification", 0)
+
+    bucket = config.get("bucket", BUCKET)
+    path_within_bucket = config.get("path_within_bucket", PATH_WITHIN_BUCKET)
+    local_dir = config.get("local_dir", "temp")
+
+    if config_file_city is None or config_file_arrondissement is None:
+        config_file_city, config_file_arrondissement = prepare_merge_split_inputs(
+            config, fs=fs
+        )
+
+    _, split_merge_function = get_engine(config)
+    outputs = split_merge_function(
         local_dir=local_dir,
-        config_file_city={
-            "location": "temp/preprocessed_combined",
-            "filename": "COMMUNE",
-            "extension": "geojson",
-        },
-        config_file_arrondissement={
-            "location": "temp/metropole",
-            "filename": "ARRONDISSEMENT_MUNICIPAL",
-            "extension": "shp",
-        },
+        config_file_city=config_file_city,
+        config_file_arrondissement=config_file_arrondissement,
         format_output=format_output,
         niveau_agreg=filter_by,
         provider=provider,
@@ -176,25 +282,28 @@ def mapshaperize_merge_split_from_s3(config, fs=FS):
         crs=crs,
         simplification=simplification,
     )
+    if isinstance(outputs, str):
+        outputs = {(format_output, simplification): outputs}
 
-    for values in os.listdir(output_path):
-        path_s3 = create_path_bucket(
-            {
-                "bucket": bucket,
-                "path_within_bucket": path_within_bucket,
-                "year": year,
-                "borders": "COMMUNE_ARRONDISSEMENT",
-                "crs": crs,
-                "filter_by": filter_by,
-                "value": values.replace(f".{format_output}", ""),
-                "vectorfile_format": format_output,
-                "provider": provider,
-                "dataset_family": dataset_family,
-                "source": source,
-                "territory": territory,
-                "simplification": simplification,
-            }
-        )
-        fs.put(f"{output_path}/{values}", path_s3)
+    for (vectorfile_format, simplification_level), output_path in outputs.items():
+        for values in os.listdir(output_path):
+            path_s3 = create_path_bucket(
+                {
+                    "bucket": bucket,
+                    "path_within_bucket": path_within_bucket,
+                    "year": year,
+                    "borders": "COMMUNE_ARRONDISSEMENT",
+                    "crs": crs,
+                    "filter_by": filter_by,
+                    "value": values.replace(f".{vectorfile_format}", ""),
+                    "vectorfile_format": vectorfile_format,
+                    "provider": provider,
+                    "dataset_family": dataset_family,
+                    "source": source,
+                    "territory": territory,
+                    "simplification": simplification_level,
+                }
+            )
+            fs.put(f"{output_path}/{values}", path_s3)
 
-    shutil.rmtree(output_path)
+        shutil.rmtree(output_path)
@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+"""
+Planning of the production pipeline : each row of the cross product
+(crossproduct_parameters_production) is expanded into a chain of operations
+(combine -> enrich -> dissolve -> bring closer -> project -> simplify ->
+split). Operations are content-addressed (their key is a hash of their kind,
+parameters and inputs), so that the work shared by several rows (ie the
+enrichment, the dissolution of a level or a reprojection) appears once in
+the plan.
+
+The plan can be run by the argo workflow (ExecutionPlan.split_jobs gives
+the parameters of the split-dataset tasks, shared operations being run by
+the upstream tasks) or in-process (execute_plan, with local_handlers).
+"""
+
+from collections import Counter
+import hashlib
+import heapq
+import json
+import logging
+import os
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+from cartiflette.config import DISSOLVE_PARTITION
+from cartiflette.utils import DICT_CORRESP_ADMINEXPRESS
+from cartiflette.geoprocessing import bring_closer
+from cartiflette.geoprocessing.dissolve import (
+    DISSOLVE_PARENTS,
+    level_fields,
+    parallel_dissolve_by,
+    splittable_by,
+)
+from cartiflette.geoprocessing.split import read_layer, merge_arrondissements
+from cartiflette.geoprocessing.wrangling import (
+    read_metadata,
+    enrich,
+    dissolve_by,
+    dissolve,
+    simplify,
+    split,
+)
+
+logger = logging.getLogger(__name__)
+
+# Estimated cost of an output of a split job, relative to a REGION one, by
+# level of the polygons (COMMUNE jobs also produce COMMUNE_ARRONDISSEMENT)
+SPLIT_COSTS = {
+    "COMMUNE": 40,
+    "DEPARTEMENT": 2,
+    "REGION": 1,
+    "FRANCE_ENTIERE": 1,
+}
+DEFAULT_SPLIT_COST = 4
+
+
+class Operation:
+    """
+    A node of the plan : the kind of operation (ie "dissolve"), it's
+    parameters and the operations whose results it uses. Two operations with
+    the same kind, parameters and inputs share the same key.
+    """
+
+    def __init__(self, kind: str, params: dict, inputs: tuple = ()):
+        self.kind = kind
+        self.params = params
+        self.inputs = tuple(inputs)
+        payload = json.dumps(
+            [kind, params, [x.key for x in self.inputs]], sort_keys=True, default=str
+        )
+        self.key = hashlib.sha1(payload.encode("utf8")).hexdigest()[:16]
+
+    def __eq__(self, other):
+        return isinstance(other, Operation) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        params = ", ".join(f"{k}={v}" for k, v in self.params.items())
+        return f"{self.kind}({params})"
+
+
+def _layer_operations(
+    year: int, source: str, level_polygons: str, filter_by: str
+) -> Operation:
+    "Operations producing the layer of level_polygons, before the split"
+    combine = Operation("combine", {"year": year})
+
+    if level_polygons == "COMMUNE_ARRONDISSEMENT":
+        merged = Operation("merge_arrondissements", {"year": year}, [combine])
+        return Operation("enrich", {"source": source}, [merged])
+
+    enriched = Operation("enrich", {"source": source}, [combine])
+    if level_polygons == "COMMUNE":
+        return enriched
+
+    if level_polygons in DISSOLVE_PARENTS and filter_by in splittable_by(
+        level_polygons
+    ):
+        # hierarchical dissolve, shared by every split of the level (and
+        # it's descendants)
+        def dissolved(level):
+            if level == "COMMUNE":
+                return enriched
+            parent = dissolved(DISSOLVE_PARENTS[level])
+            return Operation("dissolve", {"level": level}, [parent])
+
+        return dissolved(level_polygons)
+
+    # dissolve keeping the fields needed by this split only
+    return Operation(
+        "dissolve", {"level": level_polygons, "niveau_agreg": filter_by}, [enriched]
+    )
+
+
+def split_operation(
+    year: int = 2022,
+    source: str = "EXPRESS-COG-CARTO-TERRITOIRE",
+    level_polygons: str = "COMMUNE",
+    filter_by: str = "DEPARTEMENT",
+    crs: int = 4326,
+    format_output: str = "topojson",
+    simplification: float = 0,
+) -> Operation:
+    """
+    Chain of operations of a row of the cross product.
+
+    Returns
+    -------
+    Operation
+        The final (split) operation, the chain being given by it's inputs
+
+    """
+    layer = _layer_operations(year, source, level_polygons, filter_by)
+
+    # IF WE DESIRE TO BRING "DROM" CLOSER TO FRANCE
+    if filter_by == "FRANCE_ENTIERE_DROM_RAPPROCHES":
+        niveau_filter_drom = "DEPARTEMENT"
+        if level_polygons not in ("COMMUNE", "COMMUNE_ARRONDISSEMENT"):
+            niveau_filter_drom = level_polygons
+        layer = Operation("bring_closer", {"level": niveau_filter_drom}, [layer])
+
+    layer = Operation("project", {"crs": crs}, [layer])
+    if simplification:
+        layer = Operation(
+            "simplify", {"simplification": float(simplification)}, [layer]
+        )
+
+    return Operation(
+        "split",
+        {
+            "year": year,
+            "source": source,
+            "level_polygons": level_polygons,
+            "filter_by": filter_by,
+            "crs": crs,
+            "format_output": format_output,
+            "simplification": simplification,
+        },
+        [layer],
+    )
+
+
+class ExecutionPlan:
+    """
+    Deduplicated plan of a set of split operations : every operation
+    appears once, in topological order (each operation after it's inputs).
+    """
+
+    def __init__(self, targets: List[Operation]):
+        self.targets = list(dict.fromkeys(targets))
+        self.operations: Dict[str, Operation] = {}
+
+        def visit(operation):
+            if operation.key in self.operations:
+                return
+            for x in operation.inputs:
+                visit(x)
+            self.operations[operation.key] = operation
+
+        for target in self.targets:
+            visit(target)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations.values())
+
+    def stages(self) -> List[List[Operation]]:
+        """
+        Operations grouped by depth : the operations of a stage only depend
+        on operations of the previous stages, and can be run concurrently.
+        """
+        depth = {}
+        for operation in self:
+            depth[operation.key] = 1 + max(
+                (depth[x.key] for x in operation.inputs), default=-1
+            )
+        stages = [[] for _ in range(max(depth.values(), default=-1) + 1)]
+        for operation in self:
+            stages[depth[operation.key]].append(operation)
+        return stages
+
+    def summary(self) -> dict:
+        """
+        Number of operations of the plan (by kind), and of operations that
+        would be run without deduplication (each row running it's whole
+        chain).
+        """
+        def chain(operation):
+            return {operation.key}.union(*(chain(x) for x in operation.inputs))
+
+        return {
+            "operations": len(self),
+            "without_deduplication": sum(len(chain(x)) for x in self.targets),
+            "by_kind": dict(Counter(x.kind for x in self)),
+        }
+
+    def split_jobs(self) -> List[dict]:
+        """
+        Parameters of the split jobs (one per (year, source, level_polygons,
+        filter_by, crs), producing every format and simplification level of
+        the split, see mapshaperize_split_from_s3). The operations shared by
+        several jobs (enrich, hierarchical dissolve) are the upstream stages
+        of the pipeline.
+        """
+        jobs = {}
+        for target in self.targets:
+            params = target.params
+            if params["level_polygons"] == "COMMUNE_ARRONDISSEMENT":
+                # produced by the job of the COMMUNE level (split_merge_tiles)
+                continue
+            job = jobs.setdefault(
+                tuple(
+                    params[x]
+                    for x in ("year", "source", "level_polygons", "filter_by", "crs")
+                ),
+                {"format_output": [], "simplification": []},
+            )
+            for field in ("format_output", "simplification"):
+                if params[field] not in job[field]:
+                    job[field].append(params[field])
+
+        return [
+            {
+                "year": year,
+                "source": source,
+                "level_polygons": level_polygons,
+                "filter_by": filter_by,
+                "crs": crs,
+                **outputs,
+            }
+            for (year, source, level_polygons, filter_by, crs), outputs in jobs.items()
+        ]
+
+    def batches(
+        self, n_batches: int, level_polygons: str = None
+    ) -> List[List[dict]]:
+        """
+        Bin-packing of the split jobs into (at most) n_batches batches of
+        similar estimated cost (see SPLIT_COSTS), to be run by
+        split_batch_from_s3. The jobs starting from the same level are kept
+        together as much as possible, so that they share their input layer.
+
+        Parameters
+        ----------
+        n_batches : int
+            Number of batches
+        level_polygons : str, optional
+            Only pack the split jobs of this level. The default is None, which
+            will pack every split job.
+
+        Returns
+        -------
+        List[List[dict]]
+            The split jobs of each batch
+
+        """
+
+        def cost(job):
+            outputs = len(job["format_output"]) * len(job["simplification"])
+            weight = SPLIT_COSTS.get(job["level_polygons"], DEFAULT_SPLIT_COST)
+            return weight * outputs
+
+        jobs = self.split_jobs()
+        if level_polygons is not None:
+            jobs = [x for x in jobs if x["level_polygons"] == level_polygons]
+        if not jobs:
+            return []
+        capacity = max(
+            sum(cost(x) for x in jobs) / n_batches, max(cost(x) for x in jobs)
+        )
+
+        # chunks of jobs sharing their input layer, within the capacity
+        chunks = []
+        groups = {}
+        for job in jobs:
+            key = (job["year"], job["source"], job["level_polygons"])
+            groups.setdefault(key, []).append(job)
+        for group in groups.values():
+            chunk, load = [], 0
+            for job in group:
+                if chunk and load + cost(job) > capacity:
+                    chunks.append((load, chunk))
+                    chunk, load = [], 0
+                chunk.append(job)
+                load += cost(job)
+            chunks.append((load, chunk))
+
+        # longest processing time first : each chunk goes to the least loaded
+        # batch
+        batches = [(0, k, []) for k in range(n_batches)]
+        for load, chunk in sorted(chunks, key=lambda x: -x[0]):
+            batch_load, k, batch = heapq.heappop(batches)
+            heapq.heappush(batches, (batch_load + load, k, batch + chunk))
+        return [batch for _, _, batch in sorted(batches, key=lambda x: x[1]) if batch]
+
+
+def plan_from_crossproduct(
+    tempdf: pd.DataFrame, with_arrondissements: bool = True
+) -> ExecutionPlan:
+    """
+    Deduplicated plan of a cross product.
+
+    Parameters
+    ----------
+    tempdf : pd.DataFrame
+        The cross product, as returned by crossproduct_parameters_production
+    with_arrondissements : bool, optional
+        Whether the COMMUNE rows are also produced for COMMUNE_ARRONDISSEMENT
+        (as split_merge_tiles.py does). The default is True.
+
+    Returns
+    -------
+    ExecutionPlan
+        The plan
+
+    """
+    targets = []
+    for row in tempdf.to_dict(orient="records"):
+        levels = [row["level_polygons"]]
+        if with_arrondissements and row["level_polygons"] == "COMMUNE":
+            levels.append("COMMUNE_ARRONDISSEMENT")
+        for level in levels:
+            targets.append(
+                split_operation(
+                    year=row["year"],
+                    source=row["source"],
+                    level_polygons=level,
+                    filter_by=row["filter_by"],
+                    crs=row["crs"],
+                    format_output=row["format_output"],
+                    simplification=row["simplification"],
+                )
+            )
+    return ExecutionPlan(targets)
+
+
+def local_handlers(
+    combined_layer: str,
+    metadata_file: str = "temp/tagc.csv",
+    arrondissement_layer: str = None,
+    local_dir: str = "temp",
+    provider: str = "IGN",
+    dict_corresp: dict = DICT_CORRESP_ADMINEXPRESS,
+) -> Dict[str, Callable]:
+    """
+    Handlers running each kind of operation in-process (with the python
+    engine), from local files.
+
+    Parameters
+    ----------
+    combined_layer : str
+        Path of the combined commune layer (before COG enrichment)
+    metadata_file : str, optional
+        Path of the COG metadata. The default is "temp/tagc.csv".
+    arrondissement_layer : str, optional
+        Path of the arrondissement layer (needed for COMMUNE_ARRONDISSEMENT).
+        The default is None.
+    local_dir : str, optional
+        Directory of the outputs, written to
+        {local_dir}/{year}/{level_polygons}/{filter_by}/{format_output}/
+        simplification={simplification}. The default is "temp".
+    provider : str, optional
+        The data provider. The default is "IGN".
+    dict_corresp : dict, optional
+        A dictionary giving correspondance between levels and variable names.
+        The default is DICT_CORRESP_ADMINEXPRESS.
+
+    Returns
+    -------
+    Dict[str, Callable]
+        Handler of each kind of operation, called with the operation and the
+        results of it's inputs
+
+    """
+    def run_dissolve(operation, gdf):
+        level = operation.params["level"]
+        if "niveau_agreg" in operation.params:
+            return dissolve(gdf, level, operation.params["niveau_agreg"], dict_corresp)
+        by, fields = dict_corresp[level], level_fields(level, dict_corresp)
+        if operation.inputs[0].kind == "enrich":
+            return parallel_dissolve_by(
+                gdf, by, fields, dict_corresp[DISSOLVE_PARTITION]
+            )
+        return dissolve_by(gdf, by, fields)
+
+    def run_split(operation, gdf):
+        params = operation.params
+        output_path = (
+            f"{local_dir}/{params['year']}/{params['level_polygons']}/"
+            f"{params['filter_by']}/{params['format_output']}/"
+            f"simplification={params['simplification']}"
+        )
+        return split(
+            gdf,
+            split_variable=dict_corresp[params["filter_by"]],
+            output_path=output_path,
+            format_output=params["format_output"],
+            crs=params["crs"],
+            source_identifier=f"{provider}:{params['source']}",
+        )
+
+    return {
+        "combine": lambda operation: read_layer(combined_layer),
+        "merge_arrondissements": lambda operation, gdf: merge_arrondissements(
+            gdf, read_layer(arrondissement_layer)
+        ),
+        "enrich": lambda operation, gdf: enrich(
+            gdf, read_metadata(metadata_file), dict_corresp
+        ),
+        "dissolve": run_dissolve,
+        "bring_closer": lambda operation, gdf: bring_closer(
+            gdf, operation.params["level"]
+        ),
+        "project": lambda operation, gdf: gdf.to_crs(operation.params["crs"]),
+        "simplify": lambda operation, gdf: simplify(
+            gdf, operation.params["simplification"]
+        ),
+        "split": run_split,
+    }
+
+
+def execute_plan(plan: ExecutionPlan, handlers: Dict[str, Callable]) -> dict:
+    """
+    Run a plan in-process : each operation is run once (in topological
+    order), it's result being released as soon as every operation using it
+    has been run.
+
+    Parameters
+    ----------
+    plan : ExecutionPlan
+        The plan
+    handlers : Dict[str, Callable]
+        Handler of each kind of operation (see local_handlers)
+
+    Returns
+    -------
+    dict
+        Results of the plan's targets, by key
+
+    """
+    remaining_uses = Counter(x.key for operation in plan for x in operation.inputs)
+    targets = {x.key for x in plan.targets}
+    results = {}
+    for operation in plan:
+        logger.info(f"running {operation}")
+        results[operation.key] = handlers[operation.kind](
+            operation, *(results[x.key] for x in operation.inputs)
+        )
+        for x in operation.inputs:
+            remaining_uses[x.key] -= 1
+            if remaining_uses[x.key] == 0 and x.key not in targets:
+                del results[x.key]
+    return {key: results[key] for key in targets}
+
+
+def write_plan(plan: ExecutionPlan, path: str) -> None:
+    "Write a plan (operations, their parameters and inputs) to a json file"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(
+            [
+                {
+                    "key": x.key,
+                    "kind": x.kind,
+                    "params": x.params,
+                    "inputs": [y.key for y in x.inputs],
+                }
+                for x in plan
+            ],
+            f,
+            indent=2,
+        )
@@ -3,11 +3,21 @@ import pandas as pd
 import s3fs
 
 from cartiflette.config import FS
-from cartiflette.s3 import upload_s3_raw
+from cartiflette.s3 import upload_s3_raw, list_raw_files, resolve_raw_file
+from cartiflette.utils import get_sources_catalog
+
+COG_METADATA_SOURCES = [
+    ("Insee", "COG", "DEPARTEMENT"),
+    ("Insee", "COG", "REGION"),
+    ("Insee", "TAGC", "APPARTENANCE"),
+]
 
 
 def prepare_cog_metadata(
-    path_within_bucket: str, local_dir: str = "temp", fs: s3fs.core.S3FileSystem = FS
+    path_within_bucket: str,
+    local_dir: str = "temp",
+    fs: s3fs.core.S3FileSystem = FS,
+    year: int = 2022,
 ) -> pd.DataFrame:
     """
     Prepares and retrieves COG (French Census Geographic Code) metadata by fetching and merging
@@ -17,12 +27,22 @@ def prepare_cog_metadata(
     - path_within_bucket (str): The path within the S3 bucket where the datasets will be stored.
     - local_dir (str): Local directory where the datasets will be downloaded.
     - fs (s3fs.core.S3FileSystem): An S3FileSystem object for interacting with the S3 bucket.
+    - year (int): The vintage of the COG and TAGC datasets. Default is 2022.
 
     Returns:
     - pd.DataFrame: A DataFrame containing the merged COG metadata, including DEPARTEMENT, REGION,
                     and TAGC information.
+
+    Raises:
+    - ValueError: If one of the datasets is not described for this year in the
+      sources' yaml file.
     """
 
+    # Check every dataset is available for this year before any download
+    catalog = get_sources_catalog()
+    for provider, dataset_family, source in COG_METADATA_SOURCES:
+        catalog.resolve(provider, dataset_family, source, "france_entiere", year)
+
     # Create the local directory if it does not exist
     os.makedirs(local_dir, exist_ok=True)
 
@@ -32,8 +52,8 @@ def prepare_cog_metadata(
         dataset_family="COG",
         source="DEPARTEMENT",
         territory="france_entiere",
-        borders="DATASET_INSEE_COG_DEPARTEMENT_FRANCE_ENTIERE_2022",
-        year=2022,
+        borders=None,
+        year=year,
         vectorfile_format="csv",
         path_within_bucket=path_within_bucket,
     )
@@ -44,8 +64,8 @@ def prepare_cog_metadata(
         dataset_family="COG",
         source="REGION",
         territory="france_entiere",
-        borders="DATASET_INSEE_COG_REGION_FRANCE_ENTIERE_2022",
-        year=2022,
+        borders=None,
+        year=year,
         vectorfile_format="csv",
         path_within_bucket=path_within_bucket,
     )
@@ -56,16 +76,21 @@ def prepare_cog_metadata(
         dataset_family="TAGC",
         source="APPARTENANCE",
         territory="france_entiere",
-        borders="table-appartenance-geo-communes-22",
-        year=2022,
+        borders=None,
+        year=year,
         vectorfile_format="xlsx",
         path_within_bucket=path_within_bucket,
     )
 
     # Retrieve paths for the uploaded datasets
-    path_tagc = fs.ls(path_bucket_tagc_appartenance)[0]
-    path_bucket_cog_departement = fs.ls(path_bucket_cog_departement)[0]
-    path_bucket_cog_region = fs.ls(path_bucket_cog_region)[0]
+    path_tagc, path_bucket_cog_departement, path_bucket_cog_region = (
+        resolve_raw_file(fs, list_raw_files(fs, path)[0])
+        for path in (
+            path_bucket_tagc_appartenance,
+            path_bucket_cog_departement,
+            path_bucket_cog_region,
+        )
+    )
 
     # Read datasets from S3 into Pandas DataFrames
     with fs.open(path_tagc, mode="rb") as remote_file:
@@ -76,15 +101,16 @@ def prepare_cog_metadata(
             dtype={"REG": "string[pyarrow]"},
         )
 
+    # Older vintages of the COG have lowercase column names
     with fs.open(path_bucket_cog_departement, mode="rb") as remote_file:
         cog_dep = pd.read_csv(
             remote_file, dtype_backend="pyarrow", dtype={"REG": "string[pyarrow]"}
-        )
+        ).rename(columns=str.upper)
 
     with fs.open(path_bucket_cog_region, mode="rb") as remote_file:
         cog_region = pd.read_csv(
             remote_file, dtype_backend="pyarrow", dtype={"REG": "string[pyarrow]"}
-        )
+        ).rename(columns=str.upper)
 
     # Merge DEPARTEMENT and REGION COG metadata
     cog_metadata = (
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Batches of split jobs : several rows of the cross product run in a single
+pod, the layers they start from being downloaded once and the jobs being run
+on a local process pool.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+from typing import List
+
+from cartiflette.config import FS, GEOPROCESSING_ENGINE, SPLIT_BATCH_MAX_WORKERS
+from cartiflette.geoprocessing.dissolve import splittable_by
+from .mapshaper_split_from_s3 import (
+    prepare_split_input,
+    prepare_merge_split_inputs,
+    mapshaperize_split_from_s3,
+    mapshaperize_merge_split_from_s3,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_batch(rows: List[dict]) -> List[dict]:
+    """
+    Job configs of a batch of rows, as emitted by crossproduct.py (keys with
+    dashes, formats and simplification levels as comma separated strings).
+
+    Parameters
+    ----------
+    rows : List[dict]
+        The rows of the batch
+
+    Returns
+    -------
+    List[dict]
+        The configs of the jobs (see mapshaperize_split_from_s3)
+
+    """
+    configs = []
+    for row in rows:
+        config = {key.replace("-", "_"): value for key, value in row.items()}
+        if isinstance(config.get("format_output"), str):
+            config["format_output"] = config["format_output"].split(",")
+        if isinstance(config.get("simplification"), str):
+            config["simplification"] = [
+                float(x) for x in config["simplification"].split(",")
+            ]
+        configs.append(config)
+    return configs
+
+
+def _input_key(config: dict, merge: bool) -> tuple:
+    "Identifies the input layer(s) of a job, which can be shared across jobs"
+    key = (
+        merge,
+        config.get("year", 2022),
+        config.get("source", "EXPRESS-COG-CARTO-TERRITOIRE"),
+        config.get("engine", GEOPROCESSING_ENGINE),
+    )
+    if merge:
+        return key
+    level_polygons = config.get("level_polygons", "COMMUNE")
+    splittable = config.get("filter_by", "DEPARTEMENT") in splittable_by(
+        level_polygons
+    )
+    return key + (level_polygons if splittable else "COMMUNE",)
+
+
+def _run_job(config: dict, merge: bool, inputs, fs) -> None:
+    "Run a split job (in a worker process)"
+    if merge:
+        mapshaperize_merge_split_from_s3(config, fs, *inputs)
+    else:
+        mapshaperize_split_from_s3(config, fs, inputs)
+
+
+def split_batch_from_s3(
+    configs: List[dict],
+    fs=FS,
+    max_workers: int = SPLIT_BATCH_MAX_WORKERS,
+    with_arrondissements: bool = True,
+) -> None:
+    """
+    Run a batch of split jobs : the input layers are downloaded once (per
+    distinct input), then the jobs are run on a process pool, each one in
+    it's own working directory.
+
+    Parameters
+    ----------
+    configs : List[dict]
+        The configs of the jobs (see mapshaperize_split_from_s3 and
+        parse_batch)
+    fs : s3fs.S3FileSystem, optional
+        S3 file system to use. The default is FS.
+    max_workers : int, optional
+        Number of processes. The default is SPLIT_BATCH_MAX_WORKERS.
+    with_arrondissements : bool, optional
+        Whether the COMMUNE jobs are also run for COMMUNE_ARRONDISSEMENT (as
+        split_merge_tiles.py does). The default is True.
+
+    """
+    jobs = []
+    for config in configs:
+        jobs.append((config, False))
+        if with_arrondissements and config.get("level_polygons") == "COMMUNE":
+            jobs.append(({**config, "level_polygons": "COMMUNE_ARRONDISSEMENT"}, True))
+
+    # SHARED INPUTS, DOWNLOADED ONCE
+    inputs = {}
+    for config, merge in jobs:
+        key = _input_key(config, merge)
+        if key not in inputs:
+            prepare = prepare_merge_split_inputs if merge else prepare_split_input
+            inputs[key] = prepare(config, fs=fs)
+    logger.info(f"{len(jobs)} jobs sharing {len(inputs)} input layers")
+
+    # JOBS, EACH IN IT'S OWN DIRECTORY (OUTPUTS ARE NAMED AFTER FILTER_BY)
+    errors = []
+    with ProcessPoolExecutor(max_workers) as pool:
+        futures = [
+            pool.submit(
+                _run_job,
+                {**config, "local_dir": f"{config.get('local_dir', 'temp')}/job_{k}"},
+                merge,
+                inputs[_input_key(config, merge)],
+                fs,
+            )
+            for k, (config, merge) in enumerate(jobs)
+        ]
+        for (config, merge), future in zip(jobs, futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"job {config} failed : {e}")
+                errors.append(e)
+
+    if errors:
+        raise RuntimeError(
+            f"{len(errors)} jobs out of {len(jobs)} failed"
+        ) from errors[0]
@@ -1,8 +1,13 @@
 from .upload_raw_s3 import upload_s3_raw
-from .list_files_s3 import download_files_from_list, list_raw_files_level
+from .list_files_s3 import (
+    download_files_from_list,
+    list_raw_files_level,
+    list_raw_files,
+    resolve_raw_file,
+)
 from .download_vectorfile import download_vectorfile_url_all
 
 __all__ = [
     "upload_s3_raw", "download_files_from_list", "list_raw_files_level",
-    "download_vectorfile_url_all"
+    "download_vectorfile_url_all", "list_raw_files", "resolve_raw_file"
 ]
@@ -1,6 +1,10 @@
+from cartiflette.download.raw_store import list_raw_files, resolve_raw_file
+
+
 def list_raw_files_level(fs, path_bucket, borders):
     """
-    Lists raw files at a specific level within the file system.
+    Lists raw files at a specific level within the file system (whether
+    they are stored in the folder or referenced in it's manifest).
 
     Parameters
     ----------
@@ -16,13 +20,11 @@ def list_raw_files_level(fs, path_bucket, borders):
     list
         A list of raw files at the specified level in the file system.
     """
-    list_raw_files = fs.ls(path_bucket)
-    list_raw_files = [
+    return [
         chemin
-        for chemin in list_raw_files
+        for chemin in list_raw_files(fs, path_bucket)
         if chemin.rsplit("/", maxsplit=1)[-1].startswith(f"{borders}.")
     ]
-    return list_raw_files
 
 
 def download_files_from_list(fs, list_raw_files, local_dir="temp"):
@@ -44,5 +46,8 @@ def download_files_from_list(fs, list_raw_files, local_dir="temp"):
         The path of the local directory where the files are downloaded.
     """
     for files in list_raw_files:
-        fs.download(files, f"{local_dir}/{files.rsplit('/', maxsplit=1)[-1]}")
+        fs.download(
+            resolve_raw_file(fs, files),
+            f"{local_dir}/{files.rsplit('/', maxsplit=1)[-1]}",
+        )
     return local_dir
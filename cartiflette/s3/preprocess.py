@@ -8,6 +8,7 @@ import pandas as pd
 import s3fs
 
 from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET, FS
+from cartiflette.download.raw_store import MANIFEST, list_raw_files, resolve_raw_file
 from cartiflette.utils import magic_csv_reader
 
 logger = logging.getLogger(__name__)
@@ -150,11 +151,19 @@ def get_cog_year(
             f"{bucket}/{path_within_bucket}/{year=}/**/"
             f"provider=Insee/dataset_family=COG/source={level}/**/*.*"
         )
-        files = fs.glob(pattern)  # , refresh=True)
+        paths = fs.glob(pattern)  # , refresh=True)
         # see issue : https://github.com/fsspec/s3fs/issues/504
+
+        # The glob also matches the manifests' entries : resolve the raw
+        # files of each folder through it's manifest
+        folders = dict.fromkeys(
+            folder.removesuffix(f"/{MANIFEST}")
+            for folder in (path.rsplit("/", maxsplit=1)[0] for path in paths)
+        )
+        files = [file for folder in folders for file in list_raw_files(fs, folder)]
         data = []
         for file in files:
-            with fs.open(file, "rb") as f:
+            with fs.open(resolve_raw_file(fs, file), "rb") as f:
                 dummy = io.BytesIO(f.read())
             df = magic_csv_reader(dummy)
             data.append(df)
@@ -30,7 +30,9 @@ def upload_s3_raw(
     territory : str, optional
         The territory of the data, by default "metropole".
     borders : str, optional
-        The type of borders, by default "COMMUNE".
+        The type of borders, by default "COMMUNE". None to retrieve the only
+        layer of the dataset (ie a table whose layer's name follows it's
+        filename, which changes from year to year).
     path_within_bucket : str, optional
         The path within the S3 bucket, by default cartiflette.config.PATH_WITHIN_BUCKET.
     bucket : str, optional
@@ -74,6 +76,13 @@ def upload_s3_raw(
                 "simplification": 0,
             }
         )
+    elif borders is None:
+        if len(rawpaths) != 1:
+            raise ValueError(
+                f"{len(rawpaths)} layers found in {provider} {dataset_family} "
+                f"{source} {year}, borders should be set"
+            )
+        path_raw_s3 = next(iter(rawpaths.values()))[0]
     else:
         path_raw_s3 = rawpaths[borders][0]
 
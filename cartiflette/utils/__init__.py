@@ -14,11 +14,19 @@ from .dict_correspondance import (
 
 from .keep_subset_geopandas import keep_subset_geopandas
 from .hash import hash_file
+from .dbf_transcoding import transcode_dbf
 from .dict_update import deep_dict_update
 
+from .sources_catalog import (
+    compile_sources_index,
+    is_described,
+    get_sources_catalog,
+    SourcesCatalog,
+)
 from .csv_magic import magic_csv_reader
 from .create_path_bucket import create_path_bucket
 from .standardize_inputs import standardize_inputs
+from .split_outputs import split_outputs
 
 
 __all__ = [
@@ -30,9 +38,15 @@ __all__ = [
     "keep_subset_geopandas",
     "official_epsg_codes",
     "hash_file",
+    "transcode_dbf",
     "deep_dict_update",
+    "compile_sources_index",
+    "is_described",
+    "get_sources_catalog",
+    "SourcesCatalog",
     "magic_csv_reader",
     "create_path_bucket",
     "standardize_inputs",
+    "split_outputs",
     "DICT_CORRESP_ADMINEXPRESS",
 ]
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming re-encoding of shapefiles' attribute tables (dbf files)
+"""
+
+import codecs
+import logging
+import os
+import struct
+import tempfile
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Character fields can't be wider than 254 bytes in dBASE III
+MAX_CHAR_FIELD_LENGTH = 254
+
+
+def _python_codec(encoding: str) -> str:
+    """
+    Convert an encoding as found in a .cpg file (ie "1252", "ISO-8859-1",
+    "UTF-8", ...) to the name of a python codec
+    """
+    encoding = encoding.strip()
+    if encoding.isdigit():
+        encoding = f"cp{encoding}"
+    return codecs.lookup(encoding).name
+
+
+def _read_header(f) -> Tuple[bytes, List[list], int, int, int]:
+    """
+    Read the dbf header and return it's raw bytes, the fields' descriptors
+    (as mutable lists [raw_descriptor, type, length]) and the number of
+    records, header's length and record's length.
+    """
+    header = f.read(32)
+    n_records, header_length, record_length = struct.unpack("<IHH", header[4:12])
+    descriptors = f.read(header_length - 32)
+
+    fields = []
+    for k in range(0, len(descriptors), 32):
+        descriptor = descriptors[k : k + 32]
+        if descriptor[:1] == b"\r":
+            break
+        fields.append([descriptor, chr(descriptor[11]), descriptor[16]])
+    return header, fields, n_records, header_length, record_length
+
+
+def _truncate(value: bytes, length: int, encoding: str) -> bytes:
+    "Truncate encoded value to length without breaking any character"
+    return value[:length].decode(encoding, errors="ignore").encode(encoding)
+
+
+def transcode_dbf(
+    dbf_path: str,
+    encoding: str,
+    target_encoding: str = "utf-8",
+    cpg_path: str = None,
+) -> str:
+    """
+    Re-encode the attribute table of a shapefile, record by record, without
+    touching the geometries (.shp/.shx files). As re-encoded values may be
+    longer than the initial ones (ie "é" is stored with 1 byte in cp1252 and
+    with 2 bytes in utf-8), the table is read twice : once to evaluate the
+    new width of each character field and once to write the records.
+    The .cpg file is then updated to reflect the new encoding.
+
+    Parameters
+    ----------
+    dbf_path : str
+        Path to the dbf file
+    encoding : str
+        Initial encoding of the dbf (as found in the .cpg file)
+    target_encoding : str, optional
+        Desired encoding. The default is "utf-8".
+    cpg_path : str, optional
+        Path to the .cpg file to update. The default is None, which will use
+        the dbf's path with a .cpg extension.
+
+    Returns
+    -------
+    str
+        Path to the .cpg file
+
+    """
+    encoding = _python_codec(encoding)
+    target_encoding = _python_codec(target_encoding)
+    if cpg_path is None:
+        cpg_path = os.path.splitext(dbf_path)[0] + ".cpg"
+
+    with open(dbf_path, "rb") as f:
+        header, fields, n_records, header_length, record_length = _read_header(f)
+
+        def iter_records():
+            f.seek(header_length)
+            for _ in range(n_records):
+                record = f.read(record_length)
+                if len(record) < record_length:
+                    break
+                yield record
+
+        def iter_values(record):
+            position = 1  # first byte is the deletion flag
+            for _, field_type, length in fields:
+                yield field_type, record[position : position + length]
+                position += length
+
+        # 1st pass : evaluate the needed width of each character field
+        widths = [length for _, _, length in fields]
+        for record in iter_records():
+            for k, (field_type, value) in enumerate(iter_values(record)):
+                if field_type != "C":
+                    continue
+                value = value.decode(encoding).rstrip(" ").encode(target_encoding)
+                widths[k] = max(widths[k], len(value))
+
+        if any(x > MAX_CHAR_FIELD_LENGTH for x in widths):
+            logger.warning(
+                f"{dbf_path} - some values will be truncated to "
+                f"{MAX_CHAR_FIELD_LENGTH} bytes after re-encoding"
+            )
+        widths = [min(x, MAX_CHAR_FIELD_LENGTH) for x in widths]
+
+        new_record_length = 1 + sum(widths)
+        new_header = bytearray(header)
+        new_header[10:12] = struct.pack("<H", new_record_length)
+        # language driver id : let readers rely on the .cpg file
+        new_header[29] = 0
+        new_descriptors = b""
+        for (descriptor, _, _), width in zip(fields, widths):
+            descriptor = bytearray(descriptor)
+            descriptor[16] = width
+            new_descriptors += bytes(descriptor)
+
+        # 2nd pass : write the re-encoded records
+        directory = os.path.dirname(os.path.abspath(dbf_path))
+        with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as out:
+            out.write(bytes(new_header))
+            out.write(new_descriptors)
+            out.write(b"\r")
+            out.write(b"\x00" * (header_length - 33 - len(new_descriptors)))
+
+            for record in iter_records():
+                out.write(record[:1])
+                for (field_type, value), width in zip(iter_values(record), widths):
+                    if field_type == "C":
+                        value = (
+                            value.decode(encoding)
+                            .rstrip(" ")
+                            .encode(target_encoding)
+                        )
+                        value = _truncate(value, width, target_encoding)
+                        value = value.ljust(width, b" ")
+                    out.write(value)
+            out.write(b"\x1a")
+            temp_path = out.name
+
+    os.replace(temp_path, dbf_path)
+
+    with open(cpg_path, "w") as f:
+        f.write(target_encoding.upper().replace("_", "-"))
+
+    return cpg_path
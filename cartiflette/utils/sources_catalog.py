@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled views of the sources described in the YAML file
+"""
+
+from datetime import date
+from functools import lru_cache
+import logging
+from typing import Dict, Iterator, Tuple
+
+from ._import_yaml_config import import_yaml_config, config_file
+
+logger = logging.getLogger(__name__)
+
+# Keys of a source which are not years
+SOURCE_METADATA = {"territory", "FTP"}
+
+
+def iter_sources(config: dict) -> Iterator[Tuple[str, str, str, dict]]:
+    """
+    Iterate over the sources described in the YAML (skipping any field
+    common to a dataset family, such as `pattern` or `structure`).
+
+    Parameters
+    ----------
+    config : dict
+        Content of the YAML file
+
+    Yields
+    ------
+    Iterator[Tuple[str, str, str, dict]]
+        provider, dataset_family, source and the source's YAML content
+
+    """
+    for provider, provider_yaml in config.items():
+        if not isinstance(provider_yaml, dict):
+            continue
+        for dataset_family, dataset_family_yaml in provider_yaml.items():
+            if not isinstance(dataset_family_yaml, dict):
+                continue
+            for source, source_yaml in dataset_family_yaml.items():
+                if not isinstance(source_yaml, dict):
+                    continue
+                yield provider, dataset_family, source, source_yaml
+
+
+def compile_sources_index(config: dict = None) -> Dict[Tuple[str, str, str], dict]:
+    """
+    Compile an index of the YAML, describing for each source the available
+    years and territories.
+
+    Parameters
+    ----------
+    config : dict, optional
+        Content of the YAML file. The default is None, which will use the
+        (cached) content of the sources catalog.
+
+    Returns
+    -------
+    Dict[Tuple[str, str, str], dict]
+        Index where keys are (provider, dataset_family, source) and values
+        are dict of the following form :
+            {"years": set of years, "territories": set of territories}
+        "territories" is None if the source is not split by territory.
+
+    """
+    if config is None:
+        config = get_sources_catalog().config
+
+    index = {}
+    for provider, dataset_family, source, source_yaml in iter_sources(config):
+        try:
+            territories = set(source_yaml["territory"])
+        except KeyError:
+            territories = None
+        index[(provider, dataset_family, source)] = {
+            "years": set(source_yaml) - SOURCE_METADATA,
+            "territories": territories,
+        }
+    return index
+
+
+def is_described(
+    index: Dict[Tuple[str, str, str], dict],
+    provider: str,
+    dataset_family: str,
+    source: str,
+    territory: str,
+    year: int,
+) -> bool:
+    """
+    Check if a combination is described in the YAML file, using the index
+    computed by compile_sources_index.
+
+    Nota : sources which are not split by territory are valid for any
+    territory (it will only be used as a label) ; a missing year defaults to
+    the current year (as for Dataset objects).
+
+    """
+    try:
+        described = index[(provider, dataset_family, source)]
+    except KeyError:
+        return False
+
+    if not year:
+        year = date.today().year
+    if year not in described["years"]:
+        return False
+
+    territories = described["territories"]
+    return territories is None or territory in territories
+
+
+class SourcesCatalog:
+    """
+    Validated catalog of the sources described in the YAML file. Every
+    combination is resolved once (url and pattern of the files to retrieve),
+    so that any error in the YAML surfaces when the catalog is loaded and
+    that each later resolution is a simple lookup.
+    """
+
+    def __init__(self, config: dict):
+        """
+        Compile the catalog.
+
+        Parameters
+        ----------
+        config : dict
+            Content of the YAML file
+
+        Raises
+        ------
+        ValueError
+            If any combination described in the YAML can't be resolved
+
+        """
+        self.config = config
+        self.index = compile_sources_index(config)
+        self.entries = {}
+
+        errors = []
+        for provider, dataset_family, source, source_yaml in iter_sources(config):
+            described = self.index[(provider, dataset_family, source)]
+            for year in described["years"]:
+                for territory in described["territories"] or [None]:
+                    key = (provider, dataset_family, source, territory, year)
+                    try:
+                        self.entries[key] = self._resolve_from_yaml(*key)
+                    except Exception as e:
+                        errors.append(f"{'/'.join(map(str, key))} : {e!r}")
+
+        if errors:
+            msg = "sources yaml is not valid:\n" + "\n".join(errors)
+            raise ValueError(msg)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _first_value(self, field: str, keys: tuple):
+        "Get the first (shallowest) value of field when scrolling the yaml"
+        d = self.config
+        for key in keys:
+            d = d[key]
+            try:
+                return d[field]
+            except KeyError:
+                continue
+        return None
+
+    def _resolve_from_yaml(
+        self,
+        provider: str,
+        dataset_family: str,
+        source: str,
+        territory: str,
+        year: int,
+    ) -> dict:
+        """
+        Resolve a combination by scrolling the yaml to find the first `file`
+        (fixed URL) or `structure` value (url to be formatted with diverse
+        fields) and pattern.
+        """
+        keys = (provider, dataset_family, source, year)
+        pattern = self._first_value("pattern", keys)
+        url = self._first_value("file", keys)
+        if not url:
+            url = self._first_value("structure", keys)
+            if not url:
+                raise ValueError("neither `file` nor `structure` has been found")
+
+            source_yaml = self.config[provider][dataset_family][source]
+            kwargs = source_yaml[year].copy()
+            if territory:
+                kwargs["territory"] = source_yaml["territory"][territory]
+            url = url.format(**kwargs)
+
+        return {"url": url, "pattern": pattern}
+
+    def resolve(
+        self,
+        provider: str,
+        dataset_family: str,
+        source: str,
+        territory: str,
+        year: int,
+    ) -> dict:
+        """
+        Get the url and pattern of the files to retrieve for a combination.
+
+        Parameters
+        ----------
+        provider : str
+            Provider described in the yaml file
+        dataset_family : str
+            Family described in the yaml file
+        source : str
+            Source described in the yaml file
+        territory : str
+            Territory described in the yaml file (ignored for sources which
+            are not split by territory)
+        year : int
+            Year described in the yaml file
+
+        Raises
+        ------
+        ValueError
+            If the combination is not described in the yaml file
+
+        Returns
+        -------
+        dict
+            {"url": url to download the file from,
+             "pattern": pattern of the files to extract (or None)}
+
+        """
+        try:
+            described = self.index[(provider, dataset_family, source)]
+        except KeyError:
+            raise ValueError(
+                f"source {source} not described in YAML for provider "
+                f"{provider} and dataset family {dataset_family}"
+            )
+
+        if year not in described["years"]:
+            msg = (
+                f"year {year} not described in YAML for provider {provider} "
+                f"with source {source}"
+            )
+            raise ValueError(msg)
+
+        territories = described["territories"]
+        if territories is None:
+            territory = None
+        elif territory not in territories:
+            msg = f"error on territory : {territory} not in {territories}"
+            raise ValueError(msg)
+
+        return self.entries[(provider, dataset_family, source, territory, year)]
+
+
+@lru_cache(maxsize=None)
+def get_sources_catalog(location: str = config_file) -> SourcesCatalog:
+    """
+    Get the catalog of the sources described in the YAML file. The YAML is
+    parsed (and validated) only once per process.
+
+    Parameters
+    ----------
+    location : str, optional
+        YAML file location. The default is cartiflette/utils/sources.yaml.
+
+    Returns
+    -------
+    SourcesCatalog
+        Catalog of sources
+
+    """
+    catalog = SourcesCatalog(import_yaml_config(location))
+    logger.debug(f"{len(catalog)} combinations described in {location}")
+    return catalog
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Tuple, Union
+
+
+def split_outputs(
+    local_dir: str = "temp",
+    territory: str = "metropole",
+    niveau_agreg: str = "DEPARTEMENT",
+    format_output: Union[str, List[str]] = "topojson",
+    simplification: Union[float, List[float]] = 0,
+) -> Dict[Tuple[str, float], str]:
+    """
+    Local output directories of a split, for one or several formats and
+    simplification levels.
+
+    The outputs are ordered from the least to the most simplified (no
+    simplification first, then decreasing percentages of retained vertices),
+    which is the order in which they are produced by progressive
+    simplification.
+
+    Parameters
+    ----------
+    local_dir : str, optional
+        The local directory for file storage. The default is "temp".
+    territory : str, optional
+        The territory of the data. The default is "metropole".
+    niveau_agreg : str, optional
+        The level of aggregation for the split. The default is "DEPARTEMENT".
+    format_output : Union[str, List[str]], optional
+        The output format(s). The default is "topojson".
+    simplification : Union[float, List[float]], optional
+        The simplification level(s), as percentages of retained vertices (0 or
+        None for no simplification). The default is 0.
+
+    Returns
+    -------
+    Dict[Tuple[str, float], str]
+        The output directory of each (format, simplification)
+
+    """
+    formats = [format_output] if isinstance(format_output, str) else format_output
+    if not isinstance(simplification, (list, tuple)):
+        simplification = [simplification]
+    simplifications = sorted(
+        dict.fromkeys(simplification), key=lambda x: x or 100, reverse=True
+    )
+
+    return {
+        (format_output, simplification): (
+            f"{local_dir}/{territory}/{niveau_agreg}/{format_output}/{simplification=}"
+        )
+        for simplification in simplifications
+        for format_output in dict.fromkeys(formats)
+    }
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the in-process "bring closer" (shapely) against the mapshaper
+one, on a France-wide layer (EPSG:4326, with INSEE_DEP) :
+
+    python misc/benchmark_bring_closer.py path/to/france.geojson
+
+Both outputs are compared (number of features, total area in EPSG:3857 and
+largest Hausdorff distance between matching features) when mapshaper is
+available.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import geopandas as gpd
+
+from cartiflette.geoprocessing import bring_closer_file
+from cartiflette.mapshaper import mapshaper_bring_closer
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def summary(path):
+    gdf = gpd.read_file(path).to_crs(3857)
+    return len(gdf), gdf.area.sum()
+
+
+def max_distance(path, other_path):
+    # features are in the same order in both outputs
+    gdf = gpd.read_file(path).to_crs(3857)
+    other = gpd.read_file(other_path).to_crs(3857)
+    if len(gdf) != len(other):
+        return float("inf")
+    return gdf.geometry.hausdorff_distance(other.geometry, align=False).max()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="france-wide layer (ie temp.geojson)")
+    parser.add_argument("--level", default="DEPARTEMENT")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        output, seconds = timed(
+            bring_closer_file,
+            args.input,
+            os.path.join(workdir, "shapely.geojson"),
+            level_agreg=args.level,
+        )
+        print(f"shapely   : {seconds:.2f}s")
+        outputs = {"shapely": output}
+
+        if shutil.which("mapshaper"):
+            output, seconds = timed(
+                mapshaper_bring_closer, args.input, level_agreg=args.level
+            )
+            print(f"mapshaper : {seconds:.2f}s")
+            outputs["mapshaper"] = output
+
+        for engine, output in outputs.items():
+            count, area = summary(output)
+            print(f"{engine} : {count} features, area {area:.0f} m²")
+        if len(outputs) == 2:
+            print(f"max distance : {max_distance(*outputs.values()):.3f} m")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
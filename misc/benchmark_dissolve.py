@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the partitioned dissolve (parallel_dissolve_by) against the
+serial one (dissolve_by), on an enriched commune layer (as stored by the
+enrichment stage, ie COMMUNE.parquet) :
+
+    python misc/benchmark_dissolve.py path/to/COMMUNE.parquet --workers 1 2 4
+
+Each level is dissolved from the commune layer with each number of workers,
+and the results are checked to be the same as the serial dissolve's.
+"""
+
+import argparse
+import time
+
+import geopandas as gpd
+
+from cartiflette.config import CPUS, DISSOLVE_PARTITION
+from cartiflette.geoprocessing.dissolve import level_fields, parallel_dissolve_by
+from cartiflette.geoprocessing.wrangling import dissolve_by
+from cartiflette.utils import DICT_CORRESP_ADMINEXPRESS
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def read(path):
+    if path.endswith(".parquet"):
+        return gpd.read_parquet(path)
+    return gpd.read_file(path, engine="pyogrio")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="enriched commune layer")
+    parser.add_argument("--levels", nargs="+", default=["DEPARTEMENT", "ZONE_EMPLOI"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[2, CPUS])
+    args = parser.parse_args()
+
+    communes = read(args.input)
+    partition = DICT_CORRESP_ADMINEXPRESS[DISSOLVE_PARTITION]
+    print(f"{len(communes)} communes, {CPUS} CPUs available")
+
+    for level in args.levels:
+        by = DICT_CORRESP_ADMINEXPRESS[level]
+        fields = level_fields(level)
+        serial, seconds = timed(dissolve_by, communes, by, fields)
+        print(f"{level} : serial {seconds:.2f}s ({len(serial)} polygons)")
+
+        for workers in dict.fromkeys(args.workers):
+            parallel, seconds = timed(
+                parallel_dissolve_by, communes, by, fields, partition, workers
+            )
+            same = (
+                parallel[by].tolist() == serial[by].tolist()
+                and parallel.geometry.geom_equals(serial.geometry).all()
+            )
+            print(
+                f"{level} : {workers} workers {seconds:.2f}s "
+                f"({'same' if same else 'DIFFERENT'} result)"
+            )
+
+
+if __name__ == "__main__":
+    main()
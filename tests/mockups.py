@@ -37,6 +37,11 @@ def total_mock_s3(monkeypatch):
         }
 
     monkeypatch.setattr(MasterScraper, "download_unpack", mock_unpack)
+
+    def mock_download(self, x, check_md5=True):
+        return False, None, None
+
+    monkeypatch.setattr(MasterScraper, "download_archive", mock_download)
     # monkeypatch.setattr("cartiflette.THREADS_DOWNLOAD", 1)
 
     def mock_ls(folder):
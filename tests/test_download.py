@@ -1,18 +1,49 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+import io
+import requests
 import os
 import requests_cache
+import urllib3
 import logging
+import shutil
+import threading
+import time
+import zipfile
+import fsspec
+from pebble import ThreadPool
+import s3fs
+import geopandas as gpd
+import json
+from shapely.geometry import Point
 
 from cartiflette.download.dataset import Dataset
+from cartiflette.download.layer import Layer
+from cartiflette.download.md5_registry import Md5Registry
+from cartiflette.download.raw_store import (
+    RawStore,
+    list_raw_files,
+    resolve_raw_file,
+    supported_put_kwargs,
+)
+from cartiflette.download.report import RunReport
+from cartiflette.download.scheduler import DownloadScheduler, StagedPipeline
 from cartiflette.download.scraper import (
+    layers_pool,
     MasterScraper,
     validate_file,
     download_to_tempfile_http,
 )
 from cartiflette.download import download_all
-from cartiflette.utils import import_yaml_config
+from cartiflette.s3.preprocess import get_cog_year
+from cartiflette.download.download import (
+    _expand_combinations,
+    _plan_combinations,
+    _share_archive,
+    _upload_raw_dataset_to_s3,
+)
+from cartiflette.utils import import_yaml_config, get_sources_catalog
 from tests.conftest import (
     DUMMY_FILE_1,
     DUMMY_FILE_2,
@@ -23,6 +54,15 @@ from tests.conftest import (
 logger = logging.getLogger(__name__)
 
 
+@pytest.fixture
+def memory_fs():
+    "Système de fichiers en mémoire (vidé après chaque test)"
+    fs = fsspec.filesystem("memory")
+    yield fs
+    if fs.exists("bucket"):
+        fs.rm("bucket", recursive=True)
+
+
 def test_Dataset():
     """
     __md5__
@@ -37,6 +77,622 @@ def test_Dataset():
     pass
 
 
+def test_Dataset_unpack_nested_archive(monkeypatch, tmp_path):
+    """
+    test du dézipage d'archives imbriquées (zip dans zip), avec un seuil de
+    mise en mémoire minimal forçant l'écriture sur disque
+    """
+    monkeypatch.setattr(Dataset, "_get_last_md5", lambda x: None)
+
+    inner = io.BytesIO()
+    with zipfile.ZipFile(inner, "w") as archive:
+        archive.writestr("com_bv2022.dbf", b"x" * 4096)
+        archive.writestr("other.csv", b"dummy")
+
+    outer = tmp_path / "outer.zip"
+    with zipfile.ZipFile(outer, "w") as archive:
+        archive.writestr("fonds_bv2022.zip", inner.getvalue())
+
+    ds = Dataset("BV", "FondsDeCarte_BV_2022", 2022, "Insee", None)
+    ds.get_path_from_provider()
+    ds.set_temp_file_path(str(outer))
+    root, paths = ds.unpack(protocol="zip", spool_size=1024)
+    try:
+        assert len(paths) == 1
+        (path,) = paths[0]
+        assert path.endswith("com_bv2022.dbf")
+        assert os.path.getsize(path) == 4096
+    finally:
+        shutil.rmtree(root)
+
+
+def test_Layer_metadata_probe(monkeypatch, tmp_path):
+    """
+    test de l'évaluation d'une couche SIG : la projection et le territoire
+    doivent être déduits des seules métadonnées, sans lecture des géométries
+    """
+    monkeypatch.setattr(Dataset, "_get_last_md5", lambda x: None)
+
+    path = str(tmp_path / "COMMUNE.shp")
+    gpd.GeoDataFrame(
+        {"INSEE_COM": ["75056"]}, geometry=[Point(652000, 6862000)], crs=2154
+    ).to_file(path, encoding="utf-8")
+
+    def forbidden_read(*args, **kwargs):
+        raise AssertionError("geometries should not be loaded")
+
+    monkeypatch.setattr(gpd, "read_file", forbidden_read)
+
+    ds = Dataset("ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE", 2022, "IGN", None)
+    files = {str(x): True for x in tmp_path.iterdir()}
+    layer = Layer(ds, "COMMUNE", files)
+    assert layer.crs == 2154
+    assert layer.format == "shp"
+    assert layer.territory == "metropole"
+
+
+def test_unpack_layers_pool(monkeypatch, tmp_path):
+    """
+    test de l'évaluation des couches d'une archive par un pool de processus
+    (lancés par spawn) : seule une description du Dataset est transmise aux
+    processus, les couches retournées sont rattachées au Dataset
+    """
+    monkeypatch.setattr(Dataset, "_get_last_md5", lambda x: None)
+
+    archive = tmp_path / "archive.zip"
+    with zipfile.ZipFile(archive, "w") as z:
+        for name, xy in [("COMMUNE", (652000, 6862000)), ("REGION", (0, 0))]:
+            folder = tmp_path / name
+            folder.mkdir()
+            gpd.GeoDataFrame(
+                {"CODE": ["1"]}, geometry=[Point(*xy)], crs=2154
+            ).to_file(folder / f"{name}.shp", encoding="utf-8")
+            for path in folder.iterdir():
+                z.write(path, f"DONNEES_LIVRAISON/{name}/{path.name}")
+
+    def forbidden_pickle(self):
+        raise AssertionError("the Dataset should not be sent to the workers")
+
+    ds = Dataset(
+        "ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE", 2022, "IGN", "metropole"
+    )
+    ds.get_path_from_provider()
+    monkeypatch.setattr(Dataset, "__reduce_ex__", forbidden_pickle, raising=False)
+
+    with layers_pool(2) as pool:
+        result = MasterScraper(
+            cache_name=str(tmp_path / "cache.sqlite")
+        ).unpack_layers(ds, True, "Zip archive", str(archive), pool=pool)
+    try:
+        layers = result["layers"]
+        assert set(layers) == {"COMMUNE", "REGION"}
+        assert layers["COMMUNE"].territory == "metropole"
+        assert all(layer.crs == 2154 for layer in layers.values())
+        assert all(layer.dataset is ds for layer in layers.values())
+        assert not os.path.exists(archive)
+    finally:
+        shutil.rmtree(result["root_cleanup"])
+
+    with layers_pool(1) as pool:
+        assert pool is None
+
+
+def test_DownloadScheduler():
+    """
+    test de l'ordonnanceur : les plus gros fichiers sont téléchargés en
+    premier pour chaque hôte, tous les résultats sont retournés
+    """
+    sizes = {"https://h1/a": 1, "https://h1/b": 3, "https://h2/c": 2}
+
+    class DummySession:
+        def head(self, url, *args, **kwargs):
+            response = requests.Response()
+            response.headers = {"Content-length": sizes[url]}
+            return response
+
+    order = []
+
+    def func(key):
+        order.append(key)
+        return key.upper()
+
+    scheduler = DownloadScheduler(
+        DummySession(),
+        hosts_concurrency={"h1": 1, "h2": 1},
+        default_concurrency=2,
+        disk_budget=10,
+    )
+    jobs = [("a", "https://h1/a"), ("b", "https://h1/b"), ("c", "https://h2/c")]
+    results = dict(scheduler.run(jobs, func))
+    assert results == {"a": "A", "b": "B", "c": "C"}
+    assert [x for x in order if x != "c"] == ["b", "a"]
+
+    # chaque copie d'une archive partagée est comptée dans le budget
+    used = {}
+
+    def func(key):
+        used[key] = scheduler.budget.used
+        return key
+
+    scheduler.default_concurrency = 1
+    list(scheduler.run(jobs, func, copies={"b": 3}))
+    assert used == {"a": 1, "b": 9, "c": 2}
+    assert scheduler.budget.used == 0
+
+
+def test_StagedPipeline():
+    """
+    test du pipeline par étapes : chaque élément traverse toutes les étapes,
+    les éléments en erreur sont ignorés, files d'attente bornées
+    """
+
+    def double(key, value):
+        if key == "error":
+            raise ValueError("dummy")
+        return value * 2
+
+    def label(key, value):
+        return f"{key}={value}"
+
+    for sequential in [False, True]:
+        stages = [(double, 3), (label, 2)]
+        with StagedPipeline(stages, queue_size=1, sequential=sequential) as p:
+            for k in range(10):
+                p.put(f"k{k}", k)
+            p.put("error", 0)
+        assert sorted(p.results) == sorted(
+            (f"k{k}", f"k{k}={2 * k}") for k in range(10)
+        )
+        assert [(key, stage) for key, stage, _ in p.failures] == [("error", 0)]
+
+
+def test_DownloadScheduler_budget_across_stages():
+    """
+    test du budget disque : les octets d'une archive restent réservés tant
+    qu'elle est en file d'attente, décompressée ou envoyée, y compris en cas
+    d'erreur lors de l'envoi
+    """
+    sizes = {f"https://h{k % 2}/{k}": 3 for k in range(8)}
+
+    class DummySession:
+        def head(self, url, *args, **kwargs):
+            response = requests.Response()
+            response.headers = {"Content-length": sizes[url]}
+            return response
+
+    scheduler = DownloadScheduler(
+        DummySession(), hosts_concurrency={}, default_concurrency=2, disk_budget=7
+    )
+    lock = threading.Lock()
+    on_disk = {"current": 0, "peak": 0, "reserved": 0}
+
+    def unpack(key, value):
+        time.sleep(0.01)
+        return value
+
+    def store(key, value):
+        ticket = value
+        try:
+            time.sleep(0.02)
+            if key.endswith("/5"):
+                raise ValueError("dummy")
+        finally:
+            with lock:
+                on_disk["current"] -= sizes[key]
+            ticket.release()
+        return key
+
+    with StagedPipeline([(unpack, 2), (store, 2)], queue_size=1) as pipeline:
+
+        def download(url, ticket):
+            with lock:
+                on_disk["current"] += sizes[url]
+                on_disk["peak"] = max(on_disk["peak"], on_disk["current"])
+                on_disk["reserved"] = max(on_disk["reserved"], ticket.budget.used)
+            ticket.add_holder()
+            pipeline.put(url, ticket)
+
+        list(scheduler.run([(url, url) for url in sizes], download, hold=True))
+
+    # 2 archives de 3 octets au plus simultanément pour un budget de 7
+    assert on_disk["peak"] == 6
+    assert on_disk["reserved"] <= 7
+    assert scheduler.budget.used == 0
+    assert len(pipeline.results) == 7
+    assert [key for key, _, _ in pipeline.failures] == ["https://h1/5"]
+
+
+def test_RunReport(tmp_path):
+    """
+    test du rapport d'exécution : durées, volumes et concurrence par étape
+    et par hôte, erreurs comptabilisées, export json
+    """
+    report = RunReport(
+        workers={"upload": 2}, hosts_workers={"h1": 3}, default_host_workers=2
+    )
+    with report.measure("download", host="h1") as event:
+        event["bytes"] = 1024**2
+        with report.measure("download", host="h2") as event:
+            event["bytes"] = 2 * 1024**2
+    with pytest.raises(ValueError):
+        with report.measure("upload", dataset="dummy"):
+            raise ValueError("dummy")
+
+    summary = report.summary()
+    assert summary["download"]["count"] == 2
+    assert summary["download"]["bytes"] == 3 * 1024**2
+    assert summary["download"]["max_concurrency"] == 2
+    assert summary["download"]["workers"] == {"h1": 3, "h2": 2}
+    assert summary["upload"]["errors"] == 1
+    assert summary["upload"]["workers"] == 2
+
+    report.to_json(tmp_path / "report.json")
+    with open(tmp_path / "report.json") as f:
+        written = json.load(f)
+    assert set(written["hosts"]) == {"h1", "h2"}
+    assert written["hosts"]["h1"]["workers"] == 3
+    assert written["hosts"]["h2"]["max_concurrency"] == 1
+    assert len(written["events"]) == 3
+
+
+def test_Md5Registry(memory_fs):
+    """
+    test du registre des md5 : les données sont lues une seule fois (json
+    historique et objets par dataset), les mises à jour sont écrites par lots,
+    un objet par dataset, sans perte en cas d'écritures concurrentes
+    """
+    fs = memory_fs
+    with fs.open("bucket/path/md5.json", "w") as f:
+        json.dump({"IGN": {"ADMINEXPRESS": {"SRC": {"null": {"2022": "x"}}}}}, f)
+
+    reads = []
+    registry = Md5Registry("bucket", "path", fs, batch_size=2)
+    read = registry._read
+    registry._read = lambda: reads.append(1) or read()
+
+    assert registry.get("IGN", "ADMINEXPRESS", "SRC", None, 2022) == "x"
+    assert registry.get("IGN", "ADMINEXPRESS", "SRC", None, 2023) is None
+    assert len(reads) == 1
+
+    # 1ère mise à jour : conservée en mémoire seulement
+    registry.update("IGN", "ADMINEXPRESS", "SRC", "metropole", 2022, "y")
+    assert registry.get("IGN", "ADMINEXPRESS", "SRC", "metropole", 2022) == "y"
+    assert not fs.exists("bucket/path/md5")
+
+    # 2nde mise à jour : écriture du lot
+    registry.update("IGN", "ADMINEXPRESS", "SRC", None, 2023, "z")
+    assert fs.exists("bucket/path/md5/IGN/ADMINEXPRESS/SRC/null/2023.json")
+    assert registry.flush()
+
+    # écritures concurrentes (ie. deux pods) : aucune mise à jour perdue
+    pod1 = Md5Registry("bucket", "path", fs, batch_size=10)
+    pod2 = Md5Registry("bucket", "path", fs, batch_size=10)
+    pod1.update("IGN", "ADMINEXPRESS", "SRC", "guyane", 2022, "a")
+    pod2.update("IGN", "ADMINEXPRESS", "SRC", "mayotte", 2022, "b")
+    pod1.flush()
+    pod2.flush()
+
+    new_run = Md5Registry("bucket", "path", fs)
+    assert new_run.get("IGN", "ADMINEXPRESS", "SRC", None, 2022) == "x"
+    assert new_run.get("IGN", "ADMINEXPRESS", "SRC", None, 2023) == "z"
+    assert new_run.get("IGN", "ADMINEXPRESS", "SRC", "metropole", 2022) == "y"
+    assert new_run.get("IGN", "ADMINEXPRESS", "SRC", "guyane", 2022) == "a"
+    assert new_run.get("IGN", "ADMINEXPRESS", "SRC", "mayotte", 2022) == "b"
+
+
+def test_Md5Registry_snapshot(monkeypatch, memory_fs):
+    """
+    test de la compaction du registre des md5 : les objets par dataset sont
+    regroupés dans un instantané, seuls les objets plus récents que celui-ci
+    étant lus ensuite
+    """
+    fs = memory_fs
+    with fs.open("bucket/path/md5.json", "w") as f:
+        json.dump({"IGN": {"ADMINEXPRESS": {"SRC": {"null": {"2022": "x"}}}}}, f)
+
+    registry = Md5Registry("bucket", "path", fs)
+    for territory in ["metropole", "guyane", "mayotte"]:
+        registry.update("IGN", "ADMINEXPRESS", "SRC", territory, 2022, territory)
+    registry.flush()
+
+    reads = []
+    cat = fs.cat
+
+    def counting_cat(paths, **kwargs):
+        reads.append(paths)
+        return cat(paths, **kwargs)
+
+    monkeypatch.setattr(fs, "cat", counting_cat)
+
+    # 1ère lecture : 3 objets plus récents que l'instantané (inexistant)
+    first = Md5Registry("bucket", "path", fs, compaction=3)
+    assert first.get("IGN", "ADMINEXPRESS", "SRC", "guyane", 2022) == "guyane"
+    assert len(reads[-1]) == 3
+    assert fs.exists("bucket/path/md5_snapshot.json")
+
+    # 2nde lecture : instantané seul (json historique inclus)
+    reads.clear()
+    second = Md5Registry("bucket", "path", fs, compaction=3)
+    assert second.get("IGN", "ADMINEXPRESS", "SRC", None, 2022) == "x"
+    assert second.get("IGN", "ADMINEXPRESS", "SRC", "mayotte", 2022) == "mayotte"
+    assert not reads
+
+    # mise à jour d'un dataset : seul son objet est relu
+    second.update("IGN", "ADMINEXPRESS", "SRC", "guyane", 2022, "new")
+    second.flush()
+    third = Md5Registry("bucket", "path", fs, compaction=3)
+    assert third.get("IGN", "ADMINEXPRESS", "SRC", "guyane", 2022) == "new"
+    assert third.get("IGN", "ADMINEXPRESS", "SRC", "metropole", 2022) == "metropole"
+    assert len(reads) == 1 and len(reads[0]) == 1
+
+
+def test_upload_raw_dataset_to_s3(monkeypatch, tmp_path, memory_fs):
+    """
+    test de l'envoi groupé des fichiers des couches sur le s3 (stockage
+    adressé par contenu : un même fichier n'est envoyé qu'une fois pour deux
+    millésimes) et de l'enregistrement du md5 du dataset
+    """
+    monkeypatch.setattr(Dataset, "_get_last_md5", lambda x: None)
+    fs = memory_fs
+    registry = Md5Registry("bucket", "path", fs)
+    store = RawStore("bucket", "path", fs)
+
+    class DummyLayer:
+        crs = 2154
+        format = "shp"
+        provider = "IGN"
+        dataset_family = "ADMINEXPRESS"
+        source = "EXPRESS-COG-TERRITOIRE"
+        territory = "metropole"
+
+    all_paths = {}
+    for year in [2022, 2023]:
+        dataset = Dataset(year=year, territory="metropole", registry=registry)
+        layers = {}
+        for name in ["COMMUNE", "REGION"]:
+            layers[name] = DummyLayer()
+            layers[name].year = year
+            layers[name].files_to_upload = {}
+            for ext in ["shp", "shx", "dbf"]:
+                path = tmp_path / str(year) / f"{name.lower()}.{ext}"
+                path.parent.mkdir(exist_ok=True)
+                path.write_bytes(f"{name}.{ext}".encode())
+                layers[name].files_to_upload[str(path)] = f"{name}.{ext}"
+
+        root_cleanup = tmp_path / "cleanup"
+        root_cleanup.mkdir()
+        result = {
+            "downloaded": True,
+            "hash": "dummy",
+            "layers": layers,
+            "root_cleanup": str(root_cleanup),
+        }
+        all_paths[year] = _upload_raw_dataset_to_s3(
+            dataset, result, "bucket", "path", fs, store
+        )
+        assert not root_cleanup.exists()
+
+    for paths in all_paths.values():
+        assert set(paths) == {"COMMUNE", "REGION"}
+        folder = paths["COMMUNE"][0].rsplit("/", 1)[0]
+        files = list_raw_files(fs, folder)
+        assert len(files) == 6
+        contents = {
+            x.rsplit("/", 1)[-1]: fs.cat(resolve_raw_file(fs, x)) for x in files
+        }
+        for name, content in contents.items():
+            assert name.startswith(content.decode())
+
+    # 6 fichiers distincts stockés une seule fois
+    assert len(fs.find("bucket/path/raw-store")) == 6
+
+    assert registry.flush()
+    assert fs.exists(
+        "bucket/path/md5/IGN/ADMINEXPRESS/EXPRESS-COG-TERRITOIRE/metropole/"
+        "2022.json"
+    )
+
+
+def test_RawStore_concurrent_uploads(tmp_path, memory_fs):
+    """
+    test des envois concurrents vers un même dossier : chaque entrée du
+    manifeste est un objet distinct, aucune n'est perdue
+    """
+    store = RawStore("bucket", "path", memory_fs)
+    folder = "bucket/path/raw/territory=metropole"
+    files = {}
+    for k in range(20):
+        path = tmp_path / f"file{k}.csv"
+        path.write_bytes(f"content {k}".encode())
+        files[str(path)] = f"{folder}/file{k}.csv"
+
+    with ThreadPool(8) as pool:
+        futures = [
+            pool.schedule(store.put, args=({path: logical},))
+            for path, logical in files.items()
+        ]
+        for future in futures:
+            future.result()
+
+    listed = list_raw_files(memory_fs, folder)
+    assert listed == sorted(files.values())
+    for path, logical in files.items():
+        with open(path, "rb") as f:
+            assert memory_fs.cat(resolve_raw_file(memory_fs, logical)) == f.read()
+
+
+def test_get_cog_year_raw_store(tmp_path, memory_fs):
+    """
+    test de la lecture des tables du COG stockées par contenu : les entrées du
+    manifeste ne sont pas lues comme des csv
+    """
+    store = RawStore("bucket", "path", memory_fs)
+    folder = (
+        "bucket/path/year=2022/administrative_level=None/crs=4326/"
+        "origin=raw/vectorfile_format=csv/provider=Insee/dataset_family=COG/"
+        "source=REGION/territory=france_entiere/simplification=0"
+    )
+    path = tmp_path / "region.csv"
+    path.write_text("REG,LIBELLE\n11,Île-de-France\n24,Centre-Val de Loire\n")
+    store.put({str(path): f"{folder}/REGION.csv"})
+
+    cog = get_cog_year(2022, "bucket", "path", memory_fs)
+    assert cog["REGION"]["LIBELLE"].tolist() == [
+        "Île-de-France",
+        "Centre-Val de Loire",
+    ]
+    assert cog["COMMUNE"].empty
+
+
+def test_supported_put_kwargs(memory_fs):
+    """
+    test du filtrage de max_concurrency pour les versions de s3fs ne gérant
+    pas les envois multipart concurrents
+    """
+
+    class OldS3FileSystem(s3fs.S3FileSystem):
+        async def _put_file(self, lpath, rpath, callback=None, chunksize=1, **kw):
+            pass
+
+    kwargs = {"batch_size": 2, "max_concurrency": 4}
+    fs = OldS3FileSystem(anon=True, skip_instance_cache=True)
+    assert supported_put_kwargs(fs, kwargs) == {"batch_size": 2}
+    fs = s3fs.S3FileSystem(anon=True, skip_instance_cache=True)
+    assert supported_put_kwargs(fs, kwargs) == kwargs
+    assert supported_put_kwargs(memory_fs, kwargs) == kwargs
+
+
+def test_share_archive(tmp_path):
+    """
+    test du partage d'une archive téléchargée entre plusieurs combinaisons
+    (millésimes pointant vers le même fichier) : chacune dispose de son
+    propre chemin, supprimé après dézipage
+    """
+    path = tmp_path / "archive.zip"
+    path.write_bytes(b"dummy")
+    shared = _share_archive((True, "Zip archive", str(path)), 3)
+    assert len({x[2] for x in shared}) == 3
+    for downloaded, filetype, this_path in shared:
+        assert downloaded and filetype == "Zip archive"
+        with open(this_path, "rb") as f:
+            assert f.read() == b"dummy"
+    os.unlink(shared[0][2])
+    assert os.path.exists(shared[1][2])
+
+    assert _share_archive((False, None, None), 2) == [(False, None, None)] * 2
+    assert _share_archive(None, 2) == [None, None]
+
+
+def test_plan_combinations(monkeypatch, memory_fs):
+    """
+    test de la planification d'une synchronisation (sans téléchargement) :
+    comparaison des en-têtes avec le registre des md5 et volumes estimés
+    """
+    fs = memory_fs
+    registry = Md5Registry("bucket", "path", fs)
+    source = ("IGN", "ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE")
+    registry.update(*source, "metropole", 2022, "same")
+    registry.update(*source, "guyane", 2022, "old")
+    registry.update(*source, "mayotte", 2022, "old")
+    registry.flush()
+
+    headers = {
+        "metropole": {"Content-length": "100", "content-md5": "same"},
+        "guyane": {"Content-length": "10", "content-md5": "new"},
+        "mayotte": {"Content-length": "20"},
+        "martinique": {},
+    }
+
+    catalog = get_sources_catalog()
+    headers = {
+        catalog.resolve(*source, territory, 2022)["url"]: these_headers
+        for territory, these_headers in headers.items()
+    }
+
+    def mock_head(self, url, *args, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = headers[url]
+        return response
+
+    monkeypatch.setattr(MasterScraper, "head", mock_head)
+
+    combinations = _expand_combinations(
+        ["IGN"],
+        ["ADMINEXPRESS"],
+        ["EXPRESS-COG-TERRITOIRE"],
+        ["metropole", "guyane", "mayotte", "martinique"],
+        [2022],
+    )
+    monkeypatch.setattr(
+        "cartiflette.download.download.DOWNLOAD_DISK_BUDGET", 15
+    )
+    plan = _plan_combinations(combinations, "bucket", "path", fs)
+
+    status = {x["territory"]: x["status"] for x in plan["datasets"]}
+    assert status == {
+        "metropole": "unchanged",
+        "guyane": "changed",
+        "mayotte": "unknown",
+        "martinique": "new",
+    }
+    assert plan["to_download"] == 4
+    assert plan["changed"] == 3
+    assert plan["unknown_sizes"] == 1
+    assert plan["transfer_bytes"] == 130
+    assert plan["disk_bytes"] == 100
+
+
+def test_plan_combinations_shared_url(monkeypatch, memory_fs):
+    """
+    test de la planification de combinaisons partageant une même url (un seul
+    HEAD et un seul transfert, mais une copie de l'archive par combinaison
+    sur le disque)
+    """
+    fs = memory_fs
+    source = ("IGN", "ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE")
+    catalog = get_sources_catalog()
+    shared = catalog.resolve(*source, "metropole", 2019)["url"]
+    assert catalog.resolve(*source, "guyane", 2019)["url"] == shared
+    headers = {
+        shared: {"Content-length": "100"},
+        catalog.resolve(*source, "metropole", 2021)["url"]: {"Content-length": "30"},
+        catalog.resolve(*source, "guyane", 2021)["url"]: {"Content-length": "20"},
+    }
+
+    heads = []
+
+    def mock_head(self, url, *args, **kwargs):
+        heads.append(url)
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = headers[url]
+        return response
+
+    monkeypatch.setattr(MasterScraper, "head", mock_head)
+
+    combinations = _expand_combinations(
+        ["IGN"],
+        ["ADMINEXPRESS"],
+        ["EXPRESS-COG-TERRITOIRE"],
+        ["metropole", "guyane"],
+        [2019, 2021],
+    )
+    monkeypatch.setattr(
+        "cartiflette.download.download.DOWNLOAD_DISK_BUDGET", 1000
+    )
+    plan = _plan_combinations(combinations, "bucket", "path", fs)
+
+    assert sorted(heads) == sorted(headers)
+    sizes = {(x["territory"], x["year"]): x["size"] for x in plan["datasets"]}
+    assert sizes[("metropole", 2019)] == sizes[("guyane", 2019)] == 100
+    assert plan["to_download"] == 4
+    assert plan["downloads"] == 3
+    assert plan["transfer_bytes"] == 150
+    # chaque combinaison décompresse sa propre copie de l'archive partagée
+    assert plan["disk_bytes"] == 250
+
+
 def test_file_validation():
     """
     test la validation des fichiers (méthode statique)
@@ -45,6 +701,51 @@ def test_file_validation():
     assert not validate_file(DUMMY_FILE_2, HASH_DUMMY)
 
 
+def test_MasterScraper_cache_policy(tmp_path):
+    """
+    test de la politique de cache : les archives ne sont pas stockées dans le
+    cache sqlite, contrairement aux en-têtes et aux petits fichiers
+    """
+
+    class DummyAdapter(requests.adapters.BaseAdapter):
+        def send(self, request, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response.request = request
+            response.url = request.url
+            if request.url.endswith(".zip"):
+                content_type = "application/zip"
+            else:
+                content_type = "text/csv"
+            response.headers = requests.structures.CaseInsensitiveDict(
+                {"Content-Type": content_type, "Content-length": "5"}
+            )
+            response.raw = urllib3.response.HTTPResponse(
+                body=io.BytesIO(b"dummy"),
+                headers=response.headers,
+                status=200,
+                preload_content=False,
+                request_url=request.url,
+            )
+            return response
+
+        def close(self):
+            pass
+
+    with MasterScraper(cache_name=str(tmp_path / "cache.sqlite")) as s:
+        s.mount("https://", DummyAdapter())
+        s.head("https://dummy/archive.zip")
+        s.get("https://dummy/archive.zip", stream=True)
+        s.get("https://dummy/file.csv")
+        cached = {
+            (x.request.method, x.url) for x in s.cache.responses.values()
+        }
+    assert cached == {
+        ("HEAD", "https://dummy/archive.zip"),
+        ("GET", "https://dummy/file.csv"),
+    }
+
+
 def test_http_proxy():
     """
     Test du bon fonctionnement du proxy
@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import os
+import shutil
+import subprocess
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from shapely import affinity
+from shapely.geometry import box
+
+from cartiflette.geoprocessing import (
+    bring_closer,
+    bring_closer_file,
+    dissolve_levels,
+    python_split,
+)
+from cartiflette.geoprocessing.dissolve import parallel_dissolve_by
+from cartiflette.geoprocessing.wrangling import (
+    read_metadata,
+    enrich,
+    dissolve_by,
+    dissolve,
+    simplify,
+)
+from cartiflette.mapshaper import mapshaper_bring_closer
+from cartiflette.mapshaper.mapshaper_closer import (
+    ile_de_france_expression,
+    logical_conditions,
+    shift,
+    scale,
+)
+
+
+def _center(condition):
+    xmin, ymin, xmax, ymax = map(float, condition.split("=")[1].split(","))
+    return (xmin + xmax) / 2, (ymin + ymax) / 2
+
+
+@pytest.fixture
+def france():
+    """
+    Couche fictive (EPSG:3857) : un carré au centre de chaque emprise, plus
+    Paris (dans l'emprise de la métropole)
+    """
+    emprises = logical_conditions["EMPRISES"]
+    records = []
+    for territory, condition in emprises.items():
+        x, y = _center(condition)
+        geometry = box(x - 100, y - 100, x + 100, y + 100)
+        records.append({"INSEE_DEP": territory, "geometry": geometry})
+    x, y = _center(emprises["metropole"])
+    records.append({"INSEE_DEP": "75", "geometry": box(x, y, x + 1000, y + 500)})
+    return gpd.GeoDataFrame(records, crs=3857)
+
+
+def test_bring_closer(france):
+    """
+    test du rapprochement des DROM : sélection par emprise, zoom sur l'IDF et
+    transformations affines identiques à celles de mapshaper (mise à
+    l'échelle autour du centre de l'emprise des entités, puis translation)
+    """
+    result = bring_closer(france, level_agreg="DEPARTEMENT").to_crs(3857)
+
+    # métropole (2 entités) + zoom IDF + 5 DROM
+    assert len(result) == 2 + 1 + len(shift)
+    assert result.INSEE_DEP.tolist() == ["metropole", "75", "75", *shift]
+
+    # Zoom IDF : échelle 4 autour du centre, puis translation
+    zoom = logical_conditions["DEPARTEMENT"]["zoom idf"]
+    idf = result.geometry.iloc[2]
+    paris = france.geometry.iloc[-1]
+    assert idf.area == pytest.approx(paris.area * zoom**2, rel=1e-6)
+    assert idf.centroid.x == pytest.approx(paris.centroid.x - 650000, abs=1e-3)
+    assert idf.centroid.y == pytest.approx(paris.centroid.y + 275000, abs=1e-3)
+
+    for k, region in enumerate(shift, start=3):
+        original = france.loc[france.INSEE_DEP == region].geometry.iloc[0]
+        moved = result.geometry.iloc[k]
+        dx, dy = map(float, shift[region].split(","))
+        factor = float(scale[region])
+        expected = affinity.scale(original, factor, factor, origin="center")
+        expected = affinity.translate(expected, dx, dy)
+        assert moved.equals_exact(expected, tolerance=1e-3)
+
+
+def test_bring_closer_file(france, tmp_path):
+    """
+    test du rapprochement des DROM de fichier à fichier (une lecture, une
+    écriture, en EPSG:4326)
+    """
+    france.to_crs(4326).to_file(tmp_path / "france.geojson")
+    output = bring_closer_file(
+        str(tmp_path / "france.geojson"), str(tmp_path / "closer/france.geojson")
+    )
+    result = gpd.read_file(output)
+    assert result.crs.to_epsg() == 4326
+    assert len(result) == 2 + 1 + len(shift)
+
+
+def test_bring_closer_numeric_field(france):
+    """
+    test de la sélection de l'IDF sur un champ numérique (flottant à la
+    lecture) : 1109.0 correspond à "1109", comme dans l'expression mapshaper
+    """
+    assert ile_de_france_expression("ZE2020", ["1109"]) == "ZE2020 == '1109'"
+
+    france["ZE2020"] = [2001.0] * (len(france) - 1) + [1109.0]
+    result = bring_closer(france, level_agreg="ZONE_EMPLOI")
+    assert len(result) == 2 + 1 + len(shift)
+    assert result.ZE2020.iloc[2] == 1109
+
+
+@pytest.mark.skipif(shutil.which("mapshaper") is None, reason="mapshaper absent")
+def test_bring_closer_mapshaper(france, tmp_path, monkeypatch):
+    """
+    test de l'équivalence avec mapshaper_bring_closer (mêmes entités, dans le
+    même ordre, mêmes géométries)
+    """
+    monkeypatch.chdir(tmp_path)
+    france.to_crs(4326).to_file("france.geojson")
+    expected = gpd.read_file(mapshaper_bring_closer("france.geojson"))
+    result = gpd.read_file(bring_closer_file("france.geojson", "shapely.geojson"))
+
+    assert result.INSEE_DEP.tolist() == expected.INSEE_DEP.tolist()
+    for geometry, other in zip(result.geometry, expected.geometry):
+        assert geometry.equals_exact(other, tolerance=1e-6)
+
+
+@pytest.fixture
+def communes():
+    """
+    Couche fictive de 8 communes carrées (EPSG:2154), sur 2 départements
+    ("01" et "2A") de 2 régions
+    """
+    records = []
+    for k in range(8):
+        x, y = 800000 + 1000 * (k % 4), 6500000 + 1000 * (k // 4)
+        dep = "01" if k % 4 < 2 else "2A"
+        records.append(
+            {
+                "INSEE_COM": f"{dep}{k:03d}",
+                "NOM_M": f"COMMUNE {k}",
+                "INSEE_DEP": dep,
+                "INSEE_REG": "84" if dep == "01" else "94",
+                "POPULATION": 10 * k,
+                "geometry": box(x, y, x + 1000, y + 1000),
+            }
+        )
+    return gpd.GeoDataFrame(records, crs=2154)
+
+
+@pytest.fixture
+def metadata_file(communes, tmp_path):
+    "Métadonnées fictives (équivalent de tagc.csv, avec la colonne d'index)"
+    metadata = pd.DataFrame(
+        {
+            "CODGEO": communes.INSEE_COM,
+            "DEP": communes.INSEE_DEP,
+            "REG": communes.INSEE_REG,
+            "ZE2020": ["1109"] * 8,
+            "LIBELLE_DEPARTEMENT": communes.INSEE_DEP.map(
+                {"01": "Ain", "2A": "Corse-du-Sud"}
+            ),
+            "LIBELLE_REGION": communes.INSEE_REG.map(
+                {"84": "Auvergne-Rhône-Alpes", "94": "Corse"}
+            ),
+        }
+    )
+    path = str(tmp_path / "tagc.csv")
+    metadata.to_csv(path)
+    return path
+
+
+def test_enrich(communes, metadata_file):
+    """
+    test de l'enrichissement : jointure avec les métadonnées (typées comme
+    par mapshaper), suppression et renommage de champs, champ PAYS
+    """
+    metadata = read_metadata(metadata_file)
+    assert "Unnamed: 0" not in metadata.columns
+    assert metadata.ZE2020.tolist() == [1109] * 8
+    assert metadata.DEP.tolist()[:2] == ["01", "01"]
+
+    enriched = enrich(communes, metadata)
+    assert enriched.crs.to_epsg() == 4326
+    assert len(enriched) == 8
+    assert "NOM_M" not in enriched.columns
+    assert enriched.INSEE_DEP.tolist() == communes.INSEE_DEP.tolist()
+    # codes régions sans zéro initial : numériques, comme avec mapshaper
+    assert enriched.INSEE_REG.tolist() == communes.INSEE_REG.astype(int).tolist()
+    assert (enriched.PAYS == "France").all()
+    assert enriched.LIBELLE_DEPARTEMENT.iloc[-1] == "Corse-du-Sud"
+
+
+def test_dissolve(communes, metadata_file):
+    """
+    test de la fusion des communes en départements : union des géométries,
+    somme des populations, copie des champs nécessaires au découpage
+    """
+    enriched = enrich(communes.to_crs(4326), read_metadata(metadata_file))
+    dissolved = dissolve(enriched, "DEPARTEMENT", "REGION")
+
+    assert dissolved.columns.tolist() == [
+        "INSEE_DEP",
+        "INSEE_REG",
+        "LIBELLE_DEPARTEMENT",
+        "LIBELLE_REGION",
+        "POPULATION",
+        "geometry",
+    ]
+    assert dissolved.INSEE_DEP.tolist() == ["01", "2A"]
+    assert dissolved.POPULATION.tolist() == [
+        communes.loc[communes.INSEE_DEP == dep, "POPULATION"].sum()
+        for dep in ["01", "2A"]
+    ]
+    areas = dissolved.to_crs(2154).area
+    assert areas.tolist() == pytest.approx([4e6, 4e6], rel=1e-6)
+    assert dissolved.geometry.geom_type.tolist() == ["Polygon", "Polygon"]
+
+
+def test_dissolve_levels(communes, metadata_file):
+    """
+    test de la fusion hiérarchique : chaque niveau est calculé depuis son
+    niveau parent, avec le même résultat qu'une fusion depuis les communes
+    """
+    enriched = enrich(communes.to_crs(4326), read_metadata(metadata_file))
+    levels = dissolve_levels(enriched, ["REGION", "FRANCE_ENTIERE", "ZONE_EMPLOI"])
+
+    # les niveaux parents sont aussi calculés, mais pas les communes
+    assert sorted(levels) == [
+        "DEPARTEMENT",
+        "FRANCE_ENTIERE",
+        "REGION",
+        "ZONE_EMPLOI",
+    ]
+    assert levels["DEPARTEMENT"].columns.tolist() == [
+        "INSEE_DEP",
+        "LIBELLE_DEPARTEMENT",
+        "INSEE_REG",
+        "LIBELLE_REGION",
+        "PAYS",
+        "POPULATION",
+        "geometry",
+    ]
+
+    region = levels["REGION"]
+    direct = dissolve(enriched, "REGION", "REGION")
+    assert region.INSEE_REG.tolist() == direct.INSEE_REG.tolist()
+    assert region.LIBELLE_REGION.tolist() == direct.LIBELLE_REGION.tolist()
+    assert region.POPULATION.tolist() == direct.POPULATION.tolist()
+    assert region.geometry.geom_equals(direct.geometry).all()
+
+    assert levels["FRANCE_ENTIERE"].PAYS.tolist() == ["France"]
+    assert levels["FRANCE_ENTIERE"].POPULATION.tolist() == [
+        communes.POPULATION.sum()
+    ]
+    assert levels["ZONE_EMPLOI"].ZE2020.tolist() == [1109]
+
+
+def test_parallel_dissolve_by(communes, metadata_file):
+    """
+    test de la fusion parallélisée (partitionnée par département) : même
+    résultat que la fusion séquentielle, y compris pour une zone à cheval sur
+    plusieurs départements
+    """
+    enriched = enrich(communes.to_crs(4326), read_metadata(metadata_file))
+    enriched["ZE2020"] = [1109, 1109, 1109, 1110, 1110, 1109, 1109, 1110]
+    enriched = enriched.iloc[::-1]
+
+    serial = dissolve_by(enriched, "ZE2020", ["PAYS", "INSEE_DEP"])
+    parallel = parallel_dissolve_by(
+        enriched, "ZE2020", ["PAYS", "INSEE_DEP"], "INSEE_DEP", max_workers=2
+    )
+
+    assert parallel.columns.tolist() == serial.columns.tolist()
+    assert parallel.ZE2020.tolist() == serial.ZE2020.tolist() == [1110, 1109]
+    assert parallel.INSEE_DEP.tolist() == serial.INSEE_DEP.tolist()
+    assert parallel.POPULATION.tolist() == serial.POPULATION.tolist()
+    assert parallel.geometry.geom_equals(serial.geometry).all()
+
+
+@pytest.fixture
+def coverage():
+    """
+    Couverture fictive : carrés aux bords ondulés, découpés par des lignes
+    communes (bords partagés, sommets non alignés)
+    """
+    t = np.linspace(0, 1000, 400)
+    lines = [box(0, 0, 1000, 1000).exterior]
+    for i in range(1, 10):
+        lines.append(shapely.linestrings(100 * i + 10 * np.sin(t / 7 + i), t))
+        lines.append(shapely.linestrings(t, 100 * i + 10 * np.cos(t / 9 + i)))
+    noded = shapely.get_parts(shapely.node(shapely.union_all(lines)))
+    cells = shapely.get_parts(shapely.polygonize(noded))
+    return gpd.GeoDataFrame(geometry=cells, crs=2154)
+
+
+def test_simplify(coverage):
+    """
+    test de la simplification : proportion de sommets conservés (sur
+    l'ensemble des sommets, et non sur les seuls sommets supprimables comme
+    mapshaper) et préservation de la topologie (pas de trous ni de
+    recouvrements)
+    """
+    simplified = simplify(coverage, 10)
+    before = shapely.get_num_coordinates(coverage.geometry.values).sum()
+    after = shapely.get_num_coordinates(simplified.geometry.values).sum()
+    assert after / before == pytest.approx(0.1, abs=0.01)
+    assert simplified.area.sum() == pytest.approx(1e6, rel=1e-6)
+    assert simplified.union_all().area == pytest.approx(1e6, rel=1e-6)
+
+
+def test_simplify_without_coverage_simplify(coverage, monkeypatch):
+    """
+    test de la simplification avec shapely < 2.1 (sans coverage_simplify) :
+    simplification des arcs partagés avec topojson
+    """
+    monkeypatch.delattr(shapely, "coverage_simplify", raising=False)
+    simplified = simplify(coverage, 10)
+    before = shapely.get_num_coordinates(coverage.geometry.values).sum()
+    after = shapely.get_num_coordinates(simplified.geometry.values).sum()
+    assert after / before == pytest.approx(0.1, abs=0.01)
+    assert len(simplified) == len(coverage)
+    assert simplified.area.sum() == pytest.approx(1e6, rel=1e-6)
+    assert simplified.union_all().area == pytest.approx(1e6, rel=1e-6)
+
+
+@pytest.mark.skipif(shutil.which("mapshaper") is None, reason="mapshaper absent")
+def test_simplify_mapshaper(coverage, tmp_path):
+    """
+    test de la proximité avec mapshaper -simplify : les sommets conservés
+    diffèrent (Visvalingam pondéré, pourcentage des sommets supprimables),
+    mais leur nombre et la surface couverte restent comparables
+    """
+    coverage.to_file(tmp_path / "coverage.geojson")
+    subprocess.run(
+        f"mapshaper {tmp_path}/coverage.geojson -simplify 10% "
+        f"-o {tmp_path}/simplified.geojson",
+        shell=True,
+        check=True,
+    )
+    expected = gpd.read_file(tmp_path / "simplified.geojson")
+    simplified = simplify(coverage, 10)
+
+    count = shapely.get_num_coordinates(simplified.geometry.values).sum()
+    expected_count = shapely.get_num_coordinates(expected.geometry.values).sum()
+    assert count == pytest.approx(expected_count, rel=0.2)
+    assert simplified.area.sum() == pytest.approx(expected.area.sum(), rel=1e-3)
+
+
+@pytest.mark.parametrize("format_output", ["geojson", "topojson", "gpkg"])
+def test_python_split(communes, metadata_file, tmp_path, format_output):
+    """
+    test du moteur python de bout en bout (dans un pool de processus) :
+    enrichissement, fusion en départements, découpage par région et écriture
+    d'un fichier par région
+    """
+    os.makedirs(tmp_path / "input")
+    communes.to_file(tmp_path / "input/COMMUNE.shp")
+    kwargs = {
+        "local_dir": str(tmp_path),
+        "config_file_city": {"location": str(tmp_path / "input")},
+        "format_output": format_output,
+        "niveau_polygons": "DEPARTEMENT",
+        "niveau_agreg": "REGION",
+        "metadata_file": metadata_file,
+    }
+    with ProcessPoolExecutor(1) as pool:
+        output_path = pool.submit(python_split, **kwargs).result()
+
+    files = sorted(glob.glob(f"{output_path}/*"))
+    assert [os.path.basename(x) for x in files] == [
+        f"84.{format_output}",
+        f"94.{format_output}",
+    ]
+    result = gpd.read_file(files[0])
+    assert len(result) == 1
+    assert result.SOURCE.tolist() == ["IGN:EXPRESS-COG-CARTO-TERRITOIRE"]
+
+
+def test_python_split_enriched(communes, metadata_file, tmp_path):
+    """
+    test du moteur python depuis un niveau déjà fusionné (geoparquet) : ni
+    enrichissement, ni fusion
+    """
+    enriched = enrich(communes.to_crs(4326), read_metadata(metadata_file))
+    os.makedirs(tmp_path / "dissolved")
+    dissolve_levels(enriched, ["DEPARTEMENT"])["DEPARTEMENT"].to_parquet(
+        tmp_path / "dissolved/DEPARTEMENT.parquet"
+    )
+
+    output_path = python_split(
+        local_dir=str(tmp_path),
+        config_file_city={
+            "location": str(tmp_path / "dissolved"),
+            "filename": "DEPARTEMENT",
+            "extension": "parquet",
+            "enriched": True,
+        },
+        format_output="geojson",
+        niveau_polygons="DEPARTEMENT",
+        niveau_agreg="REGION",
+        metadata_file=str(tmp_path / "absent.csv"),
+    )
+
+    files = sorted(glob.glob(f"{output_path}/*"))
+    assert [os.path.basename(x) for x in files] == ["84.geojson", "94.geojson"]
+    result = gpd.read_file(files[1])
+    assert result.INSEE_DEP.tolist() == ["2A"]
+    assert result.LIBELLE_REGION.tolist() == ["Corse"]
+
+
+def test_python_split_multiple_outputs(communes, metadata_file, tmp_path):
+    """
+    test du moteur python avec plusieurs formats et niveaux de simplification
+    : une seule lecture de la couche, simplifiée progressivement
+    """
+    os.makedirs(tmp_path / "input")
+    communes.to_file(tmp_path / "input/COMMUNE.shp")
+    outputs = python_split(
+        local_dir=str(tmp_path),
+        config_file_city={"location": str(tmp_path / "input")},
+        format_output=["geojson", "gpkg"],
+        niveau_polygons="DEPARTEMENT",
+        niveau_agreg="REGION",
+        simplification=[50, 0],
+        metadata_file=metadata_file,
+    )
+
+    assert list(outputs) == [
+        ("geojson", 0),
+        ("gpkg", 0),
+        ("geojson", 50),
+        ("gpkg", 50),
+    ]
+    for (format_output, _), output_path in outputs.items():
+        files = sorted(glob.glob(f"{output_path}/*"))
+        assert [os.path.basename(x) for x in files] == [
+            f"84.{format_output}",
+            f"94.{format_output}",
+        ]
+    assert outputs["geojson", 0].endswith("geojson/simplification=0")
+
+
+def test_execute_plan(communes, metadata_file, tmp_path):
+    """
+    test de l'exécution locale d'un plan : chaque opération partagée est
+    exécutée une seule fois
+    """
+    from cartiflette.pipeline.planner import (
+        ExecutionPlan,
+        split_operation,
+        local_handlers,
+        execute_plan,
+    )
+
+    communes.to_file(tmp_path / "COMMUNE.gpkg")
+    plan = ExecutionPlan(
+        [
+            split_operation(
+                level_polygons=level,
+                filter_by=filter_by,
+                format_output="geojson",
+                simplification=simplification,
+            )
+            for level, filter_by in [("DEPARTEMENT", "REGION"), ("REGION", "REGION")]
+            for simplification in (0, 50)
+        ]
+    )
+    handlers = local_handlers(
+        str(tmp_path / "COMMUNE.gpkg"),
+        metadata_file=metadata_file,
+        local_dir=str(tmp_path / "output"),
+    )
+    calls = []
+
+    def counting(kind, handler):
+        def run(*args):
+            calls.append(kind)
+            return handler(*args)
+
+        return run
+
+    handlers = {kind: counting(kind, handler) for kind, handler in handlers.items()}
+    results = execute_plan(plan, handlers)
+
+    assert calls.count("enrich") == 1
+    assert calls.count("dissolve") == 2
+    assert calls.count("split") == 4
+    assert len(results) == 4
+    files = sorted(
+        os.path.relpath(x, tmp_path / "output")
+        for x in glob.glob(f"{tmp_path}/output/**/*.geojson", recursive=True)
+    )
+    assert len(files) == 8
+    assert files[0] == "2022/DEPARTEMENT/REGION/geojson/simplification=0/84.geojson"
@@ -1,14 +1,31 @@
 import unittest
+from unittest import mock
 import tempfile
 import os
 import glob
+import json
 import shutil
-from shapely.geometry import Point
+import subprocess
+import threading
+from shapely.geometry import Point, box
 import pandas as pd
 import geopandas as gpd
 
 # Import the functions to be tested
-from cartiflette.mapshaper.mapshaper_wrangling import mapshaper_enrich, mapshaper_split
+from cartiflette.mapshaper.mapshaper_wrangling import (
+    mapshaper_enrich,
+    mapshaper_split,
+    mapshaper_command,
+    dissolve_commands,
+)
+from cartiflette.mapshaper.mapshaper_worker import (
+    MapshaperWorker,
+    MapshaperWorkerPool,
+)
+from cartiflette.mapshaper.mapshaperize import (
+    mapshaperize_split,
+    mapshaperize_split_merge,
+)
 
 
 class TestMapshaperWrangling(unittest.TestCase):
@@ -127,5 +144,245 @@ class TestMapshaperWrangling(unittest.TestCase):
             shutil.rmtree(output_path)
 
 
+class TestMapshaperCommands(unittest.TestCase):
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.local_dir)
+
+    def test_mapshaper_command(self):
+        cmd = mapshaper_command("in.geojson", "-proj EPSG:4326 ", "", "-o out.geojson")
+        self.assertEqual(
+            cmd, "mapshaper in.geojson name='' -proj EPSG:4326 -o out.geojson"
+        )
+
+    def test_dissolve_commands(self):
+        cmd = dissolve_commands(
+            "DEPARTEMENT",
+            "REGION",
+            {
+                "DEPARTEMENT": "INSEE_DEP",
+                "REGION": "INSEE_REG",
+                "LIBELLE_REGION": "LIBELLE_REGION",
+            },
+        )
+        self.assertIn("-dissolve INSEE_DEP ", cmd)
+        self.assertTrue(cmd.endswith("copy-fields=INSEE_DEP,INSEE_REG,LIBELLE_REGION"))
+
+    def test_mapshaperize_split_single_invocation(self):
+        # Every step (enrich, dissolve, bring closer, split) should be chained
+        # in a single mapshaper call, without intermediate files
+        with mock.patch(
+            "cartiflette.mapshaper.mapshaperize.run_mapshaper"
+        ) as run_mapshaper:
+            mapshaperize_split(
+                local_dir=self.local_dir,
+                niveau_polygons="DEPARTEMENT",
+                niveau_agreg="FRANCE_ENTIERE_DROM_RAPPROCHES",
+            )
+
+        run_mapshaper.assert_called_once()
+        cmd = run_mapshaper.call_args.args[0]
+        steps = ["-join", "-dissolve", "-affine", "-merge-layers", "-split", "-o"]
+        positions = [cmd.index(step) for step in steps]
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(cmd.count(" -o "), 1)
+        self.assertNotIn("temp.geojson", cmd)
+
+    def test_mapshaperize_split_merge_single_invocation(self):
+        with mock.patch(
+            "cartiflette.mapshaper.mapshaperize.run_mapshaper"
+        ) as run_mapshaper:
+            mapshaperize_split_merge(local_dir=self.local_dir)
+
+        run_mapshaper.assert_called_once()
+        cmd = run_mapshaper.call_args.args[0]
+        self.assertEqual(cmd.count(" -o "), 1)
+        self.assertIn("combine-files", cmd)
+        self.assertLess(cmd.index("-merge-layers"), cmd.index("-join"))
+
+    def test_mapshaperize_split_multiple_outputs(self):
+        # Every format and simplification level should be produced by a
+        # single mapshaper call, the layer being simplified progressively
+        with mock.patch(
+            "cartiflette.mapshaper.mapshaperize.run_mapshaper"
+        ) as run_mapshaper:
+            outputs = mapshaperize_split(
+                local_dir=self.local_dir,
+                niveau_polygons="DEPARTEMENT",
+                niveau_agreg="REGION",
+                format_output=["topojson", "geojson"],
+                simplification=[50, 0, 10],
+            )
+
+        self.assertEqual(
+            list(outputs),
+            [
+                ("topojson", 0),
+                ("geojson", 0),
+                ("topojson", 50),
+                ("geojson", 50),
+                ("topojson", 10),
+                ("geojson", 10),
+            ],
+        )
+        for output_path in outputs.values():
+            self.assertTrue(os.path.isdir(output_path))
+
+        run_mapshaper.assert_called_once()
+        cmd = run_mapshaper.call_args.args[0]
+        self.assertEqual(cmd.count("-join"), 1)
+        self.assertEqual(cmd.count("-dissolve"), 1)
+        self.assertEqual(cmd.count(" -o "), 6)
+        self.assertEqual(cmd.count("-split INSEE_REG"), 6)
+        simplify = [cmd.index("-simplify 50%"), cmd.index("-simplify 10%")]
+        self.assertEqual(simplify, sorted(simplify))
+        self.assertLess(cmd.index("format=geojson"), simplify[0])
+        self.assertNotIn("-simplify 0%", cmd)
+
+
+FAKE_MAPSHAPER = """
+const fs = require("fs");
+exports.runCommands = async (args, input) => {
+  // stray output on stdout must not be mistaken for an answer
+  process.stdout.write('{"id": 0, "ok": false}\\n');
+  if (args.includes("fail")) throw new Error("failure");
+  if (args.includes("hang")) await new Promise(() => {});
+  if (args.includes("sleep")) await new Promise((r) => setTimeout(r, 1000));
+  const output = args[args.indexOf("-o") + 1];
+  fs.writeFileSync(
+    output, JSON.stringify({args, input: Object.keys(input), pid: process.pid})
+  );
+};
+"""
+
+
+@unittest.skipIf(shutil.which("node") is None, "node is not installed")
+class TestMapshaperWorker(unittest.TestCase):
+    def setUp(self):
+        # Fake mapshaper module, recording the commands it receives
+        self.local_dir = tempfile.mkdtemp()
+        os.makedirs(f"{self.local_dir}/node_modules/mapshaper")
+        with open(f"{self.local_dir}/node_modules/mapshaper/index.js", "w") as f:
+            f.write(FAKE_MAPSHAPER)
+        with open(f"{self.local_dir}/input.geojson", "w") as f:
+            f.write("{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.local_dir)
+
+    def test_worker(self):
+        output = f"{self.local_dir}/output.json"
+        cmd = (
+            f"mapshaper {self.local_dir}/input.geojson name='' "
+            f"-each \"SOURCE='IGN:EXPRESS COG'\" -o {output}"
+        )
+        with mock.patch.dict(
+            os.environ, {"NODE_PATH": f"{self.local_dir}/node_modules"}
+        ), MapshaperWorker() as worker:
+            worker.run(cmd)
+            pid = worker.process.pid
+            worker.run(cmd)
+            # The same process is reused between commands
+            self.assertEqual(worker.process.pid, pid)
+
+            with open(output) as f:
+                result = json.load(f)
+            self.assertEqual(
+                result["args"],
+                [
+                    f"{self.local_dir}/input.geojson",
+                    "name=",
+                    "-each",
+                    "SOURCE='IGN:EXPRESS COG'",
+                    "-o",
+                    output,
+                ],
+            )
+            self.assertEqual(result["input"], [f"{self.local_dir}/input.geojson"])
+
+            # mapshaper errors are raised as the CLI would
+            with self.assertRaises(subprocess.CalledProcessError):
+                worker.run(f"mapshaper fail -o {output}")
+
+    def test_worker_timeout(self):
+        output = f"{self.local_dir}/output.json"
+        with mock.patch.dict(
+            os.environ, {"NODE_PATH": f"{self.local_dir}/node_modules"}
+        ), MapshaperWorker(timeout=2) as worker:
+            with self.assertRaises(subprocess.TimeoutExpired):
+                worker.run(f"mapshaper hang -o {output}")
+            self.assertIsNone(worker.process)
+
+            # The worker is restarted on the next command
+            worker.run(f"mapshaper {self.local_dir}/input.geojson -o {output}")
+            self.assertTrue(os.path.exists(output))
+
+    def test_pool(self):
+        outputs = [f"{self.local_dir}/output_{k}.json" for k in range(2)]
+        with mock.patch.dict(
+            os.environ, {"NODE_PATH": f"{self.local_dir}/node_modules"}
+        ), MapshaperWorkerPool(size=2) as pool:
+            threads = [
+                threading.Thread(target=pool.run, args=(f"mapshaper sleep -o {o}",))
+                for o in outputs
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Both commands ran concurrently, each on it's own worker
+            pids = set()
+            for output in outputs:
+                with open(output) as f:
+                    pids.add(json.load(f)["pid"])
+            self.assertEqual(len(pids), 2)
+            self.assertEqual(len(pool.workers), 2)
+
+            # An idle worker is reused
+            pool.run(f"mapshaper sleep -o {outputs[0]}")
+            self.assertEqual(len(pool.workers), 2)
+
+
+@unittest.skipIf(shutil.which("mapshaper") is None, "mapshaper is not installed")
+class TestMapshaperWorkerCLI(unittest.TestCase):
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+        gdf = gpd.GeoDataFrame(
+            {"INSEE_DEP": ["01", "01", "02"]},
+            geometry=[
+                box(0, 0, 1, 1),
+                box(1, 0, 2, 1.5),
+                Point(3, 3).buffer(0.5),
+            ],
+            crs="EPSG:4326",
+        )
+        gdf.to_file(f"{self.local_dir}/input.geojson", driver="GeoJSON")
+
+    def tearDown(self):
+        shutil.rmtree(self.local_dir)
+
+    def test_worker_matches_cli(self):
+        # The same command gives the same output through the CLI and the worker
+        def cmd(output):
+            return mapshaper_command(
+                f"{self.local_dir}/input.geojson",
+                "-dissolve INSEE_DEP",
+                "-simplify 50% keep-shapes",
+                f"-o {output} format=geojson",
+            )
+
+        subprocess.run(cmd(f"{self.local_dir}/cli.json"), shell=True, check=True)
+        with MapshaperWorker() as worker:
+            worker.run(cmd(f"{self.local_dir}/worker.json"))
+
+        with open(f"{self.local_dir}/cli.json") as f:
+            cli = json.load(f)
+        with open(f"{self.local_dir}/worker.json") as f:
+            self.assertEqual(json.load(f), cli)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,27 @@
 
 
-from cartiflette.pipeline import restructure_nested_dict_borders
+import os
+
+import fsspec
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+from cartiflette.pipeline import (
+    restructure_nested_dict_borders,
+    crossproduct_parameters_production,
+    enrich_communes_from_s3,
+    dissolve_levels_from_s3,
+    download_dissolved_level,
+    split_batch_from_s3,
+)
+from cartiflette.pipeline.enrich_communes import path_combined_layer
+from cartiflette.pipeline.mapshaper_split_from_s3 import prepare_merge_split_inputs
+from cartiflette.pipeline.prepare_cog_metadata import prepare_cog_metadata
+from cartiflette.utils import create_path_bucket
+from cartiflette.pipeline.planner import plan_from_crossproduct
+from cartiflette.pipeline.split_batch import parse_batch
 
 def test_restructure_nested_dict_borders():
     sample_dict = {'a': [1, 2, 3], 'b': [4, 5]}
@@ -12,3 +33,334 @@ def test_restructure_nested_dict_borders():
 
     single_item_dict = {'a': [1]}
     assert restructure_nested_dict_borders(single_item_dict) == [['a', 1]]
+
+
+@pytest.fixture
+def local_bucket(tmp_path):
+    "Local file system standing for the s3, holding the combined layer"
+    fs = fsspec.filesystem("file", auto_mkdir=True)
+    config = {
+        "bucket": str(tmp_path / "bucket"),
+        "path_within_bucket": "test",
+        "local_dir": str(tmp_path / "work"),
+        "metadata_file": str(tmp_path / "tagc.csv"),
+        "engine": "python",
+    }
+
+    communes = gpd.GeoDataFrame(
+        {
+            "INSEE_COM": ["01001", "01002", "2A001", "2A002"],
+            "INSEE_DEP": ["01", "01", "2A", "2A"],
+            "POPULATION": [1, 2, 3, 4],
+        },
+        geometry=[box(k, 0, k + 1, 1) for k in range(4)],
+        crs=4326,
+    )
+    path = path_combined_layer(
+        2022, "EXPRESS-COG-CARTO-TERRITOIRE", config["bucket"], "test"
+    )
+    os.makedirs(os.path.dirname(path))
+    communes.to_file(path)
+    pd.DataFrame(
+        {
+            "CODGEO": communes.INSEE_COM,
+            "DEP": communes.INSEE_DEP,
+            "REG": ["84", "84", "94", "94"],
+            "ZE2020": ["1109"] * 4,
+        }
+    ).to_csv(config["metadata_file"])
+    return fs, config
+
+
+def test_enrich_and_dissolve_stages(tmp_path, local_bucket):
+    fs, config = local_bucket
+    path_enriched = enrich_communes_from_s3(config, fs=fs)
+    enriched = gpd.read_parquet(path_enriched)
+    assert enriched.INSEE_REG.tolist() == [84, 84, 94, 94]
+
+    paths = dissolve_levels_from_s3(
+        {**config, "engine": "python"}, ["REGION", "ZONE_EMPLOI"], fs=fs
+    )
+    assert sorted(paths) == ["DEPARTEMENT", "REGION", "ZONE_EMPLOI"]
+    assert gpd.read_parquet(paths["REGION"]).POPULATION.tolist() == [3, 7]
+
+    kwargs = {"bucket": config["bucket"], "path_within_bucket": "test", "fs": fs}
+    kwargs["local_dir"] = str(tmp_path / "split")
+    assert download_dissolved_level("REGION", **kwargs) == {
+        "location": f"{tmp_path}/split/dissolved",
+        "filename": "REGION",
+        "extension": "parquet",
+        "enriched": True,
+    }
+    assert download_dissolved_level("COMMUNE", engine="mapshaper", **kwargs)[
+        "extension"
+    ] == "geojson"
+    assert os.path.exists(f"{tmp_path}/split/enriched/COMMUNE.geojson")
+    assert download_dissolved_level("BASSIN_VIE", **kwargs) is None
+
+
+def test_enrich_stage_mapshaper(tmp_path, local_bucket, monkeypatch):
+    fs, config = local_bucket
+    commands = []
+
+    def run_mapshaper(cmd):
+        commands.append(cmd)
+        input_file, output = cmd.split()[1], cmd.split(" -o ")[1].split()[0]
+        gpd.read_file(input_file).assign(PAYS="France").to_file(output)
+
+    monkeypatch.setattr(
+        "cartiflette.pipeline.enrich_communes.run_mapshaper", run_mapshaper
+    )
+    path = enrich_communes_from_s3({**config, "engine": "mapshaper"}, fs=fs)
+
+    local_dir = config["local_dir"]
+    assert len(commands) == 1
+    assert commands[0].startswith(
+        f"mapshaper {local_dir}/preprocessed_combined/COMMUNE.geojson"
+    )
+    assert f"-join {config['metadata_file']} " in commands[0]
+    assert f"-o {local_dir}/enriched/COMMUNE.geojson" in commands[0]
+    assert gpd.read_parquet(path).PAYS.tolist() == ["France"] * 4
+
+
+def test_dissolve_stage_mapshaper(tmp_path, local_bucket, monkeypatch):
+    fs, config = local_bucket
+    enrich_communes_from_s3(config, fs=fs)
+
+    commands = []
+
+    def run_mapshaper(cmd):
+        # each level is read from it's parent's file
+        commands.append(cmd)
+        input_file, output = cmd.split()[1], cmd.split(" -o ")[1].split()[0]
+        gpd.read_file(input_file).to_file(output)
+
+    monkeypatch.setattr(
+        "cartiflette.pipeline.dissolve_levels.run_mapshaper", run_mapshaper
+    )
+    paths = dissolve_levels_from_s3(
+        {**config, "engine": "mapshaper"}, ["REGION"], fs=fs
+    )
+    assert sorted(paths) == ["DEPARTEMENT", "REGION"]
+    assert all(fs.exists(path) for path in paths.values())
+
+    local_dir = config["local_dir"]
+    assert len(commands) == 2
+    assert commands[0].startswith(f"mapshaper {local_dir}/enriched/COMMUNE.geojson")
+    assert "-dissolve INSEE_DEP " in commands[0]
+    assert commands[1].startswith(f"mapshaper {local_dir}/dissolved/DEPARTEMENT")
+    assert "-dissolve INSEE_REG " in commands[1]
+
+
+def test_prepare_merge_split_inputs(tmp_path, local_bucket, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fs, config = local_bucket
+    arrondissements = create_path_bucket(
+        {
+            "bucket": config["bucket"],
+            "path_within_bucket": "test",
+            "year": 2022,
+            "borders": None,
+            "crs": 2154,
+            "filter_by": "origin",
+            "value": "raw",
+            "vectorfile_format": "shp",
+            "provider": "IGN",
+            "dataset_family": "ADMINEXPRESS",
+            "source": "EXPRESS-COG-CARTO-TERRITOIRE",
+            "territory": "metropole",
+            "filename": "ARRONDISSEMENT_MUNICIPAL.shp",
+            "simplification": 0,
+        }
+    ).rsplit("/", maxsplit=1)[0]
+    for extension in ["shp", "dbf"]:
+        fs.pipe(f"{arrondissements}/ARRONDISSEMENT_MUNICIPAL.{extension}", b"")
+
+    city, arrondissement = prepare_merge_split_inputs(
+        {**config, "simplification": [0, 50], "format_output": ["geojson"]}, fs=fs
+    )
+    # the inputs are downloaded to the job's working directory
+    assert city["location"] == f"{config['local_dir']}/preprocessed_combined"
+    assert arrondissement["location"] == f"{config['local_dir']}/metropole"
+    assert not os.path.exists(tmp_path / "temp")
+    assert os.path.exists(f"{city['location']}/COMMUNE.geojson")
+    assert sorted(os.listdir(arrondissement["location"])) == [
+        "ARRONDISSEMENT_MUNICIPAL.dbf",
+        "ARRONDISSEMENT_MUNICIPAL.shp",
+    ]
+
+
+def test_prepare_cog_metadata_year(tmp_path, monkeypatch):
+    years = []
+
+    def mock_upload_s3_raw(**kwargs):
+        years.append(kwargs["year"])
+        raise RuntimeError("stop")
+
+    monkeypatch.setattr(
+        "cartiflette.pipeline.prepare_cog_metadata.upload_s3_raw",
+        mock_upload_s3_raw,
+    )
+
+    # no TAGC for 2019 : rejected before any download
+    with pytest.raises(ValueError):
+        prepare_cog_metadata("test", local_dir=str(tmp_path), year=2019)
+    assert not years
+
+    with pytest.raises(RuntimeError):
+        prepare_cog_metadata("test", local_dir=str(tmp_path), year=2023)
+    assert years == [2023]
+
+
+def test_plan_deduplicates_shared_operations():
+    tempdf = pd.DataFrame(
+        {
+            "format_output": ["topojson", "geojson", "topojson", "topojson"],
+            "year": [2022] * 4,
+            "crs": [4326] * 4,
+            "source": ["EXPRESS-COG-CARTO-TERRITOIRE"] * 4,
+            "simplification": [50, 50, 0, 0],
+            "level_polygons": ["DEPARTEMENT", "DEPARTEMENT", "REGION", "REGION"],
+            "filter_by": ["REGION", "REGION", "TERRITOIRE", "TERRITOIRE"],
+        }
+    )
+    plan = plan_from_crossproduct(tempdf)
+    summary = plan.summary()
+
+    # duplicated row and shared prefixes appear once
+    assert summary["by_kind"] == {
+        "combine": 1,
+        "enrich": 1,
+        "dissolve": 2,
+        "project": 2,
+        "simplify": 1,
+        "split": 3,
+    }
+    assert summary["without_deduplication"] == 6 + 6 + 6
+    assert summary["operations"] == 10
+
+    # REGION is dissolved from DEPARTEMENT
+    region = next(x for x in plan if x.params.get("level") == "REGION")
+    assert region.inputs[0].params == {"level": "DEPARTEMENT"}
+
+    # each operation comes after it's inputs
+    seen = set()
+    for operation in plan:
+        assert all(x.key in seen for x in operation.inputs)
+        seen.add(operation.key)
+    assert [len(x) for x in plan.stages()] == [1, 1, 1, 2, 2, 3]
+
+    assert plan.split_jobs() == [
+        {
+            "year": 2022,
+            "source": "EXPRESS-COG-CARTO-TERRITOIRE",
+            "level_polygons": "DEPARTEMENT",
+            "filter_by": "REGION",
+            "crs": 4326,
+            "format_output": ["topojson", "geojson"],
+            "simplification": [50],
+        },
+        {
+            "year": 2022,
+            "source": "EXPRESS-COG-CARTO-TERRITOIRE",
+            "level_polygons": "REGION",
+            "filter_by": "TERRITOIRE",
+            "crs": 4326,
+            "format_output": ["topojson"],
+            "simplification": [0],
+        },
+    ]
+
+
+def test_plan_batches():
+    tempdf = crossproduct_parameters_production(
+        {
+            "COMMUNE": ["DEPARTEMENT", "REGION"],
+            "DEPARTEMENT": ["REGION", "TERRITOIRE", "FRANCE_ENTIERE"],
+            "REGION": ["TERRITOIRE", "FRANCE_ENTIERE"],
+        },
+        list_format=["topojson", "geojson"],
+        years=[2022],
+        crs_list=[4326],
+        sources=["EXPRESS-COG-CARTO-TERRITOIRE"],
+        simplifications=[0, 50],
+    )
+    plan = plan_from_crossproduct(tempdf)
+    jobs = plan.split_jobs()
+    batches = plan.batches(2)
+
+    # every job is in a single batch
+    assert len(batches) == 2
+    assert sorted(map(str, sum(batches, []))) == sorted(map(str, jobs))
+    # the COMMUNE jobs (the most expensive ones) are spread over the batches,
+    # the cheaper jobs sharing their input are kept together
+    for batch in batches:
+        assert "COMMUNE" in {x["level_polygons"] for x in batch}
+    for level in ("DEPARTEMENT", "REGION"):
+        assert sum(level in {x["level_polygons"] for x in b} for b in batches) == 1
+
+    assert len(plan.batches(10)) == 4
+
+    # jobs restricted to a level are spread over every batch
+    for level in ("COMMUNE", "REGION"):
+        batches = plan.batches(2, level_polygons=level)
+        assert len(batches) == 2
+        assert all(x["level_polygons"] == level for x in sum(batches, []))
+
+
+def test_parse_batch():
+    configs = parse_batch(
+        [
+            {
+                "year": 2022,
+                "level-polygons": "REGION",
+                "filter-by": "TERRITOIRE",
+                "format-output": "topojson,geojson",
+                "simplification": "0,50",
+            }
+        ]
+    )
+    assert configs == [
+        {
+            "year": 2022,
+            "level_polygons": "REGION",
+            "filter_by": "TERRITOIRE",
+            "format_output": ["topojson", "geojson"],
+            "simplification": [0.0, 50.0],
+        }
+    ]
+
+
+def test_split_batch(tmp_path, local_bucket, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fs, config = local_bucket
+    enrich_communes_from_s3(config, fs=fs)
+    dissolve_levels_from_s3({**config, "engine": "python"}, ["REGION"], fs=fs)
+
+    common = {
+        "bucket": config["bucket"],
+        "path_within_bucket": "test",
+        "local_dir": config["local_dir"],
+        "engine": "python",
+        "format_output": ["geojson"],
+        "simplification": [0],
+    }
+    configs = [
+        {**common, "level_polygons": "DEPARTEMENT", "filter_by": "REGION"},
+        {**common, "level_polygons": "REGION", "filter_by": "REGION"},
+        {**common, "level_polygons": "REGION", "filter_by": "FRANCE_ENTIERE"},
+    ]
+    split_batch_from_s3(configs, fs=fs, max_workers=2)
+
+    written = [
+        os.path.relpath(x, config["bucket"]).split("/")
+        for x in fs.find(config["bucket"])
+        if "vectorfile_format=geojson" in x
+    ]
+    assert sorted(x[5:8] for x in written if "preprocessed=" not in x[7]) == [
+        ["administrative_level=DEPARTEMENT", "crs=4326", "REGION=84"],
+        ["administrative_level=DEPARTEMENT", "crs=4326", "REGION=94"],
+        ["administrative_level=REGION", "crs=4326", "FRANCE_ENTIERE=France"],
+        ["administrative_level=REGION", "crs=4326", "REGION=84"],
+        ["administrative_level=REGION", "crs=4326", "REGION=94"],
+    ]
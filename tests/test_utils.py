@@ -66,3 +66,97 @@ from cartiflette.config import BUCKET, PATH_WITHIN_BUCKET
 def test_create_path_bucket(config, expected_path):
     result = create_path_bucket(config)
     assert result == expected_path
+
+
+from cartiflette.utils import hash_file, transcode_dbf
+
+
+def test_transcode_dbf(tmp_path):
+    import geopandas as gpd
+    from shapely.geometry import Point
+
+    path = str(tmp_path / "COMMUNE.shp")
+    names = ["Évry-Courcouronnes", "Saint-Étienne", "Paris"]
+    gpd.GeoDataFrame(
+        {"NOM": names, "POPULATION": [1, 2, 3]},
+        geometry=[Point(0, 0), Point(1, 1), Point(2, 2)],
+        crs=4326,
+    ).to_file(path, encoding="cp1252")
+    hash_shp = hash_file(path)
+
+    cpg = transcode_dbf(str(tmp_path / "COMMUNE.dbf"), "1252")
+
+    with open(cpg) as f:
+        assert f.read() == "UTF-8"
+    assert hash_file(path) == hash_shp
+    gdf = gpd.read_file(path, encoding="utf-8")
+    assert gdf["NOM"].tolist() == names
+    assert gdf["POPULATION"].tolist() == [1, 2, 3]
+
+
+from cartiflette.utils import compile_sources_index, is_described
+
+
+@pytest.mark.parametrize(
+    "combination, expected",
+    [
+        (("IGN", "ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE", "metropole", 2022), True),
+        (("IGN", "ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE", "metropole", 2015), False),
+        (("IGN", "ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE", "france", 2022), False),
+        (("IGN", "ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE", None, 2022), False),
+        (("IGN", "CONTOUR-IRIS", "ROOT", None, 2022), True),
+        (("Insee", "COG", "COMMUNE", "france_entiere", 2022), True),
+        (("Insee", "COG", "DUMMY", "france_entiere", 2022), False),
+        (("IGN", "BDTOPO", "pattern", None, 2022), False),
+    ],
+)
+def test_is_described(combination, expected):
+    index = compile_sources_index()
+    assert is_described(index, *combination) == expected
+
+
+from cartiflette.utils import get_sources_catalog, SourcesCatalog
+
+
+def test_sources_catalog():
+    catalog = get_sources_catalog()
+    assert catalog is get_sources_catalog()
+
+    resolved = catalog.resolve("Insee", "COG", "COMMUNE", "france_entiere", 2021)
+    assert resolved == {
+        "url": "https://www.insee.fr/fr/statistiques/fichier/5057840/commune2021-csv.zip",
+        "pattern": "*.csv",
+    }
+
+    resolved = catalog.resolve(
+        "IGN", "ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE", "guyane", 2022
+    )
+    assert "UTM22RGFG95_GUF" in resolved["url"]
+    assert resolved["pattern"] == "*DONNEES_LIVRAISON*.shp"
+
+    with pytest.raises(ValueError):
+        catalog.resolve("IGN", "ADMINEXPRESS", "EXPRESS-COG-TERRITOIRE", None, 2022)
+    with pytest.raises(ValueError):
+        catalog.resolve("Insee", "COG", "COMMUNE", "france_entiere", 1900)
+
+
+def test_sources_catalog_invalid():
+    config = {
+        "IGN": {
+            "DUMMY": {
+                "ROOT": {2022: {"prefix": "dummy"}},
+            }
+        }
+    }
+    with pytest.raises(ValueError):
+        SourcesCatalog(config)
+
+    config["IGN"]["DUMMY"]["structure"] = "https://dummy/{prefix}/{version}.7z"
+    with pytest.raises(ValueError):
+        SourcesCatalog(config)
+
+    config["IGN"]["DUMMY"]["ROOT"][2022]["version"] = "1-0"
+    catalog = SourcesCatalog(config)
+    assert catalog.resolve("IGN", "DUMMY", "ROOT", None, 2022)["url"] == (
+        "https://dummy/dummy/1-0.7z"
+    )